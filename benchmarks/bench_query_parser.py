@@ -0,0 +1,63 @@
+# Full stat 解析のマイクロベンチマーク
+# 旧実装 (split() + index())、同じ情報を split で取り出す場合、mc_query.parse_full_stat を
+# プレイヤー数を変えた応答で比較する。
+#
+# 実行: python benchmarks/bench_query_parser.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud-function"))
+
+from mc_query import parse_full_stat  # noqa: E402
+
+
+def build_full_stat(player_count):
+    kv = [
+        b"hostname", b"A Minecraft Server", b"gametype", b"SMP", b"game_id", b"MINECRAFT",
+        b"version", b"1.20.6", b"plugins", b"", b"map", b"world",
+        b"numplayers", str(player_count).encode(), b"maxplayers", b"1000",
+        b"hostport", b"25565", b"hostip", b"0.0.0.0",
+    ]
+    players = [f"player_{i:05d}".encode() for i in range(player_count)]
+    return (
+        b"\x00\x01\x02\x03\x04splitnum\x00\x80\x00"
+        + b"\x00".join(kv) + b"\x00\x00"
+        + b"\x01player_\x00\x00"
+        + b"".join(name + b"\x00" for name in players) + b"\x00"
+    )
+
+
+def parse_split(data):
+    """旧実装: 全体を split してから numplayers を探す (プレイヤー名は捨てる)"""
+    parts = data.split(b"\x00")
+    return int(parts[parts.index(b"numplayers") + 1])
+
+
+def parse_split_full(data):
+    """split 方式で parse_full_stat と同じ情報 (K/V とプレイヤー名) を取り出した場合"""
+    parts = data.split(b"\x00")
+    idx = parts.index(b"\x01player_")
+    kv = parts[3:idx - 1]  # 先頭の "splitnum" のパディングと末尾の空キーを除く
+    info = {kv[i].decode(): kv[i + 1].decode() for i in range(0, len(kv) - 1, 2)}
+    players = tuple(name.decode() for name in parts[idx + 2:] if name)
+    return int(info["numplayers"]), players
+
+
+def main():
+    print(f"{'players':>8} {'bytes':>8} {'split (us)':>12} {'split+decode (us)':>18} {'memoryview (us)':>16} {'ratio':>7}")
+    for player_count in (0, 10, 100, 1000, 5000):
+        data = build_full_stat(player_count)
+        assert parse_split(data) == parse_full_stat(data).numplayers == player_count
+        assert parse_split_full(data) == (player_count, parse_full_stat(data).players)
+        number = 2000 if player_count <= 100 else 200
+        split_us = min(timeit.repeat(lambda: parse_split(data), number=number, repeat=5)) / number * 1e6
+        full_us = min(timeit.repeat(lambda: parse_split_full(data), number=number, repeat=5)) / number * 1e6
+        view_us = min(timeit.repeat(lambda: parse_full_stat(data), number=number, repeat=5)) / number * 1e6
+        print(f"{player_count:>8} {len(data):>8} {split_us:>12.2f} {full_us:>18.2f} {view_us:>16.2f} {view_us / full_us:>7.2f}")
+    print("※ split は numplayers のみ、split+decode と memoryview はプレイヤー名・バージョン等もすべて取り出した時間")
+    print("※ ratio = memoryview / split+decode")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+# ベンチマーク用のローカルフェイク
+# - FakeQueryServer: Minecraft Query (handshake / full stat) を話すUDPサーバー。遅延・パケットロス・人数を設定できる
+#   slp=True なら同じポート番号の TCP で Server List Ping (handshake / status / ping) にも応答する
+# - FakeCompute: googleapiclient の Compute サービスと同じ呼び出し方ができるインメモリ実装
+#   (instances / disks / snapshots / zoneOperations / バッチリクエスト)。API呼び出しごとの遅延を設定できる
+import asyncio
+import itertools
+import json
+import random
+import re
+import struct
+import threading
+import time
+
+
+# --- Minecraft Query ---
+
+class _QueryServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        server = self.server
+        if len(data) < 7 or data[:2] != b"\xfe\xfd":
+            return
+        if random.random() < server.loss:
+            return
+        packet_type, session = data[2], data[3:7]
+        if packet_type == 0x09:
+            response = b"\x09" + session + str(server.token).encode() + b"\x00"
+        elif packet_type == 0x00 and data[7:11] == struct.pack(">i", server.token):
+            response = b"\x00" + session + server.full_stat_body()
+        else:
+            return
+        server.requests += 1
+        loop = asyncio.get_running_loop()
+        loop.call_later(server.latency, self.transport.sendto, response, addr)
+
+
+def _varint(value):
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+async def _read_slp_packet(reader):
+    length = shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    data = await reader.readexactly(length)
+    # パケットIDは 0x00 / 0x01 なので1バイト
+    return data[0], data[1:]
+
+
+def _slp_packet(packet_id, payload):
+    body = _varint(packet_id) + payload
+    return _varint(len(body)) + body
+
+
+class FakeQueryServer:
+    """別スレッドのイベントループで動くQueryサーバー
+
+    with FakeQueryServer("127.0.0.2", 25565, players=3, latency=0.01) as server:
+        ...
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, players=0, max_players=20, latency=0.0, loss=0.0, slp=True):
+        self.host = host
+        self.port = port
+        self.players = players
+        self.max_players = max_players
+        self.latency = latency
+        self.loss = loss
+        self.slp = slp
+        self.slp_requests = 0
+        self.token = random.randint(1, 2**31 - 1)
+        self.requests = 0
+        self._loop = None
+        self._thread = None
+        self._transport = None
+        self._tcp_server = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def full_stat_body(self):
+        kv = [
+            b"hostname", b"Fake Minecraft Server", b"gametype", b"SMP", b"game_id", b"MINECRAFT",
+            b"version", b"1.20.6", b"plugins", b"", b"map", b"world",
+            b"numplayers", str(self.players).encode(), b"maxplayers", str(self.max_players).encode(),
+            b"hostport", str(self.port).encode(), b"hostip", self.host.encode(),
+        ]
+        names = b"".join(f"player{i}".encode() + b"\x00" for i in range(self.players))
+        return b"splitnum\x00\x80\x00" + b"\x00".join(kv) + b"\x00\x00\x01player_\x00\x00" + names + b"\x00"
+
+    def status_json(self):
+        return {
+            "version": {"name": "1.20.6", "protocol": 766},
+            "players": {
+                "max": self.max_players, "online": self.players,
+                "sample": [{"name": f"player{i}", "id": f"00000000-0000-0000-0000-{i:012d}"} for i in range(min(self.players, 12))],
+            },
+            "description": {"text": "Fake Minecraft Server"},
+        }
+
+    async def _handle_slp(self, reader, writer):
+        try:
+            await _read_slp_packet(reader)  # handshake
+            packet_id, _ = await _read_slp_packet(reader)
+            if packet_id != 0x00:
+                return
+            self.slp_requests += 1
+            await asyncio.sleep(self.latency)
+            body = json.dumps(self.status_json()).encode()
+            writer.write(_slp_packet(0x00, _varint(len(body)) + body))
+            await writer.drain()
+            packet_id, payload = await _read_slp_packet(reader)
+            if packet_id == 0x01:
+                await asyncio.sleep(self.latency)
+                writer.write(_slp_packet(0x01, payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._transport, _ = self._loop.run_until_complete(self._loop.create_datagram_endpoint(
+                lambda: _QueryServerProtocol(self), local_addr=(self.host, self.port)))
+            self.port = self._transport.get_extra_info("sockname")[1]
+            if self.slp:
+                self._tcp_server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle_slp, self.host, self.port))
+        except OSError as e:
+            if self._transport is not None:
+                self._transport.close()
+            self._error = e
+            self._ready.set()
+            self._loop.close()
+            return
+        self._ready.set()
+        self._loop.run_forever()
+        # close() はソケットの解放を次のループ反復で行うので、1回回してから閉じる
+        self._transport.close()
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+            self._loop.run_until_complete(self._tcp_server.wait_closed())
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._error is None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+# --- Compute API ---
+
+class FakeHttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.resp = type("Resp", (), {"status": status})()
+
+
+class FakeRequest:
+    """googleapiclient.http.HttpRequest の代わり。execute() で遅延してから結果を返す"""
+
+    def __init__(self, compute, method_id, func):
+        self.compute = compute
+        self.methodId = method_id
+        self._func = func
+
+    def execute(self):
+        self.compute.record_call(self.methodId)
+        time.sleep(self.compute.latency)
+        return self._func()
+
+
+class FakeBatch:
+    def __init__(self, compute, callback):
+        self.compute = compute
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self):
+        # バッチ全体で1往復分の遅延
+        self.compute.record_call("batch")
+        time.sleep(self.compute.latency)
+        for request_id, request in self.requests:
+            self.compute.record_call(request.methodId)
+            try:
+                response, error = request._func(), None
+            except FakeHttpError as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+
+class _Resource:
+    def __init__(self, compute, prefix):
+        self._compute = compute
+        self._prefix = prefix
+
+    def _request(self, method, func):
+        return FakeRequest(self._compute, f"compute.{self._prefix}.{method}", func)
+
+
+class _Instances(_Resource):
+    def get(self, project, zone, instance, fields=None):
+        return self._request("get", lambda: self._compute.instance(zone, instance))
+
+    def start(self, project, zone, instance):
+        return self._request("start", lambda: self._compute.transition(zone, instance, "RUNNING", "start"))
+
+    def stop(self, project, zone, instance):
+        return self._request("stop", lambda: self._compute.transition(zone, instance, "TERMINATED", "stop"))
+
+    def aggregatedList(self, project, filter=None, fields=None, returnPartialSuccess=None, pageToken=None):
+        request = self._request("aggregatedList", lambda: self._compute.aggregated_list(filter, pageToken))
+        request.args = {"project": project, "filter": filter, "fields": fields}
+        return request
+
+    def aggregatedList_next(self, previous_request, previous_response):
+        token = previous_response.get("nextPageToken")
+        if not token:
+            return None
+        return self.aggregatedList(pageToken=token, **previous_request.args)
+
+
+class _Disks(_Resource):
+    def createSnapshot(self, project, zone, disk, body):
+        return self._request("createSnapshot", lambda: self._compute.create_snapshot(zone, disk, body))
+
+
+class _Snapshots(_Resource):
+    def list(self, project, filter=None, fields=None, maxResults=500, pageToken=None):
+        request = self._request("list", lambda: self._compute.list_snapshots(filter, maxResults, pageToken))
+        request.args = {"project": project, "filter": filter, "fields": fields, "maxResults": maxResults}
+        return request
+
+    def list_next(self, previous_request, previous_response):
+        token = previous_response.get("nextPageToken")
+        if not token:
+            return None
+        return self.list(pageToken=token, **previous_request.args)
+
+    def get(self, project, snapshot, fields=None):
+        return self._request("get", lambda: self._compute.snapshot(snapshot))
+
+    def delete(self, project, snapshot):
+        return self._request("delete", lambda: self._compute.delete_snapshot(snapshot))
+
+
+class _ZoneOperations(_Resource):
+    def get(self, project, zone, operation):
+        return self._request("get", lambda: self._compute.operation(operation))
+
+    def wait(self, project, zone, operation):
+        return self._request("wait", lambda: self._compute.wait_operation(operation))
+
+
+class FakeCompute:
+    """インメモリの Compute API
+
+    compute = FakeCompute(latency=0.05, operation_seconds=0.2)
+    compute.add_instance("asia-northeast1-b", "mc-1", ip="127.0.0.2")
+    """
+
+    def __init__(self, latency=0.0, operation_seconds=0.0, page_size=500):
+        self.latency = latency
+        self.operation_seconds = operation_seconds
+        self.page_size = page_size
+        self.instance_table = {}  # (zone, name) -> dict
+        self.snapshot_table = {}  # name -> dict
+        self.operation_table = {}  # name -> (done_at, dict)
+        self.calls = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def record_call(self, method_id):
+        with self._lock:
+            self.calls[method_id] = self.calls.get(method_id, 0) + 1
+
+    # googleapiclient 互換のエントリポイント
+    def instances(self):
+        return _Instances(self, "instances")
+
+    def disks(self):
+        return _Disks(self, "disks")
+
+    def snapshots(self):
+        return _Snapshots(self, "snapshots")
+
+    def zoneOperations(self):
+        return _ZoneOperations(self, "zoneOperations")
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # --- データの準備 ---
+    def add_instance(self, zone, name, ip=None, status="RUNNING", labels=None):
+        self.instance_table[(zone, name)] = {
+            "name": name,
+            "zone": f"https://www.googleapis.com/compute/v1/projects/fake/zones/{zone}",
+            "status": status,
+            "labels": labels or {},
+            "networkInterfaces": [{"accessConfigs": [{"natIP": ip}] if ip else []}],
+            "disks": [{"boot": True, "source": f"projects/fake/zones/{zone}/disks/{name}"}],
+        }
+
+    def add_snapshot(self, name, created_at, storage_bytes=1 << 30):
+        self.snapshot_table[name] = {
+            "name": name,
+            "id": str(next(self._ids)),
+            "creationTimestamp": created_at,
+            "storageBytes": str(storage_bytes),
+            "status": "READY",
+        }
+
+    # --- 各APIの挙動 ---
+    def instance(self, zone, name):
+        instance = self.instance_table.get((zone, name))
+        if instance is None:
+            raise FakeHttpError(404, f"instance {zone}/{name} not found")
+        return instance
+
+    def _operation(self, zone, target, operation_type):
+        name = f"operation-{next(self._ids)}"
+        operation = {
+            "name": name,
+            "zone": f"https://www.googleapis.com/compute/v1/projects/fake/zones/{zone}",
+            "operationType": operation_type,
+            "targetLink": f"projects/fake/zones/{zone}/{target}",
+            "status": "RUNNING",
+        }
+        with self._lock:
+            self.operation_table[name] = (time.monotonic() + self.operation_seconds, operation)
+        return dict(operation)
+
+    def transition(self, zone, name, status, operation_type):
+        instance = self.instance(zone, name)
+        instance["status"] = status
+        if status == "TERMINATED":
+            instance["networkInterfaces"][0]["accessConfigs"] = []
+        return self._operation(zone, f"instances/{name}", operation_type)
+
+    def create_snapshot(self, zone, disk, body):
+        if body["name"] in self.snapshot_table:
+            raise FakeHttpError(409, f"snapshot {body['name']} already exists")
+        self.add_snapshot(body["name"], time.strftime("%Y-%m-%dT%H:%M:%S.000+00:00", time.gmtime()))
+        return self._operation(zone, f"disks/{disk}", "createSnapshot")
+
+    def operation(self, name):
+        with self._lock:
+            done_at, operation = self.operation_table[name]
+        result = dict(operation)
+        if time.monotonic() >= done_at:
+            result["status"] = "DONE"
+        return result
+
+    def wait_operation(self, name):
+        with self._lock:
+            done_at, _ = self.operation_table[name]
+        time.sleep(max(0.0, done_at - time.monotonic()))
+        return self.operation(name)
+
+    def aggregated_list(self, filter_expr, page_token):
+        names = set(re.findall(r'name = "([^"]+)"', filter_expr or ""))
+        labels = dict(re.findall(r'labels\.([\w-]+) = "([^"]*)"', filter_expr or ""))
+        require_running = 'status = "RUNNING"' in (filter_expr or "")
+        matched = [
+            instance for instance in self.instance_table.values()
+            if (not names or instance["name"] in names)
+            and all(instance["labels"].get(k) == v for k, v in labels.items())
+            and (not require_running or instance["status"] == "RUNNING")
+        ]
+        start = int(page_token or 0)
+        page = matched[start:start + self.page_size]
+        items = {}
+        for instance in page:
+            items.setdefault(f"zones/{instance['zone'].split('/')[-1]}", {"instances": []})["instances"].append(instance)
+        response = {"items": items}
+        if start + self.page_size < len(matched):
+            response["nextPageToken"] = str(start + self.page_size)
+        return response
+
+    def list_snapshots(self, filter_expr, max_results, page_token):
+        pattern = None
+        match = re.match(r"name eq '(.*)'$", filter_expr or "")
+        if match:
+            pattern = re.compile(match.group(1))
+        matched = [s for name, s in sorted(self.snapshot_table.items()) if pattern is None or pattern.fullmatch(name)]
+        start = int(page_token or 0)
+        size = min(max_results, self.page_size)
+        response = {"items": matched[start:start + size]}
+        if start + size < len(matched):
+            response["nextPageToken"] = str(start + size)
+        return response
+
+    def snapshot(self, name):
+        snapshot = self.snapshot_table.get(name)
+        if snapshot is None:
+            raise FakeHttpError(404, f"snapshot {name} not found")
+        return {"status": snapshot["status"]}
+
+    def delete_snapshot(self, name):
+        if self.snapshot_table.pop(name, None) is None:
+            raise FakeHttpError(404, f"snapshot {name} not found")
+        return {"name": f"operation-{next(self._ids)}", "status": "RUNNING", "operationType": "delete"}
@@ -0,0 +1,395 @@
+# オフラインのベンチマーク / 負荷テスト
+# 実VMやGCPプロジェクトなしで、ローカルのフェイク (benchmarks/fakes.py) に対して
+#   - cloud-function/main.py の main() (単体モード / フリートモード)
+#   - cloud-function-delete-snapshots/main.py の delete_old_snapshots_http()
+#   - discord-bot/bot.py のGCPヘルパー (discord.py などの依存が入っている場合のみ)
+#   - discord-bot/gcp_client.py の並列実行 (googleapiclient が入っている場合のみ)
+# を端から端まで実行し、シナリオごとに p50 / p99 レイテンシとスループットを出力する。
+#
+# 実行: python benchmarks/run_benchmarks.py [--iterations 50] [--api-latency 0.02] [--only check_players,delete,bot,gcp_client]
+#
+# フリートのシナリオは 127.0.0.2 以降のループバックアドレスに Query サーバーを立てる (Linux 前提)。
+import argparse
+import asyncio
+import contextlib
+import datetime
+import importlib.util
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeCompute, FakeQueryServer  # noqa: E402
+
+ZONE = "asia-northeast1-b"
+INSTANCE = "minecraft-server"
+SNAPSHOT_PREFIX = "minecraft-server-snapshot-"
+
+
+def load_module(alias, directory, filename="main.py"):
+    """デプロイ単位ごとのディレクトリからモジュールを別名で読み込む (main.py 同士の衝突を避ける)"""
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[alias] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_udp_port():
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def measure(name, func, iterations, setup=None, quiet=True):
+    """func() を iterations 回呼び、レイテンシの統計を返す。setup() は計測に含めない"""
+    samples = []
+    errors = 0
+    wall = 0.0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        sink = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(sink):
+            started_at = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                result = e
+            elapsed = time.perf_counter() - started_at
+        wall += elapsed
+        samples.append(elapsed)
+        if isinstance(result, Exception) or (isinstance(result, tuple) and result[1] >= 500):
+            errors += 1
+    return {
+        "name": name,
+        "n": iterations,
+        "p50_ms": statistics.median(samples) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+        "throughput": iterations / wall if wall else float("inf"),
+        "errors": errors,
+    }
+
+
+def print_report(rows):
+    print(f"{'scenario':<28} {'n':>5} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10} {'ops/s':>9} {'errors':>7}")
+    for row in rows:
+        print(
+            f"{row['name']:<28} {row['n']:>5} {row['p50_ms']:>10.1f} {row['p99_ms']:>10.1f} "
+            f"{row['max_ms']:>10.1f} {row['throughput']:>9.1f} {row['errors']:>7}"
+        )
+
+
+# --- check_players (cloud-function/main.py) ---
+
+def setup_check_players(args, history_dir):
+    cf = load_module("check_players_main", "cloud-function")
+    cf.project_id = "fake-project"
+    cf.gce_zone = ZONE
+    cf.gce_instance_name = INSTANCE
+    cf.DISCORD_BOT_WEBHOOK_URL = None
+    cf.RCON_PASSWORD = None
+    cf.PLAYER_HISTORY_URI = history_dir
+    cf.OPERATION_WAIT_SECONDS = args.operation_wait
+    return cf
+
+
+def check_players_scenarios(args, history_dir):
+    cf = setup_check_players(args, history_dir)
+    compute = FakeCompute(latency=args.api_latency, operation_seconds=args.operation_seconds)
+    cf._compute_service = compute
+    # フリートの停止処理のワーカーもスレッドごとのクライアントとして同じフェイクを使う
+    cf.build_compute_service = lambda: compute
+    port = free_udp_port()
+    cf.MINECRAFT_QUERY_PORT = port
+    cf.MINECRAFT_GAME_PORT = port
+    rows = []
+
+    def reset_single():
+        compute.add_instance(ZONE, INSTANCE, ip="127.0.0.1")
+        compute.snapshot_table.clear()
+
+    with FakeQueryServer("127.0.0.1", port, players=3, latency=args.query_latency):
+        cf.GCE_INSTANCES = cf.GCE_INSTANCE_LABEL = None
+        rows.append(measure("check_players:active", lambda: cf.main(None), args.iterations, reset_single))
+
+    with FakeQueryServer("127.0.0.1", port, players=0, latency=args.query_latency):
+        cf.IDLE_REQUIRED_ZERO_READINGS = 1
+        cf.SKIP_UNCHANGED_SNAPSHOT = False
+        rows.append(measure("check_players:idle_stop", lambda: cf.main(None), args.iterations, reset_single))
+
+    # 応答しないサーバー: Queryのタイムアウト (5秒) がそのまま効くので回数を絞る
+    with FakeQueryServer("127.0.0.1", port, loss=1.0, slp=False):
+        rows.append(measure("check_players:hung_server", lambda: cf.main(None), min(args.iterations, 3), reset_single))
+
+    # Query だけ遮断されたサーバー: Query のタイムアウト後に Server List Ping で人数を取る
+    with FakeQueryServer("127.0.0.1", port, players=3, latency=args.query_latency, loss=1.0):
+        rows.append(measure("check_players:query_blocked", lambda: cf.main(None), min(args.iterations, 3), reset_single))
+
+    # Server List Ping を先に試す設定
+    with FakeQueryServer("127.0.0.1", port, players=3, latency=args.query_latency):
+        cf.PLAYER_PROBES = ["ping", "query"]
+        rows.append(measure("check_players:ping_first", lambda: cf.main(None), args.iterations, reset_single))
+        cf.PLAYER_PROBES = ["query", "ping"]
+
+    # fleet_N: 半分をアイドルにして停止処理も通す / fleet_idle_N: 全台アイドル (停止処理の並行度を見る)
+    fleets = [(f"fleet_{size}", size, lambda i: 0 if i % 2 else 2) for size in args.fleet_sizes]
+    fleets += [(f"fleet_idle_{size}", size, lambda i: 0) for size in args.fleet_sizes]
+    for name, size, players in fleets:
+        hosts = [f"127.0.0.{i + 2}" for i in range(size)]
+        servers = [
+            FakeQueryServer(host, port, players=players(i), latency=args.query_latency)
+            for i, host in enumerate(hosts)
+        ]
+
+        def reset_fleet():
+            compute.instance_table.clear()
+            compute.snapshot_table.clear()
+            for i, host in enumerate(hosts):
+                compute.add_instance(ZONE, f"mc-{i}", ip=host, labels={"role": "minecraft"})
+
+        with contextlib.ExitStack() as stack:
+            for server in servers:
+                stack.enter_context(server)
+            cf.GCE_INSTANCE_LABEL = "role=minecraft"
+            rows.append(measure(f"check_players:{name}", lambda: cf.main(None), args.iterations, reset_fleet))
+        cf.GCE_INSTANCE_LABEL = None
+    rows[-1]["calls"] = dict(compute.calls)
+    idle_rows = [row for row in rows if row["name"].startswith("check_players:fleet_idle_")]
+    if len(idle_rows) > 1:
+        # 全台アイドルのフリートで、最小の台数に対する最大の台数の所要時間 (1に近いほど台数によらず一定)
+        idle_rows[-1]["note"] = (f"{idle_rows[-1]['name']} / {idle_rows[0]['name']} の p50 比: "
+                                 f"{idle_rows[-1]['p50_ms'] / idle_rows[0]['p50_ms']:.2f} "
+                                 f"(停止処理の同時実行数 {cf.FLEET_STOP_CONCURRENCY})")
+    return rows
+
+
+# --- delete_old_snapshots (cloud-function-delete-snapshots/main.py) ---
+
+def delete_snapshot_scenarios(args):
+    dm = load_module("delete_snapshots_main", "cloud-function-delete-snapshots")
+    compute = FakeCompute(latency=args.api_latency)
+    dm._compute_service = compute
+    dm.PROJECT_ID = "fake-project"
+    dm.SNAPSHOT_PREFIX = SNAPSHOT_PREFIX
+    dm.SNAPSHOT_RETENTION_COUNT = 7
+    dm.SNAPSHOT_SOURCES = [SNAPSHOT_PREFIX[:-len("-snapshot-")]]
+    dm.RETENTION_DRY_RUN = False
+    started_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=-8)))
+
+    def populate():
+        compute.snapshot_table.clear()
+        for i in range(args.snapshots):
+            # 約1時間ごとの自動スナップショットと、10個に1個の手動バックアップ
+            created = started_at + datetime.timedelta(minutes=61 * i)
+            created_at = created.isoformat(timespec="milliseconds")
+            stamp = created.strftime("%Y%m%d-%H%M%S")
+            compute.add_snapshot(f"{SNAPSHOT_PREFIX}{stamp}", created_at)
+            if i % 10 == 0:
+                compute.add_snapshot(f"{dm.SNAPSHOT_SOURCES[0]}-backup-{stamp}", created_at)
+            # 他のインスタンスのスナップショットは対象外
+            compute.add_snapshot(f"other-disk-snapshot-{stamp}", created_at)
+
+    rows = [measure(f"delete_snapshots:{args.snapshots}", lambda: dm.delete_old_snapshots_http(None), args.iterations, populate)]
+    rows[-1]["calls"] = dict(compute.calls)
+    return rows
+
+
+# --- Discord Bot のGCPヘルパー ---
+
+def load_bot(compute):
+    config = types.ModuleType("config")
+    config.DISCORD_BOT_TOKEN = "benchmark"
+    config.GCP_PROJECT_ID = "fake-project"
+    config.GCP_ZONE = ZONE
+    config.GCP_INSTANCE_NAME = INSTANCE
+    config.DISCORD_CHANNEL_ID = 0
+    config.RCON_PASSWORD = ""
+    config.RCON_PORT = 25575
+    sys.modules["config"] = config
+    with mock.patch("google.auth.default", return_value=(None, "fake-project")), \
+            contextlib.redirect_stdout(io.StringIO()):
+        bot = load_module("discord_bot_main", "discord-bot", "bot.py")
+    from gcp_client import ComputeClient
+    bot.compute.shutdown()
+    bot.compute = ComputeClient(None, observer=bot.observe_gcp_call, service_factory=lambda: compute)
+    return bot
+
+
+def bot_scenarios(args):
+    try:
+        import discord  # noqa: F401
+        import aiohttp  # noqa: F401
+        import googleapiclient  # noqa: F401
+    except ImportError as e:
+        print(f"discord-bot のシナリオはスキップします (依存パッケージがありません: {e.name})")
+        return []
+    compute = FakeCompute(latency=args.api_latency, operation_seconds=args.operation_seconds)
+    compute.add_instance(ZONE, INSTANCE, ip="127.0.0.1")
+    bot = load_bot(compute)
+    loop = asyncio.new_event_loop()
+
+    def run(coro_func):
+        return lambda: loop.run_until_complete(coro_func())
+
+    async def concurrent_status():
+        # 同時に来たコマンドが1本の instances().get に合流すること
+        bot.instance_cache.invalidate()
+        await asyncio.gather(*(bot.get_instance_status() for _ in range(args.concurrency)))
+
+    async def snapshot_and_wait():
+        ok, _, error = await bot.create_gce_snapshot(INSTANCE, "bench", wait=True)
+        if not ok:
+            raise RuntimeError(error)
+
+    rows = [
+        measure("bot:get_instance_state", run(bot.get_instance_state), args.iterations,
+                setup=lambda: bot.instance_cache.invalidate()),
+        measure("bot:get_instance_state_hit", run(bot.get_instance_state), args.iterations),
+        measure(f"bot:status_x{args.concurrency}", run(concurrent_status), args.iterations),
+        measure("bot:start_instance", run(bot.start_instance), args.iterations),
+        measure("bot:snapshot_wait", run(snapshot_and_wait), min(args.iterations, 10),
+                setup=compute.snapshot_table.clear),
+    ]
+    rows[-1]["calls"] = dict(compute.calls)
+    bot.compute.shutdown()
+    loop.close()
+    return rows
+
+
+# --- gcp_client.ComputeClient の並列実行 ---
+# bot:status_x* は single-flight で1回の呼び出しに合流するため並列性の確認にならない。
+# ここでは別々のインスタンスへの instances().get をワーカー数だけ同時に投げ、
+#   - 全体の所要時間が1往復分 (N往復分ではない) に収まること
+#   - その間もイベントループが応答し続けること (ティッカーの遅れが小さいこと)
+# を確認する。どちらかを満たさなければエラーとして数える。
+
+GCP_CLIENT_DELAY = 0.1
+GCP_CLIENT_TICK = 0.005
+
+
+def gcp_client_scenarios(args):
+    try:
+        import googleapiclient  # noqa: F401
+    except ImportError as e:
+        print(f"gcp_client のシナリオはスキップします (依存パッケージがありません: {e.name})")
+        return []
+    sys.path.insert(0, os.path.join(ROOT, "discord-bot"))
+    from gcp_client import DEFAULT_MAX_WORKERS, ComputeClient
+
+    workers = DEFAULT_MAX_WORKERS
+    compute = FakeCompute(latency=GCP_CLIENT_DELAY)
+    names = [f"{INSTANCE}-{i}" for i in range(workers)]
+    for name in names:
+        compute.add_instance(ZONE, name)
+    client = ComputeClient(None, max_workers=workers, service_factory=lambda: compute)
+    loop = asyncio.new_event_loop()
+    worst = {"elapsed": 0.0, "lag": 0.0}
+
+    async def ticker(stop):
+        # 一定間隔で起きるはずのコルーチンが、どれだけ遅れて起きたかの最大値
+        max_lag = 0.0
+        while not stop.is_set():
+            started_at = time.perf_counter()
+            await asyncio.sleep(GCP_CLIENT_TICK)
+            max_lag = max(max_lag, time.perf_counter() - started_at - GCP_CLIENT_TICK)
+        return max_lag
+
+    async def parallel_get():
+        stop = asyncio.Event()
+        tick = asyncio.ensure_future(ticker(stop))
+        started_at = time.perf_counter()
+        results = await asyncio.gather(*(
+            client.execute(lambda s, name=name: s.instances().get(project="fake", zone=ZONE, instance=name))
+            for name in names
+        ))
+        elapsed = time.perf_counter() - started_at
+        stop.set()
+        lag = await tick
+        worst["elapsed"] = max(worst["elapsed"], elapsed)
+        worst["lag"] = max(worst["lag"], lag)
+        assert [result["name"] for result in results] == names
+        assert elapsed < GCP_CLIENT_DELAY * 1.5, \
+            f"{workers}件の呼び出しに {elapsed * 1000:.0f}ms かかりました (1往復 {GCP_CLIENT_DELAY * 1000:.0f}ms)"
+        assert lag < GCP_CLIENT_DELAY / 2, f"イベントループが {lag * 1000:.0f}ms 止まりました"
+
+    async def warm_up():
+        await asyncio.gather(*(client.run(lambda s: None) for _ in range(workers)))
+
+    def run():
+        loop.run_until_complete(parallel_get())
+
+    # ワーカースレッドの起動とクライアント生成は計測から外す
+    loop.run_until_complete(warm_up())
+    row = measure(f"gcp_client:get_x{workers}", run, args.iterations)
+    client.shutdown()
+    loop.close()
+    row["note"] = (
+        f"gcp_client: {workers}件の並行呼び出し 最大 {worst['elapsed'] * 1000:.1f}ms "
+        f"(1往復 {GCP_CLIENT_DELAY * 1000:.0f}ms / 直列なら {workers * GCP_CLIENT_DELAY * 1000:.0f}ms)、"
+        f"イベントループの最大遅延 {worst['lag'] * 1000:.1f}ms"
+    )
+    return [row]
+
+
+SCENARIOS = {
+    "check_players": lambda args, tmp: check_players_scenarios(args, tmp),
+    "delete": lambda args, tmp: delete_snapshot_scenarios(args),
+    "bot": lambda args, tmp: bot_scenarios(args),
+    "gcp_client": lambda args, tmp: gcp_client_scenarios(args),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="フェイクのQueryサーバー / Compute APIに対するベンチマーク")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Compute API 1往復あたりの遅延 (秒)")
+    parser.add_argument("--query-latency", type=float, default=0.005, help="Query応答の遅延 (秒)")
+    parser.add_argument("--operation-seconds", type=float, default=0.2, help="オペレーションが DONE になるまでの秒数")
+    parser.add_argument("--operation-wait", type=float, default=0, help="check_players の OPERATION_WAIT_SECONDS")
+    parser.add_argument("--fleet-sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1, 5, 20])
+    parser.add_argument("--snapshots", type=int, default=500, help="削除シナリオのスナップショット数 (プレフィックス一致分)")
+    parser.add_argument("--concurrency", type=int, default=50, help="bot の同時ステータス取得数")
+    parser.add_argument("--only", help=f"実行するシナリオ (カンマ区切り): {','.join(SCENARIOS)}")
+    parser.add_argument("--show-calls", action="store_true", help="シナリオごとのAPI呼び出し回数を表示する")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TRACE_ENABLED", "false")
+    selected = args.only.split(",") if args.only else list(SCENARIOS)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in selected:
+            rows.extend(SCENARIOS[name](args, tmp))
+    print_report(rows)
+    for row in rows:
+        if "note" in row:
+            print(row["note"])
+    if args.show_calls:
+        for row in rows:
+            if "calls" in row:
+                print(f"{row['name']} までの累計: {row['calls']}")
+    # エラーのあったシナリオがあれば失敗として終了する (gcp_client の並列性チェックなど)
+    if any(row["errors"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
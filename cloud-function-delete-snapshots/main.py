@@ -1,62 +1,172 @@
 import os
-import google.auth
-from googleapiclient import discovery
-from datetime import datetime, timezone
+import re
+import json
+from zoneinfo import ZoneInfo
+
+from tracing import Trace
+from retention import KINDS, parse_policy, plan_retention
 
 # 環境変数から設定を取得
 PROJECT_ID = os.environ.get("GCP_PROJECT")
 SNAPSHOT_PREFIX = os.environ.get("SNAPSHOT_PREFIX", "minecraft-server-snapshot-") # デフォルトのプレフィックス
 SNAPSHOT_RETENTION_COUNT = int(os.environ.get("SNAPSHOT_RETENTION_COUNT", 7)) # デフォルトの保持数 (例: 最新7個)
+# 対象のインスタンス名 (カンマ区切り)。<名前>-snapshot-* と <名前>-backup-* の両方を世代管理する
+# 未設定なら SNAPSHOT_PREFIX ("<名前>-snapshot-") から取り出す
+SNAPSHOT_SOURCES = [
+    source.strip() for source in
+    os.environ.get("SNAPSHOT_SOURCES", re.sub(r"-snapshot-?$", "", SNAPSHOT_PREFIX)).split(",")
+    if source.strip()
+]
+# 種類ごとの保持ルール (retention.parse_policy の形式、空なら既定値)
+#   snapshot: 停止前の自動スナップショット / backup: /mc_backup による手動バックアップ
+SNAPSHOT_RETENTION_POLICY = (os.environ.get("SNAPSHOT_RETENTION_POLICY")
+                             or f"latest={SNAPSHOT_RETENTION_COUNT},daily=7,weekly=4,monthly=3")
+BACKUP_RETENTION_POLICY = (os.environ.get("BACKUP_RETENTION_POLICY")
+                           or f"latest={SNAPSHOT_RETENTION_COUNT},weekly=8,monthly=12")
+# 日・週・月の区切りに使うタイムゾーン (Scheduler と同じ)
+RETENTION_TIMEZONE = os.environ.get("RETENTION_TIMEZONE", "Asia/Tokyo")
+# true なら削除せずに計画だけを返す (?dry_run=1 でも指定できる)
+RETENTION_DRY_RUN = os.environ.get("RETENTION_DRY_RUN", "false").lower() == "true"
+
+# 一覧取得時に必要なフィールドだけを返させる
+SNAPSHOT_LIST_FIELDS = "items(name,id,creationTimestamp,storageBytes),nextPageToken"
+SNAPSHOT_PAGE_SIZE = 500
+# 1回のバッチHTTPリクエストにまとめる削除件数 (APIの上限は1000)
+DELETE_BATCH_SIZE = 100
+
+# Computeクライアントはウォームスタート間で使い回す
+_compute_service = None
+
+def get_compute_service():
+    """Compute APIクライアントを遅延生成し、ウォームスタート間で再利用する"""
+    global _compute_service
+    if _compute_service is None:
+        import google.auth
+        from googleapiclient import discovery
+        credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/compute'])
+        # ライブラリ同梱の静的ディスカバリドキュメントを使い、ネットワーク取得を行わない
+        _compute_service = discovery.build('compute', 'v1', credentials=credentials, static_discovery=True, cache_discovery=False)
+    return _compute_service
+
+def snapshot_name_pattern(sources):
+    """対象インスタンスの自動スナップショットと手動バックアップの両方に一致する正規表現"""
+    return f"({'|'.join(re.escape(source) for source in sources)})-({'|'.join(KINDS)})-.*"
+
+def iter_snapshots(service, project, pattern):
+    """名前が pattern に一致するスナップショットをページ単位で取得しながら1件ずつ返す"""
+    request = service.snapshots().list(
+        project=project,
+        # フィルタはサーバー側で評価させる (eq は正規表現の完全一致)
+        filter=f"name eq '{pattern}'",
+        fields=SNAPSHOT_LIST_FIELDS,
+        maxResults=SNAPSHOT_PAGE_SIZE,
+    )
+    while request is not None:
+        response = request.execute()
+        for snapshot in response.get('items', []):
+            yield snapshot
+        request = service.snapshots().list_next(request, response)
+
+def is_dry_run(request):
+    if RETENTION_DRY_RUN:
+        return True
+    args = getattr(request, 'args', None) or {}
+    return str(args.get('dry_run', '')).lower() in ('1', 'true')
+
+def _format_bytes(size):
+    return f"{size / (1 << 30):.2f}GiB"
+
+def delete_snapshots_batched(service, project, snapshots, batch_size=DELETE_BATCH_SIZE):
+    """スナップショットの削除をバッチHTTPリクエストで送り、{name: (operation, error)} を返す"""
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(snapshots), batch_size):
+        batch = service.new_batch_http_request(callback=callback)
+        for snapshot in snapshots[start:start + batch_size]:
+            batch.add(service.snapshots().delete(project=project, snapshot=snapshot['name']), request_id=snapshot['name'])
+        try:
+            batch.execute()
+        except Exception as e_batch:
+            # バッチ全体が失敗した場合は、結果が得られなかった項目をエラーとして記録する
+            for snapshot in snapshots[start:start + batch_size]:
+                results.setdefault(snapshot['name'], (None, e_batch))
+    return results
 
 def delete_old_snapshots_http(request): # HTTPトリガー用のエントリポイント
-    print(f"delete_old_snapshots_http関数開始。プロジェクト: {PROJECT_ID}, プレフィックス: {SNAPSHOT_PREFIX}, 保持数: {SNAPSHOT_RETENTION_COUNT}", flush=True)
-    
+    trace = Trace("delete_old_snapshots")
+    response = ("Unhandled error", 500)
+    try:
+        response = _delete_old_snapshots(trace, is_dry_run(request))
+        return response
+    finally:
+        trace.emit("error" if response[1] >= 500 else "ok", status=response[1])
+
+def _json_response(report, status):
+    return json.dumps(report, ensure_ascii=False), status, {"Content-Type": "application/json; charset=utf-8"}
+
+def _delete_old_snapshots(trace, dry_run):
+    print(f"delete_old_snapshots_http関数開始。プロジェクト: {PROJECT_ID}, 対象: {SNAPSHOT_SOURCES}, "
+          f"自動スナップショット: {SNAPSHOT_RETENTION_POLICY}, 手動バックアップ: {BACKUP_RETENTION_POLICY}"
+          f"{' (ドライラン)' if dry_run else ''}", flush=True)
+
     if not PROJECT_ID:
         print("エラー: 環境変数 GCP_PROJECT が設定されていません。", flush=True)
         return "Configuration error: GCP_PROJECT not set", 500
+    try:
+        policies = {"snapshot": parse_policy(SNAPSHOT_RETENTION_POLICY), "backup": parse_policy(BACKUP_RETENTION_POLICY)}
+    except ValueError as e:
+        print(f"エラー: 保持ルールの設定が不正です: {e}", flush=True)
+        return f"Configuration error: {e}", 500
 
     try:
-        credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/compute'])
-        service = discovery.build('compute', 'v1', credentials=credentials)
-
-        result = service.snapshots().list(project=PROJECT_ID).execute()
-        snapshots = result.get('items', [])
-
-        relevant_snapshots = []
-        for snapshot in snapshots:
-            if snapshot['name'].startswith(SNAPSHOT_PREFIX):
-                try:
-                    # creationTimestamp は RFC3339 UTC 形式 (例: '2024-01-15T10:00:00.000-08:00')
-                    # Python 3.7+ の datetime.fromisoformat でパース可能
-                    creation_time = datetime.fromisoformat(snapshot['creationTimestamp'])
-                    relevant_snapshots.append({'name': snapshot['name'], 'creationTimestamp': creation_time, 'id': snapshot['id']})
-                except Exception as e_parse:
-                    print(f"スナップショット {snapshot['name']} の作成日時パースエラー: {e_parse}", flush=True)
-        
-        # 作成日時の降順（新しいものが先頭）でソート
-        relevant_snapshots.sort(key=lambda s: s['creationTimestamp'], reverse=True)
-        
-        print(f"見つかった関連スナップショット ({len(relevant_snapshots)}個):", flush=True)
-        for snap_idx, snap in enumerate(relevant_snapshots):
-            print(f"  [{snap_idx+1}] {snap['name']} (作成日時: {snap['creationTimestamp']})", flush=True)
-
-        if len(relevant_snapshots) > SNAPSHOT_RETENTION_COUNT:
-            snapshots_to_delete = relevant_snapshots[SNAPSHOT_RETENTION_COUNT:]
-            print(f"保持数({SNAPSHOT_RETENTION_COUNT})を超えるため、以下のスナップショットを削除します ({len(snapshots_to_delete)}個):", flush=True)
-            for snap_to_delete in snapshots_to_delete:
-                try:
-                    print(f"  - {snap_to_delete['name']} を削除中...", flush=True)
-                    delete_op = service.snapshots().delete(
-                        project=PROJECT_ID,
-                        snapshot=snap_to_delete['name']
-                    ).execute()
-                    print(f"    スナップショット削除API呼び出し成功: {snap_to_delete['name']}, operation: {delete_op.get('name')}", flush=True)
-                except Exception as e_del:
-                    print(f"    スナップショット {snap_to_delete['name']} の削除中にエラー: {e_del}", flush=True)
-        else:
-            print(f"関連スナップショット数({len(relevant_snapshots)})が保持数({SNAPSHOT_RETENTION_COUNT})以下のため、削除は行いません。", flush=True)
-            
-        return "Snapshot cleanup process completed successfully.", 200
+        service = get_compute_service()
+
+        with trace.phase("list"):
+            plan = plan_retention(
+                iter_snapshots(service, PROJECT_ID, snapshot_name_pattern(SNAPSHOT_SOURCES)),
+                policies, ZoneInfo(RETENTION_TIMEZONE),
+            )
+        snapshots_to_delete = plan.to_delete
+        report = plan.report()
+        report["dry_run"] = dry_run
+        trace.set(kept=report["kept"], to_delete=report["deleted"], reclaimed_bytes=report["reclaimed_bytes"], dry_run=dry_run)
+
+        for (source, kind), group in sorted(plan.groups.items()):
+            print(f"[{source} / {kind}] 保持 {len(group['kept'])}個, 削除対象 {len(group['delete'])}個:", flush=True)
+            for snap in group['kept']:
+                print(f"  保持 {snap['name']} (作成日時: {snap['creationTimestamp']}, "
+                      f"{_format_bytes(snap['storageBytes'])}, 理由: {'/'.join(group['reasons'][snap['name']])})", flush=True)
+            for snap in group['delete']:
+                print(f"  削除 {snap['name']} (作成日時: {snap['creationTimestamp']}, {_format_bytes(snap['storageBytes'])})", flush=True)
+        if plan.unmatched:
+            print(f"名前の形式が合わないため判定しなかったスナップショット: {[snap['name'] for snap in plan.unmatched]}", flush=True)
+        # スナップショットは増分なので、削除しても storageBytes の全量が減るとは限らない (後続のスナップショットに移る分がある)
+        print(f"削除で減るストレージ (storageBytes の合計、概算): {_format_bytes(report['reclaimed_bytes'])} / "
+              f"保持するストレージ: {_format_bytes(report['kept_bytes'])}", flush=True)
+
+        if not snapshots_to_delete or dry_run:
+            if dry_run:
+                print("ドライランのため、削除は行いません。", flush=True)
+            return _json_response(report, 200)
+
+        with trace.phase("delete"):
+            results = delete_snapshots_batched(service, PROJECT_ID, snapshots_to_delete)
+        failed = []
+        for snap_to_delete in snapshots_to_delete:
+            delete_op, e_del = results.get(snap_to_delete['name'], (None, None))
+            if e_del is not None or delete_op is None:
+                failed.append(snap_to_delete['name'])
+                print(f"  - スナップショット {snap_to_delete['name']} の削除中にエラー: {e_del}", flush=True)
+            else:
+                print(f"  - スナップショット削除API呼び出し成功: {snap_to_delete['name']}, operation: {delete_op.get('name')}", flush=True)
+
+        print(f"削除結果: 成功 {len(snapshots_to_delete) - len(failed)}個 / 失敗 {len(failed)}個", flush=True)
+        trace.set(deleted=len(snapshots_to_delete) - len(failed), failed=len(failed))
+        report["failed"] = failed
+        return _json_response(report, 500 if failed else 200)
 
     except Exception as e:
         print(f"スナップショットクリーンアップ処理中に予期せぬエラー: {e}", flush=True)
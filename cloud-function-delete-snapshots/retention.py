@@ -0,0 +1,195 @@
+# スナップショットの世代管理 (GFS: grandfather-father-son) の計画
+# スナップショットは作成元と種類でグループに分けて、グループごとに保持ルールを当てはめる:
+#   <インスタンス名>-snapshot-YYYYmmdd-HHMMSS  停止前の自動スナップショット (check-players / Bot のアイドル監視)
+#   <インスタンス名>-backup-YYYYmmdd-HHMMSS    /mc_backup による手動バックアップ
+# 保持ルール (RetentionPolicy) は「最新 latest 個」と「直近 hourly 時間・daily 日・weekly 週・monthly か月の
+# 各期間で最も新しい1個」で、どれか1つのルールが残すスナップショットは削除しない。
+# 一覧は作成日時順に並んでいなくてよい。一覧は1回だけ流し、残すかどうかはルールごとに上限つきで持つ
+# 保持候補 (latest + 各期間数 件) だけで決まる (判定のための並べ替えや再取得はしない)。
+# 名前が上の形式に合わないスナップショットは、どのグループにも入れずに残す。
+import heapq
+import re
+from datetime import datetime
+
+SNAPSHOT_NAME = re.compile(r"^(?P<source>.+)-(?P<kind>snapshot|backup)-\d{8}-\d{6}$")
+KINDS = ("snapshot", "backup")
+
+TIERS = ("hourly", "daily", "weekly", "monthly")
+
+
+def _period(tier, moment):
+    if tier == "hourly":
+        return moment.year, moment.month, moment.day, moment.hour
+    if tier == "daily":
+        return moment.year, moment.month, moment.day
+    if tier == "weekly":
+        return tuple(moment.isocalendar())[:2]
+    return moment.year, moment.month
+
+
+class RetentionPolicy:
+    """latest: 新しい順に残す数 / hourly・daily・weekly・monthly: 1個ずつ残す直近の期間数 (0 でそのルールは使わない)"""
+
+    __slots__ = ("latest",) + TIERS
+
+    def __init__(self, latest=0, hourly=0, daily=0, weekly=0, monthly=0):
+        self.latest = latest
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    def __repr__(self):
+        return "RetentionPolicy(" + ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__) + ")"
+
+
+def parse_policy(text):
+    """'latest=7,daily=7,weekly=4,monthly=6' の形式を RetentionPolicy にする。不正なら ValueError"""
+    values = {}
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, value = item.partition("=")
+        name = name.strip()
+        if not sep or name not in RetentionPolicy.__slots__:
+            raise ValueError(f"保持ルールの指定が不正です: {item!r}")
+        count = int(value)
+        if count < 0:
+            raise ValueError(f"保持数は0以上で指定してください: {item!r}")
+        values[name] = count
+    if not any(values.values()):
+        # 誤設定ですべて削除されないように、何も残さないルールは受け付けない
+        raise ValueError(f"1個も残さない保持ルールは指定できません: {text!r}")
+    return RetentionPolicy(**values)
+
+
+class _GroupPlanner:
+    """1グループ分の保持候補。add() で1件ずつ受け取り、最後に reasons() で残すものを返す"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.latest = []  # (作成日時, 名前) の最小ヒープ
+        # ルール -> {期間: (作成日時, 名前)}。直近の期間数を超えたら最も古い期間を捨てる
+        self.tiers = {tier: {} for tier in TIERS if getattr(policy, tier) > 0}
+
+    def add(self, created_at, name, moment):
+        entry = (created_at, name)
+        if self.policy.latest > 0:
+            if len(self.latest) < self.policy.latest:
+                heapq.heappush(self.latest, entry)
+            elif entry > self.latest[0]:
+                heapq.heapreplace(self.latest, entry)
+        for tier, periods in self.tiers.items():
+            period = _period(tier, moment)
+            best = periods.get(period)
+            if best is not None:
+                if entry > best:
+                    periods[period] = entry
+                continue
+            if len(periods) >= getattr(self.policy, tier):
+                oldest = min(periods)
+                if period < oldest:
+                    continue
+                del periods[oldest]
+            periods[period] = entry
+
+    def reasons(self):
+        """{残す名前: [理由のルール名]}"""
+        reasons = {}
+        for _, name in self.latest:
+            reasons.setdefault(name, []).append("latest")
+        for tier, periods in self.tiers.items():
+            for _, name in periods.values():
+                reasons.setdefault(name, []).append(tier)
+        return reasons
+
+
+class RetentionPlan:
+    """plan_retention() の結果
+
+    groups: {(作成元, 種類): {"kept": [...], "delete": [...], "reasons": {名前: [ルール]}}}
+      kept / delete は {"name", "id", "creationTimestamp", "storageBytes"} の新しい順のリスト
+    unmatched: 名前の形式が合わず、判定せずに残したスナップショット
+    """
+
+    def __init__(self, groups, unmatched):
+        self.groups = groups
+        self.unmatched = unmatched
+
+    @property
+    def to_delete(self):
+        return [snapshot for group in self.groups.values() for snapshot in group["delete"]]
+
+    @property
+    def kept(self):
+        return [snapshot for group in self.groups.values() for snapshot in group["kept"]] + self.unmatched
+
+    def report(self):
+        """グループごとの保持数・削除数と storageBytes の合計 (JSON にできる dict)"""
+        groups = []
+        for (source, kind), group in sorted(self.groups.items()):
+            kept = group["kept"]
+            groups.append({
+                "source": source,
+                "kind": kind,
+                "kept": len(kept),
+                "deleted": len(group["delete"]),
+                "kept_bytes": sum(s["storageBytes"] for s in kept),
+                "reclaimed_bytes": sum(s["storageBytes"] for s in group["delete"]),
+                # 戻せる最も古い時点
+                "oldest_kept": kept[-1]["creationTimestamp"].isoformat() if kept else None,
+            })
+        return {
+            "groups": groups,
+            "unmatched": len(self.unmatched),
+            "kept": sum(group["kept"] for group in groups) + len(self.unmatched),
+            "deleted": sum(group["deleted"] for group in groups),
+            "kept_bytes": sum(group["kept_bytes"] for group in groups) + sum(s["storageBytes"] for s in self.unmatched),
+            "reclaimed_bytes": sum(group["reclaimed_bytes"] for group in groups),
+        }
+
+
+def plan_retention(snapshots, policies, tz=None):
+    """スナップショット (一覧APIの項目) を1回流して RetentionPlan を返す
+
+    policies: {種類: RetentionPolicy}。ない種類のスナップショットは削除しない
+    tz: 期間 (日・週・月) の区切りに使うタイムゾーン。None なら作成日時のオフセットのまま
+    """
+    planners = {}
+    records = {}
+    unmatched = []
+    for snapshot in snapshots:
+        try:
+            created_at = datetime.fromisoformat(snapshot['creationTimestamp'])
+        except Exception as e_parse:
+            print(f"スナップショット {snapshot['name']} の作成日時パースエラー: {e_parse}", flush=True)
+            continue
+        record = {
+            'name': snapshot['name'],
+            'id': snapshot.get('id'),
+            'creationTimestamp': created_at,
+            'storageBytes': int(snapshot.get('storageBytes') or 0),
+        }
+        match = SNAPSHOT_NAME.match(snapshot['name'])
+        policy = policies.get(match.group('kind')) if match else None
+        if policy is None:
+            unmatched.append(record)
+            continue
+        key = (match.group('source'), match.group('kind'))
+        planner = planners.get(key)
+        if planner is None:
+            planner = planners[key] = _GroupPlanner(policy)
+        planner.add(created_at, record['name'], created_at.astimezone(tz) if tz else created_at)
+        records.setdefault(key, []).append(record)
+
+    groups = {}
+    for key, planner in planners.items():
+        reasons = planner.reasons()
+        ordered = sorted(records[key], key=lambda r: (r['creationTimestamp'], r['name']), reverse=True)
+        groups[key] = {
+            "kept": [r for r in ordered if r['name'] in reasons],
+            "delete": [r for r in ordered if r['name'] not in reasons],
+            "reasons": reasons,
+        }
+    return RetentionPlan(groups, unmatched)
@@ -0,0 +1,119 @@
+# フリートモード: 複数ゾーンにまたがる複数のMinecraftインスタンスを1回の呼び出しで処理する
+import asyncio
+
+from mc_ping import server_list_ping
+from mc_query import QueryClient, parse_player_count
+
+# aggregatedList で取得するフィールドを必要最小限に絞る
+FLEET_FIELDS = (
+    "items/*/instances(name,zone,status,networkInterfaces/accessConfigs/natIP,disks(boot,source)),"
+    "nextPageToken"
+)
+
+
+def parse_instance_list(value):
+    """GCE_INSTANCES ("name" または "zone/name" のカンマ区切り) を [(zone or None, name)] に変換する"""
+    targets = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "/" in item:
+            zone, name = item.split("/", 1)
+            targets.append((zone.strip(), name.strip()))
+        else:
+            targets.append((None, item))
+    return targets
+
+
+def build_fleet_filter(instance_names=None, label_selector=None):
+    """Compute APIの filter 式を組み立てる。RUNNING のインスタンスのみを対象にする"""
+    clauses = ['(status = "RUNNING")']
+    if label_selector:
+        # "key=value,key2=value2" 形式
+        for pair in label_selector.split(","):
+            key, _, value = pair.partition("=")
+            if key.strip():
+                clauses.append(f'(labels.{key.strip()} = "{value.strip()}")')
+    if instance_names:
+        names = " OR ".join(f'(name = "{name}")' for name in sorted(set(instance_names)))
+        clauses.append(f"({names})")
+    return " AND ".join(clauses)
+
+
+def _instance_summary(zone_key, instance):
+    ip = None
+    for interface in instance.get("networkInterfaces", []):
+        for access_config in interface.get("accessConfigs", []):
+            ip = ip or access_config.get("natIP")
+    boot_disk = None
+    for disk in instance.get("disks", []):
+        if disk.get("boot") and disk.get("source"):
+            boot_disk = disk["source"].split("/")[-1]
+    return {
+        "name": instance["name"],
+        # zone は URL 形式 (.../zones/asia-northeast1-b) なので末尾だけ使う
+        "zone": instance.get("zone", zone_key).split("/")[-1],
+        "status": instance.get("status"),
+        "ip": ip,
+        "boot_disk": boot_disk or instance["name"],
+    }
+
+
+def resolve_fleet(service, project, targets=None, label_selector=None):
+    """aggregatedList 1系統 (ページング込み) で対象インスタンスのIP・ブートディスクをまとめて取得する"""
+    wanted = {}
+    for zone, name in targets or []:
+        wanted.setdefault(name, set()).add(zone)
+    request = service.instances().aggregatedList(
+        project=project,
+        filter=build_fleet_filter(list(wanted), label_selector),
+        fields=FLEET_FIELDS,
+        returnPartialSuccess=True,
+    )
+    instances = []
+    while request is not None:
+        response = request.execute()
+        for zone_key, scoped in response.get("items", {}).items():
+            for instance in scoped.get("instances", []):
+                summary = _instance_summary(zone_key, instance)
+                zones = wanted.get(summary["name"])
+                # ゾーン指定がある場合は一致するものだけ残す
+                if zones is not None and None not in zones and summary["zone"] not in zones:
+                    continue
+                instances.append(summary)
+        request = service.instances().aggregatedList_next(request, response)
+    return instances
+
+
+async def _poll_fleet(instances, port, timeout, ping_port):
+    targets = [(instance["ip"], port) for instance in instances if instance["ip"]]
+    async with QueryClient() as client:
+        results = await client.poll_many(targets, timeout)
+    if ping_port is None:
+        return results, {}
+    # Query に応答しなかったサーバーだけ Server List Ping で並行して問い合わせる
+    failed = [ip for (ip, _), result in results.items() if not isinstance(result, bytes)]
+    pings = await asyncio.gather(
+        *(server_list_ping(ip, ping_port, timeout, ping=False) for ip in failed), return_exceptions=True)
+    return results, dict(zip(failed, pings))
+
+
+def query_fleet(instances, port=25565, timeout=5, ping_port=None):
+    """全インスタンスへ並行してQueryし、各インスタンスに player_count を設定する (失敗時 -1)
+
+    ping_port を指定すると、Query に失敗したインスタンスは Server List Ping で人数を取得する。
+    """
+    results, pings = asyncio.run(_poll_fleet(instances, port, timeout, ping_port))
+    for instance in instances:
+        result = results.get((instance["ip"], port))
+        ping = pings.get(instance["ip"])
+        if isinstance(result, bytes):
+            instance["player_count"] = parse_player_count(result)
+        elif ping is not None and not isinstance(ping, BaseException):
+            instance["player_count"] = ping.stat.numplayers
+            instance["probe"] = "ping"
+        else:
+            instance["player_count"] = -1
+            instance["query_error"] = repr(result) if result is not None else "外部IPなし"
+    return instances
@@ -0,0 +1,159 @@
+# Compute Engine の長時間オペレーション (LRO) の完了待ち
+# - 複数のゾーン/リージョン/グローバルオペレーションをまとめて待つ
+# - 未完了のものはバッチHTTPリクエスト1本で状態確認し、ジッター付き指数バックオフで間隔を空ける
+# - 残り1件で時間に余裕があれば zoneOperations().wait 等のロングポーリングを使う
+# - 全体の期限 (deadline) を超えたら打ち切り、未完了として結果を返す
+#
+# このファイルは cloud-function/ と discord-bot/ に同じ内容で置いている (デプロイ単位が別のため)
+import random
+import time
+
+# wait はサーバー側で最大2分ブロックするため、残り時間がこれより長い場合のみ使う
+LONG_POLL_MAX_SECONDS = 120
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 15.0
+
+
+def operation_scope(operation):
+    """オペレーションのスコープを ("zone", "asia-northeast1-b") / ("region", ...) / ("global", None) で返す"""
+    if operation.get("zone"):
+        return "zone", operation["zone"].split("/")[-1]
+    if operation.get("region"):
+        return "region", operation["region"].split("/")[-1]
+    return "global", None
+
+
+def _operations_api(service, scope):
+    if scope == "zone":
+        return service.zoneOperations()
+    if scope == "region":
+        return service.regionOperations()
+    return service.globalOperations()
+
+
+def _operation_request(service, project, operation, method):
+    scope, location = operation_scope(operation)
+    api = _operations_api(service, scope)
+    kwargs = {"project": project, "operation": operation["name"]}
+    if scope == "zone":
+        kwargs["zone"] = location
+    elif scope == "region":
+        kwargs["region"] = location
+    return getattr(api, method)(**kwargs)
+
+
+def _result(operation, started_at, error=None):
+    done = operation.get("status") == "DONE"
+    if error is None and done and operation.get("error"):
+        error = operation["error"].get("errors") or operation["error"]
+    return {
+        "name": operation.get("name"),
+        "target": operation.get("targetLink", "").split("/")[-1] or None,
+        "operation_type": operation.get("operationType"),
+        "status": operation.get("status"),
+        "done": done,
+        "success": done and error is None,
+        "error": error,
+        "elapsed": time.monotonic() - started_at,
+    }
+
+
+def _batch_get(service, project, operations):
+    """未完了オペレーションの状態を1回のバッチHTTPリクエストで取得する"""
+    responses = {}
+
+    def callback(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for index, operation in enumerate(operations):
+        batch.add(_operation_request(service, project, operation, "get"), request_id=str(index))
+    batch.execute()
+    return [responses.get(str(index), (None, None)) for index in range(len(operations))]
+
+
+def wait_for_operations(service, project, operations, deadline=120.0, sleep=time.sleep):
+    """operations (insert/stop/createSnapshot などが返した dict) の完了を待つ
+
+    戻り値は入力と同じ順序の結果 dict のリスト:
+        {"name", "target", "operation_type", "status", "done", "success", "error", "elapsed"}
+    期限切れの場合は done=False, error="deadline exceeded" となる。
+    """
+    started_at = time.monotonic()
+    end_at = started_at + deadline
+    results = [None] * len(operations)
+    pending = {}
+    for index, operation in enumerate(operations):
+        if operation is None:
+            results[index] = _result({}, started_at, error="operation missing")
+        elif operation.get("status") == "DONE":
+            results[index] = _result(operation, started_at)
+        else:
+            pending[index] = operation
+
+    backoff = INITIAL_BACKOFF
+    while pending:
+        remaining = end_at - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            if len(pending) == 1 and remaining > LONG_POLL_MAX_SECONDS:
+                index, operation = next(iter(pending.items()))
+                responses = {index: (_operation_request(service, project, operation, "wait").execute(), None)}
+            else:
+                indexes = list(pending)
+                fetched = _batch_get(service, project, [pending[i] for i in indexes])
+                responses = dict(zip(indexes, fetched))
+        except Exception as e:
+            # 一時的なAPIエラーはバックオフして再試行する
+            print(f"オペレーション状態の取得でエラー (再試行します): {e}", flush=True)
+            responses = {}
+
+        progressed = False
+        for index, (response, exception) in responses.items():
+            if exception is not None:
+                status = getattr(getattr(exception, "resp", None), "status", None)
+                # 404 などの恒久的なエラーはそのオペレーションの失敗として確定させる
+                if status is not None and int(status) < 500 and int(status) != 429:
+                    results[index] = _result(pending.pop(index), started_at, error=str(exception))
+                continue
+            if response is None:
+                continue
+            pending[index] = response
+            if response.get("status") == "DONE":
+                results[index] = _result(pending.pop(index), started_at)
+                progressed = True
+
+        if not pending:
+            break
+        if progressed:
+            backoff = INITIAL_BACKOFF
+        delay = min(backoff, MAX_BACKOFF, max(end_at - time.monotonic(), 0))
+        # フルジッター: [0.5, 1.0) 倍にばらして複数呼び出し元の同期を避ける
+        sleep(delay * random.uniform(0.5, 1.0))
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+    for index, operation in pending.items():
+        results[index] = _result(operation, started_at, error="deadline exceeded")
+    return results
+
+
+def wait_for_snapshot_capture(service, project, snapshot_name, timeout=60.0, interval=1.0, sleep=time.sleep):
+    """スナップショットが CREATING を抜ける (データの取得が終わり UPLOADING 以降になる) まで待つ
+
+    この時点以降はディスクへの書き込みを再開してもスナップショットの内容に影響しない。
+    戻り値は最後に確認したステータス (期限切れの場合は None)。
+    """
+    end_at = time.monotonic() + timeout
+    while time.monotonic() < end_at:
+        try:
+            status = service.snapshots().get(
+                project=project, snapshot=snapshot_name, fields="status").execute().get("status")
+        except Exception as e:
+            # 作成直後は 404 になることがあるので再試行する
+            print(f"スナップショット状態の取得でエラー (再試行します): {e}", flush=True)
+            status = None
+        if status in ("UPLOADING", "READY", "FAILED"):
+            return status
+        sleep(interval)
+    return None
@@ -1,20 +1,132 @@
 import os
-import socket
-import struct
-from googleapiclient import discovery
-import google.auth
-import requests
-import datetime
-
-gce_zone = os.environ["GCE_ZONE"]
-gce_instance_name = os.environ["GCE_INSTANCE_NAME"]
+import asyncio
+import threading
+import time
+import resource
+
+from mc_ping import server_list_ping
+from mc_query import query_server_stat
+from tracing import Trace
+
+# googleapiclient / google.auth / requests / datetime はコールドスタートを軽くするため
+# 実際に必要になる関数内で遅延importする
+
+# モジュール読み込み時刻 (コールドスタート計測用)
+_MODULE_LOADED_AT = time.monotonic()
+# インスタンス内で何回目の呼び出しか (1回目 = コールドスタート)
+_invocation_count = 0
+# Computeクライアントはウォームスタート間で使い回す
+_compute_service = None
+# Computeクライアントの生成に使う認証情報とディスカバリドキュメント (スレッドごとのクライアントでも共有する)
+_credentials = None
+_compute_document = None
+# フリートの停止処理のワーカー。httplib2 はスレッドセーフではないため、Computeクライアントはスレッドごとに持つ
+_fleet_executor = None
+_thread_local = threading.local()
+# 実行中の呼び出しのトレース (フェーズ別所要時間)
+_trace = Trace("check_players", enabled=False)
+# 実行中の呼び出しの期限 (time.monotonic() 基準)。停止処理の各手順はこの残り時間を分け合う
+_deadline = None
+
+FUNCTION_MEMORY_MB = int(os.environ.get("FUNCTION_MEMORY_MB", 256))
+# Cloud Functions のタイムアウト (秒) と、応答を返すために残しておく余裕
+FUNCTION_TIMEOUT_SECONDS = float(os.environ.get("FUNCTION_TIMEOUT_SECONDS", 60))
+DEADLINE_MARGIN_SECONDS = 5
+
+gce_zone = os.environ.get("GCE_ZONE")
+gce_instance_name = os.environ.get("GCE_INSTANCE_NAME")
+# フリートモード: どちらかが設定されていれば複数インスタンスをまとめて処理する
+# GCE_INSTANCES: "name" または "zone/name" のカンマ区切り
+# GCE_INSTANCE_LABEL: "key=value" 形式のラベルセレクタ (カンマ区切りでAND)
+GCE_INSTANCES = os.environ.get("GCE_INSTANCES")
+GCE_INSTANCE_LABEL = os.environ.get("GCE_INSTANCE_LABEL")
+# 0より大きい場合、スナップショット作成と停止のオペレーション完了をこの秒数まで待つ (通知とは並行)
+OPERATION_WAIT_SECONDS = float(os.environ.get("OPERATION_WAIT_SECONDS", 0))
+# 停止判定のヒステリシス: 連続して0人だった回数、または0人が続いた秒数で判定する
+PLAYER_HISTORY_URI = os.environ.get("PLAYER_HISTORY_URI", "/tmp/player-history")
+IDLE_REQUIRED_ZERO_READINGS = int(os.environ.get("IDLE_REQUIRED_ZERO_READINGS", 2))
+IDLE_WINDOW_SECONDS = int(os.environ.get("IDLE_WINDOW_SECONDS", 0))
+# 直近この秒数 (IDLE_WINDOW_SECONDS が大きければそちら) に以前の読み取りがない履歴は、使えない履歴と同じに扱う
+HISTORY_MAX_AGE_SECONDS = int(os.environ.get("HISTORY_MAX_AGE_SECONDS", 1800))
+# true にすると、前回のスナップショット以降にプレイヤーがいなかったと履歴から言える場合に停止前スナップショットを省略する。
+# 履歴は定期的な人数の読み取りなので、読み取りの間隔が UNCHANGED_MAX_GAP_SECONDS 以内で続いている場合だけ省略する
+# (Cloud Scheduler の15分間隔の読み取りでは省略しない)。既定では省略せず、毎回作成する
+SKIP_UNCHANGED_SNAPSHOT = os.environ.get("SKIP_UNCHANGED_SNAPSHOT", "false").lower() == "true"
+UNCHANGED_MAX_GAP_SECONDS = int(os.environ.get("UNCHANGED_MAX_GAP_SECONDS", 60))
+# 設定されていれば、停止前スナップショットの前にRCONで save-off / save-all flush を行う
+RCON_PASSWORD = os.environ.get("RCON_PASSWORD")
+RCON_PORT = int(os.environ.get("RCON_PORT", 25575))
 project_id = os.environ.get("GCP_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT")
 DISCORD_BOT_WEBHOOK_URL = os.environ.get("DISCORD_BOT_WEBHOOK_URL")
+# Bot との共有シークレット。Bot の Webhook に送るときと、?idle_confirmed=1 を受け付けるときに X-Webhook-Secret ヘッダーで照合する
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_SECRET_HEADER = "X-Webhook-Secret"
+# server.properties の query.port
+MINECRAFT_QUERY_PORT = int(os.environ.get("MINECRAFT_QUERY_PORT", 25565))
+# Server List Ping はゲームポート (TCP) に接続する
+MINECRAFT_GAME_PORT = int(os.environ.get("MINECRAFT_GAME_PORT", 25565))
+# 人数の取得方法と試す順序 (query: UDP Query / ping: Server List Ping)。前の方法が失敗したら次を試す
+PLAYER_PROBES = [name.strip() for name in os.environ.get("PLAYER_PROBES", "query,ping").split(",") if name.strip()]
+# フリートモードで同時に停止処理を行うインスタンス数の上限 (これ以下の台数なら所要時間は台数によらずほぼ一定)
+FLEET_STOP_CONCURRENCY = int(os.environ.get("FLEET_STOP_CONCURRENCY", 20))
+
+def build_compute_service():
+    """Compute APIクライアントを新しく作る
+
+    ライブラリ同梱の静的ディスカバリドキュメントを使い、ネットワーク取得を行わない。
+    ドキュメントの解析結果と認証情報は使い回すので、スレッドごとに作ってもメモリはほとんど増えない。
+    """
+    global _credentials, _compute_document
+    import json
+    import google.auth
+    from googleapiclient import discovery
+    from googleapiclient.discovery_cache import get_static_doc
+    if _credentials is None:
+        _credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/compute'])
+    if _compute_document is None:
+        _compute_document = json.loads(get_static_doc('compute', 'v1'))
+    return discovery.build_from_document(_compute_document, credentials=_credentials)
+
+def get_compute_service():
+    """Compute APIクライアントを遅延生成し、ウォームスタート間で再利用する"""
+    global _compute_service
+    if _compute_service is None:
+        _compute_service = build_compute_service()
+        print("Computeクライアントを初期化しました (静的ディスカバリ)", flush=True)
+    return _compute_service
+
+def get_thread_compute_service():
+    """呼び出し元のスレッド専用の Compute APIクライアント (フリートの停止処理のワーカー用)"""
+    service = getattr(_thread_local, "service", None)
+    if service is None:
+        service = _thread_local.service = build_compute_service()
+    return service
+
+def get_fleet_executor():
+    """フリートの停止処理のスレッドプール。ウォームスタート間で再利用し、スレッドごとのクライアントも残す"""
+    global _fleet_executor
+    if _fleet_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _fleet_executor = ThreadPoolExecutor(max_workers=FLEET_STOP_CONCURRENCY, thread_name_prefix="fleet-stop")
+    return _fleet_executor
+
+def report_invocation_stats(started_at):
+    """コールド/ウォーム別の呼び出しレイテンシとピークRSSを出力する"""
+    elapsed_ms = (time.monotonic() - started_at) * 1000
+    # Linuxでは ru_maxrss はKB単位
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    kind = "cold" if _invocation_count == 1 else "warm"
+    since_load_ms = (time.monotonic() - _MODULE_LOADED_AT) * 1000
+    print(
+        f"起動計測: kind={kind}, invocation={_invocation_count}, latency_ms={elapsed_ms:.1f}, "
+        f"since_module_load_ms={since_load_ms:.1f}, "
+        f"peak_rss_mb={peak_rss_mb:.1f}/{FUNCTION_MEMORY_MB} ({peak_rss_mb / FUNCTION_MEMORY_MB:.0%})",
+        flush=True,
+    )
 
 def get_instance_external_ip(project, zone, instance_name):
     print(f"get_instance_external_ip: project={project}, zone={zone}, instance_name={instance_name}", flush=True)
-    credentials, _ = google.auth.default()
-    service = discovery.build('compute', 'v1', credentials=credentials)
+    service = get_compute_service()
     try:
         instance = service.instances().get(
             project=project,
@@ -33,67 +145,171 @@ def get_instance_external_ip(project, zone, instance_name):
     print("外部IPが取得できませんでした", flush=True)
     return None
 
-# Minecraft Queryプロトコルで人数取得
-def get_player_count(ip, port=25565, timeout=5): # タイムアウトを少し延長 (例: 5秒)
-    print(f"Query開始: ip={ip}, port={port}, timeout={timeout}", flush=True)
+def load_player_history(instance_name):
+    """(store, records) を返す。履歴ストアが使えない場合は (None, None)"""
+    import player_history
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(timeout)
-        # handshake
-        print("handshake送信試行", flush=True)
-        # セッションIDは固定でOK (例: 0x01020304)
-        # Pythonのint.to_bytes()を使う場合、バイトオーダーと符号に注意
-        # ここではシンプルに固定バイト列を使用
-        session_id_bytes = b"\x01\x02\x03\x04"
-        handshake_payload = b"\xfe\xfd\x09" + session_id_bytes
-        s.sendto(handshake_payload, (ip, port))
-        print(f"handshake送信済み: {handshake_payload.hex()}", flush=True)
-        data_handshake, addr_handshake = s.recvfrom(2048)
-        print(f"handshake応答受信 from {addr_handshake}: {data_handshake}", flush=True)
-
-        # チャレンジトークンを抽出
-        # 応答の最初の1バイトはタイプ (0x09)
-        # 次の4バイトがセッションID (エコーバック)
-        # その後がNULL終端のチャレンジトークン文字列
-        if data_handshake[0] != 0x09 or data_handshake[1:5] != session_id_bytes:
-            print(f"handshake応答のタイプまたはセッションIDが不正です。type={data_handshake[0]}, session_id={data_handshake[1:5].hex()}", flush=True)
-            return -1
-        
-        challenge_token_str = data_handshake[5:data_handshake.find(b'\x00', 5)].decode('ascii')
-        challenge_token_int = int(challenge_token_str)
-        # チャレンジトークンはネットワークバイトオーダー (ビッグエンディアン) の符号付き32ビット整数として送信
-        challenge_token_bytes = struct.pack('>i', challenge_token_int)
-        print(f"抽出したチャレンジトークン: str='{challenge_token_str}', int={challenge_token_int}, bytes={challenge_token_bytes.hex()}", flush=True)
-
-        # stat
-        print("stat送信試行", flush=True)
-        # 基本statリクエスト: タイプ0x00, セッションID, チャレンジトークン
-        # Full statリクエストにするには、チャレンジトークンの後にペイロード (4バイトのNULLなど) を追加
-        stat_payload = b"\xfe\xfd\x00" + session_id_bytes + challenge_token_bytes + b"\x00\x00\x00\x00" # Full stat
-        s.sendto(stat_payload, (ip, port))
-        print(f"stat送信済み (トークン使用): {stat_payload.hex()}", flush=True)
-        data_stat, addr_stat = s.recvfrom(4096) # 応答データが大きくなる可能性があるのでバッファを増やす
-        print(f"stat応答受信 from {addr_stat}: {data_stat}", flush=True)
-        
-        if b'numplayers' in data_stat:
-            parts = data_stat.split(b'\x00')
-            try:
-                idx = parts.index(b'numplayers')
-                player_count = int(parts[idx+1])
-                print(f"プレイヤー数抽出成功: {player_count}", flush=True)
-                return player_count
-            except (ValueError, IndexError) as e:
-                print(f"プレイヤー数抽出失敗: {e}, parts: {parts}", flush=True)
-        else:
-            print("stat応答にnumplayersが含まれていません", flush=True)
-            
-    except socket.timeout:
-        print(f"Query失敗: socket.timeout ({timeout}秒)", flush=True)
+        store = player_history.open_store(PLAYER_HISTORY_URI, instance_name)
+        return store, player_history.decode(store.read())
     except Exception as e:
-        print(f"Query失敗: {type(e).__name__} - {e}", flush=True)
+        print(f"プレイヤー数履歴の読み込みに失敗 ({instance_name}): {e}", flush=True)
+        return None, None
+
+def evaluate_idle(records, count):
+    """今回の読み取りを含めて (停止するか, スナップショットを作るか) を判定する"""
+    import player_history
+    if count != 0:
+        return False, False
+    now = int(time.time())
+    if records is None or not player_history.has_recent_reading(
+            records, max(IDLE_WINDOW_SECONDS, HISTORY_MAX_AGE_SECONDS), now):
+        # 履歴が使えない場合や、コールドスタートで一時ディレクトリの履歴が失われた場合などで
+        # 以前の読み取りが残っていなければ、従来通り1回の0人で停止する
+        return True, True
+    current = records + [(now, count, 0)]
+    stop = player_history.should_stop(current, IDLE_REQUIRED_ZERO_READINGS, IDLE_WINDOW_SECONDS)
+    take_snapshot = not SKIP_UNCHANGED_SNAPSHOT or player_history.changed_since_last_snapshot(current, UNCHANGED_MAX_GAP_SECONDS)
+    return stop, take_snapshot
+
+def idle_confirmed(request):
+    """Bot が VM の起動エージェントの報告で0人の継続を確認済みとして呼び出した (?idle_confirmed=1) なら True
+
+    Function は誰でも呼び出せるため、WEBHOOK_SECRET が設定されていればヘッダーのシークレットが一致する場合だけ認める。
+    """
+    import hmac
+    args = getattr(request, "args", None)
+    if args is None or args.get("idle_confirmed") != "1":
+        return False
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get(WEBHOOK_SECRET_HEADER, "").encode(), WEBHOOK_SECRET.encode()):
+        print("idle_confirmed のシークレットが一致しないため無視します。", flush=True)
+        return False
+    return True
+
+def record_player_count(store, count, stopped=False, snapshot=False):
+    import player_history
+    if store is None:
+        return
+    flags = (player_history.FLAG_STOPPED if stopped else 0) | (player_history.FLAG_SNAPSHOT if snapshot else 0)
+    try:
+        store.append(player_history.encode(count, flags))
+    except Exception as e:
+        print(f"プレイヤー数履歴の保存に失敗: {e}", flush=True)
+
+def create_snapshot_with_flush(ip, snapshot_name, create_snapshot, capture_timeout=60, service=None):
+    """RCONでワールドを書き出した状態で create_snapshot() を呼び、データ取得完了後に自動保存を戻す
+
+    RCONが未設定・接続できない場合はそのまま create_snapshot() を呼ぶ。
+    データ取得完了は最大 capture_timeout 秒まで、service (既定は共有のクライアント) で確認する。
+    """
+    if not RCON_PASSWORD:
+        return create_snapshot()
+    from rcon import RconClient, save_flushed
+    from gce_operations import wait_for_snapshot_capture
+
+    created = {}
+
+    async def run():
+        async with RconClient(ip, RCON_PORT, RCON_PASSWORD) as rcon:
+            async with save_flushed(rcon):
+                print("RCONでワールドを書き出しました (save-off / save-all flush)", flush=True)
+                created['op'] = await asyncio.to_thread(create_snapshot)
+                # createSnapshot の targetLink は元ディスクなので、スナップショット名で状態を見る
+                status = await asyncio.to_thread(
+                    wait_for_snapshot_capture, service or get_compute_service(), project_id, snapshot_name, capture_timeout)
+                print(f"スナップショットのデータ取得完了 (status={status})", flush=True)
+        return created['op']
+
+    try:
+        return asyncio.run(run())
+    except Exception as e:
+        if 'op' in created:
+            # スナップショット作成後の save-on などの失敗。スナップショット自体は作成済み
+            print(f"スナップショット作成後のRCON処理でエラー: {e}", flush=True)
+            return created['op']
+        from rcon import RconError
+        if isinstance(e, (RconError, OSError, asyncio.TimeoutError)):
+            print(f"RCONによるワールド保存に失敗したため、そのままスナップショットを作成します: {e}", flush=True)
+            return create_snapshot()
+        raise
+
+def notify_vm_stopped(instance_name, zone, timeout=10):
+    """Discord BotのWebhookへVM停止を通知する"""
+    if not DISCORD_BOT_WEBHOOK_URL:
+        print("DISCORD_BOT_WEBHOOK_URLが未設定のため、通知はスキップされました。", flush=True)
+        return False
+    import requests
+    print(f"Discord Bot Webhook ({DISCORD_BOT_WEBHOOK_URL}) に通知を試みます。", flush=True)
+    try:
+        response = requests.post(
+            DISCORD_BOT_WEBHOOK_URL,
+            json={"instance": instance_name, "zone": zone},
+            headers={WEBHOOK_SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else None,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        print(f"Discord Bot Webhookへの通知成功。ステータス: {response.status_code}", flush=True)
+        return True
+    except requests.exceptions.RequestException as e:
+        print(f"Discord Bot Webhookへの通知失敗: {e}", flush=True)
+        return False
+
+def probe_query(ip, port, timeout):
+    """Minecraft Queryプロトコルで ServerStat を取得する (mc_query.QueryClient の薄いラッパー)"""
+    # handshakeとstatを合わせて timeout 秒で打ち切る。
+    # asyncio.run ごとにイベントループが変わりソケットを持ち越せないため、毎回 handshake から行う
+    # (チャレンジトークンのキャッシュが効くのは Bot の長寿命な query_client のみ)
+    return asyncio.run(query_server_stat(ip, port or MINECRAFT_QUERY_PORT, timeout))
+
+def probe_ping(ip, port, timeout):
+    """Server List Ping で ServerStat を取得する"""
+    result = asyncio.run(server_list_ping(ip, MINECRAFT_GAME_PORT, timeout))
+    print(f"Server List Ping: status {result.elapsed * 1000:.1f}ms / ping {result.latency * 1000:.1f}ms", flush=True)
+    return result.stat
+
+PROBES = {"query": probe_query, "ping": probe_ping}
+
+# PLAYER_PROBES の順に人数を取得し、最初に成功したものを使う
+def get_player_count(ip, port=None, timeout=5):
+    for name in PLAYER_PROBES:
+        probe = PROBES.get(name)
+        if probe is None:
+            print(f"不明な取得方法です: {name}", flush=True)
+            continue
+        print(f"{name}開始: ip={ip}, timeout={timeout}", flush=True)
+        try:
+            stat = probe(ip, port, timeout)
+        except asyncio.TimeoutError:
+            print(f"{name}失敗: タイムアウト ({timeout}秒)", flush=True)
+            continue
+        except Exception as e:
+            print(f"{name}失敗: {type(e).__name__} - {e}", flush=True)
+            continue
+        if stat.numplayers < 0:
+            print(f"{name}の応答からプレイヤー数を取得できませんでした", flush=True)
+            continue
+        print(f"プレイヤー数抽出成功 ({name}): {stat.numplayers}/{stat.maxplayers} {list(stat.players)} (version={stat.version})", flush=True)
+        _trace.set(probe=name)
+        return stat.numplayers
     return -1
 
 def main(request):
+    global _invocation_count, _trace, _deadline
+    _invocation_count += 1
+    started_at = time.monotonic()
+    _deadline = started_at + FUNCTION_TIMEOUT_SECONDS - DEADLINE_MARGIN_SECONDS
+    _trace = Trace("check_players")
+    _trace.set(cold_start=_invocation_count == 1)
+    response = ("Unhandled error\n", 500)
+    try:
+        response = _main(request)
+        return response
+    finally:
+        outcome = _trace.fields.pop("outcome", None) or ("error" if response[1] >= 500 else "ok")
+        _trace.emit(outcome, status=response[1])
+        report_invocation_stats(started_at)
+
+def _main(request):
     print("main関数開始", flush=True)
     if not project_id:
         print("エラー: 環境変数 GCP_PROJECT が設定されていません。", flush=True)
@@ -102,67 +318,209 @@ def main(request):
     if not DISCORD_BOT_WEBHOOK_URL:
         print("警告: 環境変数 DISCORD_BOT_WEBHOOK_URL が設定されていません。VM停止通知は送信されません。", flush=True)
 
-    ip = get_instance_external_ip(project_id, gce_zone, gce_instance_name)
+    if GCE_INSTANCES or GCE_INSTANCE_LABEL:
+        return fleet_main()
+
+    if not gce_zone or not gce_instance_name:
+        print("エラー: 環境変数 GCE_ZONE / GCE_INSTANCE_NAME が設定されていません。", flush=True)
+        return "Configuration error: GCE_ZONE or GCE_INSTANCE_NAME not set\n", 500
+
+    _trace.set(instance=gce_instance_name, zone=gce_zone)
+    with _trace.phase("ip_lookup"):
+        ip = get_instance_external_ip(project_id, gce_zone, gce_instance_name)
     if not ip:
+        _trace.set(outcome="no_ip")
         return "No external IP found or API error\n", 500
 
-    count = get_player_count(ip)
+    with _trace.phase("query"):
+        count = get_player_count(ip)
     print(f"最終的なプレイヤー数: {count}", flush=True)
+    _trace.set(player_count=count)
 
-    if count == 0:
-        print("プレイヤー数0のため、インスタンス停止処理を開始します。", flush=True)
-        try:
-            credentials, _ = google.auth.default()
-            service = discovery.build('compute', 'v1', credentials=credentials)
-
-            # --- スナップショット作成処理 --- 
-            snapshot_name = f"{gce_instance_name}-snapshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
-            print(f"VM停止前にスナップショットを作成します: {snapshot_name}", flush=True)
-            try:
-                snapshot_body = {
-                    'name': snapshot_name,
-                    'description': f'Automatic snapshot for {gce_instance_name} before shutdown on {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}'
-                }
-                # VMインスタンスの最初のディスク (通常はブートディスク) を対象とする
-                # より堅牢にするには、インスタンス情報からディスク名を正確に取得する
-                # ここではインスタンス名と同じ名前のディスクを想定 (一般的なTerraform構成)
-                snapshot_op = service.disks().createSnapshot(
-                    project=project_id,
-                    zone=gce_zone, # スナップショットはゾーンディスクから作成
-                    disk=gce_instance_name, # インスタンス名と同じディスク名と仮定
-                    body=snapshot_body
-                ).execute()
-                print(f"スナップショット作成API呼び出し成功: {snapshot_op}", flush=True)
-                # スナップショット完了を待つ場合はここでポーリング処理が必要だが、今回は呼び出しのみ
-            except Exception as e_snap:
-                print(f"スナップショット作成中にエラー: {e_snap}", flush=True)
-            # --- スナップショット作成処理ここまで ---
-
-            stop_op = service.instances().stop(
-                project=project_id,
-                zone=gce_zone,
-                instance=gce_instance_name
-            ).execute()
-            print(f"インスタンス停止API呼び出し成功: {stop_op}", flush=True)
-
-            if DISCORD_BOT_WEBHOOK_URL:
-                print(f"Discord Bot Webhook ({DISCORD_BOT_WEBHOOK_URL}) に通知を試みます。", flush=True)
-                try:
-                    response = requests.post(DISCORD_BOT_WEBHOOK_URL, timeout=10)
-                    response.raise_for_status()
-                    print(f"Discord Bot Webhookへの通知成功。ステータス: {response.status_code}", flush=True)
-                except requests.exceptions.RequestException as e:
-                    print(f"Discord Bot Webhookへの通知失敗: {e}", flush=True)
-            else:
-                print("DISCORD_BOT_WEBHOOK_URLが未設定のため、通知はスキップされました。", flush=True)
+    with _trace.phase("history_load"):
+        store, records = load_player_history(gce_instance_name)
+    stop, take_snapshot = evaluate_idle(records, count)
+    if count == 0 and not stop and idle_confirmed(request):
+        # 0人の継続は Bot 側で確認済みなので、Query でも0人なら連続読み取りを待たずに停止する
+        print("Botから0人の継続が報告されているため、停止条件を満たしたものとして扱います。", flush=True)
+        _trace.set(idle_confirmed=True)
+        stop = True
+    if not stop:
+        with _trace.phase("history_save"):
+            record_player_count(store, count)
+        if count == 0:
+            print(f"プレイヤー数0ですが、停止条件 (連続{IDLE_REQUIRED_ZERO_READINGS}回 / {IDLE_WINDOW_SECONDS}秒) を満たしていないため待機します。", flush=True)
+            _trace.set(outcome="idle_pending")
+            return f"Player count: {count} (waiting for idle confirmation)\n", 200
 
+    if stop:
+        print("プレイヤー数0が続いたため、インスタンス停止処理を開始します。", flush=True)
+        try:
+            service = get_compute_service()
+            # ここではインスタンス名と同じ名前のディスクをブートディスクと想定 (一般的なTerraform構成)
+            instance = {"name": gce_instance_name, "zone": gce_zone, "ip": ip, "boot_disk": gce_instance_name}
+            results = run_stop_pipeline(service, instance, store, count, take_snapshot, trace=_trace)
         except Exception as e:
             print(f"インスタンス停止処理またはWebhook通知中にエラー: {e}", flush=True)
             return f"Player count: {count}, but failed during stop process or notification.\n", 500
+        summary = " ".join(f"{name}={result.status}" for name, result in results.items())
+        if not results["stop"].ok:
+            print(f"インスタンス停止に失敗しました: {results['stop'].error}", flush=True)
+            return f"Player count: {count}, but failed during stop process ({summary}).\n", 500
+        operation_results = results.get("operation_wait")
+        if operation_results is not None and operation_results.ok and not operation_results.value[-1]['success']:
+            print(f"インスタンス停止オペレーションが完了しませんでした: {operation_results.value[-1]['error']}", flush=True)
+            return f"Player count: {count}, but stop operation did not complete ({summary}).\n", 500
+        _trace.set(outcome="stopped")
+        print("main関数終了", flush=True)
+        return f"Player count: {count} ({summary})\n", 200
 
-    elif count == -1:
+    if count == -1:
         print("プレイヤー数取得失敗のため、インスタンスは停止しません。", flush=True)
+        _trace.set(outcome="query_failed")
         return f"Player count: {count} (Query failed)\n", 200
 
     print("main関数終了", flush=True)
-    return f"Player count: {count}\n", 200 
\ No newline at end of file
+    _trace.set(outcome="active")
+    return f"Player count: {count}\n", 200 
+
+def run_stop_pipeline(service, instance, store, count, take_snapshot, deadline=None, trace=None):
+    """スナップショット → 停止 → (通知 / 履歴保存 / 完了待ち) を依存関係に沿って並行実行する
+
+    instance は {"name", "zone", "ip", "boot_disk"}。通知・履歴保存・オペレーション完了待ちは互いに独立なので、
+    停止APIの受付後に同時に始める。各手順には deadline (既定は呼び出しの期限) までの残り時間の一部を割り当て、
+    {手順名: StepResult} を返す。
+    """
+    import datetime
+    from pipeline import Step, run_pipeline
+    name, zone = instance["name"], instance["zone"]
+    ops = {}
+
+    def snapshot(budget):
+        if not take_snapshot:
+            print(f"{name}: 前回のスナップショット以降にプレイヤーが観測されていないため、スナップショット作成を省略します。", flush=True)
+            return None
+        now = datetime.datetime.now()
+        snapshot_name = f"{name}-snapshot-{now.strftime('%Y%m%d-%H%M%S')}"
+        print(f"VM停止前にスナップショットを作成します: {snapshot_name}", flush=True)
+        snapshot_body = {
+            'name': snapshot_name,
+            'description': f'Automatic snapshot for {name} before shutdown on {now.strftime("%Y-%m-%d %H:%M:%S")}'
+        }
+        ops['snapshot'] = create_snapshot_with_flush(instance["ip"], snapshot_name, lambda: service.disks().createSnapshot(
+            project=project_id,
+            zone=zone, # スナップショットはゾーンディスクから作成
+            disk=instance["boot_disk"],
+            body=snapshot_body
+        ).execute(), capture_timeout=budget, service=service)
+        print(f"スナップショット作成API呼び出し成功: {ops['snapshot']}", flush=True)
+        return ops['snapshot']
+
+    def stop(budget):
+        ops['stop'] = service.instances().stop(
+            project=project_id,
+            zone=zone,
+            instance=name
+        ).execute()
+        print(f"インスタンス停止API呼び出し成功: {ops['stop']}", flush=True)
+        return ops['stop']
+
+    def history_save(budget):
+        record_player_count(store, count, stopped=True, snapshot='snapshot' in ops)
+
+    def webhook(budget):
+        return notify_vm_stopped(name, zone, timeout=min(10, budget))
+
+    def operation_wait(budget):
+        from gce_operations import wait_for_operations
+        operations = [op for op in (ops.get('snapshot'), ops.get('stop')) if op]
+        return wait_for_operations(service, project_id, operations, deadline=min(OPERATION_WAIT_SECONDS, budget))
+
+    steps = [
+        Step("snapshot", snapshot, share=0.5),
+        # スナップショットに失敗しても停止はする
+        Step("stop", stop, deps=("snapshot",), require_success=False, share=0.5),
+        Step("history_save", history_save, deps=("stop",), share=0.2),
+        Step("webhook", webhook, deps=("stop",), share=0.5),
+    ]
+    if OPERATION_WAIT_SECONDS > 0:
+        steps.append(Step("operation_wait", operation_wait, deps=("stop",), share=1.0))
+    if deadline is None:
+        deadline = _deadline if _deadline is not None else time.monotonic() + FUNCTION_TIMEOUT_SECONDS
+    results = run_pipeline(steps, deadline, trace=trace)
+    for step_name, result in results.items():
+        print(f"停止処理 {name} {step_name}: {result.status} ({result.elapsed:.2f}s / 割り当て {result.budget:.1f}s) error={result.error}", flush=True)
+    if trace is not None:
+        trace.set(snapshot='snapshot' in ops, steps={step_name: result.as_dict() for step_name, result in results.items()})
+    if results.get("operation_wait") is not None and results["operation_wait"].ok:
+        for result in results["operation_wait"].value:
+            print(
+                f"オペレーション結果: {result['operation_type']} {result['target']} "
+                f"status={result['status']} success={result['success']} error={result['error']} "
+                f"elapsed={result['elapsed']:.1f}s",
+                flush=True,
+            )
+    return results
+
+def fleet_main():
+    """フリートモード: 対象インスタンスをまとめて解決・並行Queryし、アイドルなものだけ停止する"""
+    import fleet
+    targets = fleet.parse_instance_list(GCE_INSTANCES) if GCE_INSTANCES else None
+    print(f"フリートモード開始: instances={targets}, label={GCE_INSTANCE_LABEL}", flush=True)
+    _trace.set(mode="fleet")
+    service = get_compute_service()
+    try:
+        with _trace.phase("ip_lookup"):
+            instances = fleet.resolve_fleet(service, project_id, targets, GCE_INSTANCE_LABEL)
+    except Exception as e:
+        print(f"フリートのインスタンス一覧取得でAPIエラー: {e}", flush=True)
+        return "Failed to resolve fleet instances\n", 500
+    print(f"対象インスタンス (RUNNING): {[i['name'] for i in instances]}", flush=True)
+
+    with _trace.phase("query"):
+        fleet.query_fleet(instances, port=MINECRAFT_QUERY_PORT,
+                          ping_port=MINECRAFT_GAME_PORT if "ping" in PLAYER_PROBES else None)
+    for instance in instances:
+        print(f"  {instance['zone']}/{instance['name']}: ip={instance['ip']}, players={instance['player_count']}", flush=True)
+
+    idle = []
+    for instance in instances:
+        with _trace.phase("history_load"):
+            store, records = load_player_history(instance["name"])
+        stop, instance["take_snapshot"] = evaluate_idle(records, instance["player_count"])
+        instance["history_store"] = store
+        if stop:
+            idle.append(instance)
+        else:
+            record_player_count(store, instance["player_count"])
+    failed = False
+    if idle:
+        print(f"プレイヤー数0が続いたインスタンスを停止します: {[i['name'] for i in idle]}", flush=True)
+
+        def stop_instance(instance):
+            # 各インスタンスの停止処理はワーカースレッド専用のクライアントで、呼び出しの残り時間をすべて使って行う
+            # (RCONでの書き出し・データ取得の完了待ちが台数に応じて短くならないようにする)
+            return run_stop_pipeline(get_thread_compute_service(), instance, instance["history_store"], 0,
+                                     instance["take_snapshot"], deadline=_deadline)
+
+        steps = {}
+        with _trace.phase("stop_pipeline"):
+            executor = get_fleet_executor()
+            futures = [(instance, executor.submit(stop_instance, instance)) for instance in idle]
+            for instance, future in futures:
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"  {instance['name']}: 停止処理中にエラー: {e}", flush=True)
+                    failed = True
+                    continue
+                steps[instance["name"]] = {name: result.status for name, result in results.items()}
+                if not results["stop"].ok:
+                    print(f"  {instance['name']}: インスタンス停止に失敗しました: {results['stop'].error}", flush=True)
+                    failed = True
+        _trace.set(steps=steps)
+
+    _trace.set(instances=len(instances), stopped=[i["name"] for i in idle])
+    summary = ", ".join(f"{i['name']}={i['player_count']}" for i in instances) or "none"
+    print("fleet_main終了", flush=True)
+    return f"Player counts: {summary}\n", 500 if failed else 200
@@ -0,0 +1,133 @@
+# 依存関係つきの小さな実行パイプライン
+# 停止処理 (スナップショット → 停止 → 通知 / 履歴保存 / 完了待ち) のうち、互いに依存しない手順を
+# スレッドで並行に実行し、各手順に呼び出し全体の期限 (deadline) の一部を割り当てる。
+#
+#   steps = [
+#       Step("snapshot", take_snapshot, share=0.5),
+#       Step("stop", stop_instance, deps=("snapshot",), require_success=False),
+#       Step("webhook", notify, deps=("stop",)),
+#   ]
+#   results = run_pipeline(steps, deadline=time.monotonic() + 50)
+#
+# 手順の関数は割り当て秒数 (budget) を引数に受け取り、その範囲でタイムアウトを設定する。
+# 割り当てを超えても戻らない手順は timeout として結果を確定し、それに依存する手順は skipped になる
+# (スレッドは止められないため、関数側で budget を守ることが前提)。
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+OK = "ok"
+FAILED = "failed"
+TIMEOUT = "timeout"
+SKIPPED = "skipped"
+
+
+class Step:
+    """パイプラインの1手順
+
+    deps: 先に終わっている必要がある手順名
+    share: 開始時点の残り時間のうち、この手順に割り当てる割合
+    require_success: False なら依存先が失敗・スキップしても実行する (例: スナップショット失敗でも停止はする)
+    """
+
+    def __init__(self, name, func, deps=(), share=1.0, require_success=True):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.share = share
+        self.require_success = require_success
+
+
+class StepResult:
+    __slots__ = ("status", "value", "error", "elapsed", "budget")
+
+    def __init__(self, status, value=None, error=None, elapsed=0.0, budget=0.0):
+        self.status = status
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+        self.budget = budget
+
+    @property
+    def ok(self):
+        return self.status == OK
+
+    def as_dict(self):
+        """構造化ログ用 (value は含めない)"""
+        return {
+            "status": self.status,
+            "elapsed_ms": round(self.elapsed * 1000, 1),
+            "budget_ms": round(self.budget * 1000, 1),
+            "error": None if self.error is None else str(self.error),
+        }
+
+    def __repr__(self):
+        return f"StepResult({self.status}, error={self.error!r}, elapsed={self.elapsed:.2f}s)"
+
+
+def _run_step(step, budget, trace):
+    started_at = time.monotonic()
+    try:
+        if trace is not None:
+            with trace.phase(step.name):
+                value = step.func(budget)
+        else:
+            value = step.func(budget)
+        return StepResult(OK, value=value, elapsed=time.monotonic() - started_at, budget=budget)
+    except Exception as e:
+        return StepResult(FAILED, error=e, elapsed=time.monotonic() - started_at, budget=budget)
+
+
+def run_pipeline(steps, deadline, trace=None, max_workers=4):
+    """steps を依存関係に従って実行し、{手順名: StepResult} を steps と同じ順序で返す
+
+    deadline は time.monotonic() 基準の絶対時刻。trace (tracing.Trace) を渡すと手順ごとのフェーズ時間を記録する。
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        unknown = set(step.deps) - names
+        if unknown:
+            raise ValueError(f"{step.name}: 未定義の依存先 {sorted(unknown)}")
+    results = {}
+    waiting = list(steps)
+    running = {}  # future -> (step, 開始時刻, 割り当て秒数)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+    try:
+        while waiting or running:
+            now = time.monotonic()
+            for step in list(waiting):
+                dep_results = [results.get(dep) for dep in step.deps]
+                if any(result is None for result in dep_results):
+                    continue
+                waiting.remove(step)
+                failed_deps = [dep for dep, result in zip(step.deps, dep_results) if not result.ok]
+                remaining = deadline - now
+                if failed_deps and step.require_success:
+                    results[step.name] = StepResult(SKIPPED, error=f"依存先が未完了: {', '.join(failed_deps)}")
+                elif remaining <= 0:
+                    results[step.name] = StepResult(SKIPPED, error="deadline exceeded")
+                else:
+                    budget = remaining * min(max(step.share, 0.0), 1.0)
+                    future = executor.submit(_run_step, step, budget, trace)
+                    running[future] = (step, now, budget)
+            if not running:
+                if waiting:
+                    # 依存先が決まらないまま残った手順 (循環依存)
+                    for step in waiting:
+                        results[step.name] = StepResult(SKIPPED, error="循環依存")
+                    waiting.clear()
+                continue
+            next_expiry = min(started_at + budget for _, started_at, budget in running.values())
+            done, _ = wait(running, timeout=max(0.0, next_expiry - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)[0]
+                results[step.name] = future.result()
+            now = time.monotonic()
+            for future, (step, started_at, budget) in list(running.items()):
+                if started_at + budget <= now and not future.done():
+                    running.pop(future)
+                    results[step.name] = StepResult(
+                        TIMEOUT, error=f"割り当て {budget:.1f}秒 を超過", elapsed=now - started_at, budget=budget)
+    finally:
+        # 期限切れで置き去りにした手順の終了は待たない
+        executor.shutdown(wait=False)
+    return {step.name: results[step.name] for step in steps}
@@ -0,0 +1,136 @@
+# プレイヤー数の履歴 (呼び出しをまたいで保持する追記型の記録) と、停止判定のヒステリシス
+#
+# 1レコード8バイト: unix時刻(uint32) + プレイヤー数(int16, 取得失敗は-1) + フラグ(uint16)
+# 保存先は PLAYER_HISTORY_URI で指定する:
+#   gs://bucket/prefix  → Cloud Storage (google-cloud-storage)
+#   それ以外のパス      → ローカルファイル (Cloud Functions の /tmp はウォームスタート間のみ保持される)
+import os
+import struct
+import time
+
+RECORD = struct.Struct(">IhH")
+FLAG_SNAPSHOT = 0x0001  # この時点で停止前スナップショットを作成した
+FLAG_STOPPED = 0x0002   # この時点でインスタンスを停止した
+
+# 履歴として保持する最大レコード数 (5分間隔で約3.5日分)
+MAX_RECORDS = 1024
+
+
+class FileHistoryStore:
+    """ローカルファイルに追記する履歴ストア (開発用・Cloud Functions の /tmp 用)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    def append(self, record):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(record)
+        # 上限を大きく超えたら古いレコードを切り詰める
+        if os.path.getsize(self.path) > RECORD.size * MAX_RECORDS * 2:
+            data = self.read()[-RECORD.size * MAX_RECORDS:]
+            with open(self.path, "wb") as f:
+                f.write(data)
+
+
+class GcsHistoryStore:
+    """Cloud Storage のオブジェクトに保存する履歴ストア
+
+    GCS のオブジェクトは追記できないため、世代番号の事前条件付きで読み込み→追記→書き戻しを行う。
+    """
+
+    def __init__(self, bucket_name, blob_name):
+        from google.cloud import storage
+        self._blob = storage.Client().bucket(bucket_name).blob(blob_name)
+        self._generation = 0
+
+    def read(self):
+        from google.api_core.exceptions import NotFound
+        try:
+            data = self._blob.download_as_bytes()
+            self._generation = self._blob.generation
+            return data
+        except NotFound:
+            self._generation = 0
+            return b""
+
+    def append(self, record):
+        data = (self.read() + record)[-RECORD.size * MAX_RECORDS:]
+        # 他の呼び出しと競合した場合は PreconditionFailed になる (その回の記録は諦める)
+        self._blob.upload_from_string(
+            data, content_type="application/octet-stream", if_generation_match=self._generation)
+
+
+def open_store(uri, instance_name):
+    """PLAYER_HISTORY_URI とインスタンス名から履歴ストアを作る"""
+    if uri.startswith("gs://"):
+        bucket_name, _, prefix = uri[len("gs://"):].partition("/")
+        blob_name = f"{prefix.rstrip('/')}/{instance_name}.bin" if prefix else f"{instance_name}.bin"
+        return GcsHistoryStore(bucket_name, blob_name)
+    return FileHistoryStore(os.path.join(uri, f"{instance_name}.bin"))
+
+
+def encode(player_count, flags=0, timestamp=None):
+    count = max(min(player_count, 32767), -1)
+    return RECORD.pack(int(timestamp if timestamp is not None else time.time()), count, flags)
+
+
+def decode(data):
+    """[(timestamp, player_count, flags)] を古い順で返す (末尾の中途半端なバイトは無視)"""
+    usable = len(data) - len(data) % RECORD.size
+    return list(RECORD.iter_unpack(data[:usable]))
+
+
+def has_recent_reading(records, max_age, now=None):
+    """直近 max_age 秒以内の読み取りが履歴にあるか"""
+    now = now if now is not None else time.time()
+    return bool(records) and now - records[-1][0] <= max_age
+
+
+def should_stop(records, required_zero_readings=2, idle_window=0, now=None):
+    """最新の読み取りから遡って、停止してよいかを判定する
+
+    - 直近 required_zero_readings 回の読み取りがすべて 0 であること
+    - idle_window > 0 の場合は、さらに直近 idle_window 秒間の読み取りがすべて 0 で、
+      その期間をカバーするだけ古い 0 の読み取りがあること
+    取得失敗 (-1) や停止記録を挟んだ場合は連続とみなさない。
+    """
+    now = now if now is not None else time.time()
+    streak = 0
+    streak_started_at = None
+    for timestamp, count, flags in reversed(records):
+        if count != 0 or flags & FLAG_STOPPED:
+            break
+        streak += 1
+        streak_started_at = timestamp
+    if streak == 0 or streak < required_zero_readings:
+        return False
+    if idle_window > 0:
+        return now - streak_started_at >= idle_window
+    return True
+
+
+def changed_since_last_snapshot(records, max_gap):
+    """前回の停止前スナップショット以降にプレイヤーがいた可能性があるか
+
+    スナップショットの記録から最新の読み取りまで、max_gap 秒を超える間隔を空けずにすべて0人と読み取れている
+    場合だけ False を返す。読み取りの間の短いセッションは履歴に残らないため、間隔が空いている場合・
+    取得失敗 (-1) を挟む場合・スナップショットの記録が履歴に残っていない場合は、判断できないので True を返す。
+    """
+    later = None
+    for timestamp, count, flags in reversed(records):
+        if later is not None and later - timestamp > max_gap:
+            return True
+        if flags & FLAG_SNAPSHOT:
+            return False
+        if count != 0:
+            return True
+        later = timestamp
+    return True
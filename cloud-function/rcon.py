@@ -0,0 +1,136 @@
+# Minecraft RCON (TCP) の asyncio クライアント
+# - 認証済みの接続を保持して使い回す (切断されていれば1回だけ再接続する)
+# - リクエストIDで応答を対応付け、複数パケットに分割された応答を連結する
+# - スナップショット前後の save-off / save-all flush / save-on をまとめた save_flushed() を提供する
+#
+# このファイルは cloud-function/ と discord-bot/ に同じ内容で置いている (デプロイ単位が別のため)
+import asyncio
+import contextlib
+import itertools
+import struct
+
+TYPE_RESPONSE = 0
+TYPE_COMMAND = 2
+TYPE_AUTH = 3
+# 応答の終端確認用。サーバーは未知のタイプに同じIDで "Unknown request" を返す
+TYPE_END_MARKER = 200
+
+_HEADER = struct.Struct("<iii")  # length, request_id, type
+
+
+class RconError(Exception):
+    """RCONの認証失敗・プロトコル違反の例外"""
+
+
+class RconClient:
+    """使い方:
+        async with RconClient(host, 25575, password) as rcon:
+            print(await rcon.command("list"))
+    """
+
+    def __init__(self, host, port=25575, password="", timeout=5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        # 1本の接続上ではコマンドを直列に実行する
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        if self.connected:
+            return
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        request_id = next(self._ids)
+        await self._send(request_id, TYPE_AUTH, self.password)
+        # 認証応答の前に空の RESPONSE_VALUE が届く実装もあるため、AUTH_RESPONSE(2) まで読み進める
+        while True:
+            response_id, packet_type, _ = await self._read_packet()
+            if packet_type == TYPE_COMMAND:
+                break
+        if response_id == -1:
+            await self.close()
+            raise RconError("RCONの認証に失敗しました (パスワードを確認してください)")
+        if response_id != request_id:
+            await self.close()
+            raise RconError(f"RCON認証応答のIDが一致しません: {response_id} != {request_id}")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            with contextlib.suppress(Exception):
+                await self._writer.wait_closed()
+        self._reader = self._writer = None
+
+    async def _send(self, request_id, packet_type, payload):
+        body = payload.encode("utf-8") + b"\x00\x00"
+        self._writer.write(_HEADER.pack(len(body) + 8, request_id, packet_type) + body)
+        await self._writer.drain()
+
+    async def _read_packet(self):
+        header = await asyncio.wait_for(self._reader.readexactly(4), self.timeout)
+        (length,) = struct.unpack("<i", header)
+        if length < 10:
+            raise RconError(f"RCONパケット長が不正です: {length}")
+        body = await asyncio.wait_for(self._reader.readexactly(length), self.timeout)
+        request_id, packet_type = struct.unpack_from("<ii", body)
+        return request_id, packet_type, body[8:-2]
+
+    async def _command(self, command):
+        request_id = next(self._ids)
+        end_id = next(self._ids)
+        await self._send(request_id, TYPE_COMMAND, command)
+        # 長い応答は複数パケットに分割されるため、終端確認用パケットの応答が来るまで連結する。
+        # 終端確認用パケットをコマンドと続けて送ると1つのTCPセグメントにまとまり、バニラのサーバーが
+        # 読み損ねることがあるので、最初の応答パケットを受け取ってから送る
+        chunks = []
+        while True:
+            response_id, _, payload = await self._read_packet()
+            if response_id == end_id:
+                break
+            if response_id == request_id:
+                if not chunks:
+                    await self._send(end_id, TYPE_END_MARKER, "")
+                chunks.append(payload)
+        return b"".join(chunks).decode("utf-8", "replace")
+
+    async def command(self, command):
+        """コマンドを実行して応答文字列を返す。接続が切れていれば1回だけ再接続して再送する"""
+        async with self._lock:
+            for attempt in (1, 2):
+                try:
+                    await self.connect()
+                    return await self._command(command)
+                except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+                    await self.close()
+                    if attempt == 2:
+                        raise
+
+
+@contextlib.asynccontextmanager
+async def save_flushed(rcon):
+    """ワールドの自動保存を止めてディスクへ書き出し、ブロックを抜けたら自動保存を再開する
+
+    async with save_flushed(rcon):
+        ... (createSnapshot を呼び、スナップショットが取得されるまで待つ)
+    """
+    await rcon.command("save-off")
+    try:
+        await rcon.command("save-all flush")
+        yield
+    finally:
+        await rcon.command("save-on")
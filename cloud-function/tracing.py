@@ -0,0 +1,84 @@
+# 呼び出しごとのフェーズ別所要時間を計測し、1件の構造化ログ (JSON 1行) として出力する
+# TRACE_ENABLED=false の場合、phase() は共有の何もしないコンテキストを返すので計測コストはほぼゼロ
+#
+# このファイルは cloud-function/ と cloud-function-delete-snapshots/ に同じ内容で置いている (デプロイ単位が別のため)
+import json
+import os
+import time
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "true").lower() == "true"
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ("trace", "name", "started_at")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.started_at) * 1000
+        # 同じフェーズを複数回通った場合は合計する
+        self.trace.phases[self.name] = self.trace.phases.get(self.name, 0.0) + elapsed_ms
+        if exc_type is not None:
+            self.trace.fields.setdefault("failed_phase", self.name)
+        return False
+
+
+class Trace:
+    """使い方:
+        trace = Trace("check_players")
+        with trace.phase("query"):
+            ...
+        trace.emit("stopped", player_count=0)
+    """
+
+    def __init__(self, name, enabled=None):
+        self.name = name
+        self.enabled = TRACE_ENABLED if enabled is None else enabled
+        self.phases = {}
+        self.fields = {}
+        self.started_at = time.perf_counter()
+        self.emitted = False
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def set(self, **fields):
+        if self.enabled:
+            self.fields.update(fields)
+
+    def emit(self, outcome, **fields):
+        """構造化ログを1行出力する (Cloud Logging では jsonPayload として取り込まれる)"""
+        if not self.enabled or self.emitted:
+            return None
+        self.emitted = True
+        self.fields.update(fields)
+        record = {
+            "severity": "ERROR" if outcome == "error" else "INFO",
+            "message": f"trace {self.name} outcome={outcome}",
+            "trace": self.name,
+            "outcome": outcome,
+            "duration_ms": round((time.perf_counter() - self.started_at) * 1000, 1),
+            "phases_ms": {name: round(elapsed, 1) for name, elapsed in self.phases.items()},
+        }
+        record.update(self.fields)
+        print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+        return record
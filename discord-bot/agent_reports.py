@@ -0,0 +1,129 @@
+# VM の起動エージェント (vm-agent/boot_agent.py) から届くプレイヤー数報告の保持と、0人継続の判定
+# エージェントはプレイヤー数が変わるたびと、変化がなくても一定間隔 (heartbeat) で報告を送ってくる。
+# 0人の報告が idle_grace 秒続いたインスタンスを idle_due() で返し、Bot が停止判定の Cloud Function を呼び出す
+# (Function 側でも Query で0人を確認してから停止する)。
+# 報告が stale_seconds 以上途絶えたインスタンスは判定しない (定期実行の Cloud Function に任せる)。
+# ワールドのバックアップ結果 (backup) も同じ Webhook に届くが、プレイヤー数の判定には使わない。
+
+DEFAULT_IDLE_GRACE = 600.0
+# エージェントの heartbeat (300秒) を2回取りこぼしたら途絶とみなす
+DEFAULT_STALE_SECONDS = 660.0
+
+EVENTS = ("boot", "players", "heartbeat", "exit", "backup")
+
+
+def parse_report(payload):
+    """Webhook の JSON を検証して報告の dict を返す。不正なら ValueError"""
+    if not isinstance(payload, dict):
+        raise ValueError("JSONオブジェクトではありません")
+    event = payload.get("event")
+    if event not in EVENTS:
+        raise ValueError(f"不明なイベント: {event!r}")
+    instance = payload.get("instance")
+    if not instance:
+        raise ValueError("instance がありません")
+    count = payload.get("count", 0)
+    if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+        raise ValueError(f"count が不正です: {count!r}")
+    players = payload.get("players") or []
+    if not isinstance(players, list):
+        raise ValueError("players がリストではありません")
+    phases = payload.get("phases") or {}
+    if not isinstance(phases, dict):
+        raise ValueError("phases がオブジェクトではありません")
+    report = {
+        "instance": str(instance),
+        "zone": str(payload.get("zone") or ""),
+        "event": event,
+        "count": count,
+        "players": [str(name) for name in players],
+        "phases": {str(name): float(seconds) for name, seconds in phases.items()},
+    }
+    # tick の計測 (heartbeat) と起動時のマシン情報 (boot) は任意
+    for name in ("mspt", "mspt_max"):
+        value = payload.get(name)
+        if value is not None:
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"{name} が不正です: {value!r}")
+            report[name] = float(value)
+    if payload.get("machine_type"):
+        report["machine_type"] = str(payload["machine_type"])
+    if payload.get("heap_mb") is not None:
+        report["heap_mb"] = int(payload["heap_mb"])
+    if event == "backup":
+        if not payload.get("request"):
+            raise ValueError("request がありません")
+        stats = payload.get("stats") or {}
+        if not isinstance(stats, dict):
+            raise ValueError("stats がオブジェクトではありません")
+        report.update(
+            request=str(payload["request"]),
+            ok=bool(payload.get("ok")),
+            backup_id=str(payload.get("backup_id") or ""),
+            flushed=bool(payload.get("flushed")),
+            error=str(payload.get("error") or ""),
+            stats=stats,
+        )
+    return report
+
+
+class AgentReports:
+    def __init__(self, idle_grace=DEFAULT_IDLE_GRACE, stale_seconds=DEFAULT_STALE_SECONDS):
+        self._idle_grace = idle_grace
+        self._stale_seconds = stale_seconds
+        # (zone, instance) -> {"count", "players", "event", "received_at", "zero_since", "triggered"}
+        self._reports = {}
+
+    @staticmethod
+    def key(report):
+        return report["zone"], report["instance"]
+
+    def record(self, report, now):
+        """報告を反映し、プレイヤー数が前回から変わったら True"""
+        key = self.key(report)
+        previous = self._reports.get(key)
+        if report["event"] == "backup":
+            return False
+        if report["event"] == "exit":
+            # サーバーが終了した (VM停止・クラッシュ)。停止判定の対象から外す
+            self._reports.pop(key, None)
+            return previous is not None and previous["count"] != 0
+        zero_since = None
+        triggered = False
+        if report["count"] == 0:
+            if previous is not None and previous["zero_since"] is not None:
+                zero_since = previous["zero_since"]
+                triggered = previous["triggered"]
+            else:
+                zero_since = now
+        self._reports[key] = {
+            "count": report["count"],
+            "players": report["players"],
+            "event": report["event"],
+            "received_at": now,
+            "zero_since": zero_since,
+            "triggered": triggered,
+        }
+        return previous is None or previous["count"] != report["count"]
+
+    def get(self, zone, instance, now=None):
+        """最新の報告。途絶している場合は None"""
+        state = self._reports.get((zone, instance))
+        if state is None or (now is not None and now - state["received_at"] > self._stale_seconds):
+            return None
+        return state
+
+    def idle_due(self, now):
+        """0人が idle_grace 秒以上続き、まだ停止判定を依頼していない (zone, instance) のリスト"""
+        return [
+            key for key, state in self._reports.items()
+            if state["zero_since"] is not None and not state["triggered"]
+            and now - state["zero_since"] >= self._idle_grace
+            and now - state["received_at"] <= self._stale_seconds
+        ]
+
+    def mark_triggered(self, key, success):
+        """停止判定を依頼した。失敗した場合は次の判定でもう一度依頼する"""
+        state = self._reports.get(key)
+        if state is not None and success:
+            state["triggered"] = True
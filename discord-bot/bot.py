@@ -1,14 +1,37 @@
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 from discord.ui import Button, View
 import os
 import google.auth
-from googleapiclient import discovery
 import asyncio
-from flask import Flask, request, abort
-import threading
+from aiohttp import web, ClientError, ClientSession, ClientTimeout
 import datetime
 
+import collections
+import contextlib
+import functools
+import hmac
+import json
+import time
+
+import metrics
+
+from gce_operations import wait_for_operations, wait_for_snapshot_capture
+from rcon import RconClient, save_flushed
+from gcp_client import ComputeClient
+from mc_query import QueryClient, parse_full_stat
+from mc_ping import server_list_ping
+from latency import RttWindow, format_rtt_report, percentile
+from loop_monitor import LoopMonitor
+from readiness import wait_until_playable, record_boot, STAGE_RUNNING, STAGE_IP, STAGE_PLAYABLE
+from webhook_dispatch import StopEventDispatcher, QUEUED, DUPLICATE
+from dashboard import Dashboard, render_dashboard, DASHBOARD_FOOTER
+import prewarm
+from agent_reports import AgentReports, parse_report
+import sizing
+import idle_monitor as idle
+
 # 設定ファイルの読み込み
 try:
     import config
@@ -16,9 +39,6 @@ except ImportError:
     print("エラー: config.py が見つかりません。discord-bot/config.sample.py をコピーして config.py を作成し、必要な情報を設定してください。")
     exit()
 
-# --- Flask App Setup ---
-flask_app = Flask(__name__)
-
 # --- グローバル変数・初期設定 ---
 GCP_PROJECT_ID = config.GCP_PROJECT_ID
 GCP_ZONE = config.GCP_ZONE
@@ -45,9 +65,125 @@ intents.message_content = True # メッセージ内容の取得を有効にす
 
 bot = commands.Bot(command_prefix="!mc ", intents=intents) # スラッシュコマンドの場合は prefix はあまり意味をなさない
 
-# GCP Compute Engine APIサービスクライアントを初期化
+# --- メトリクス (/metrics で Prometheus 形式で公開) ---
+COMMAND_SECONDS = metrics.Histogram(
+    "mcbot_command_duration_seconds", "スラッシュコマンド・ボタン処理の所要時間", ("command", "outcome"))
+GCP_CALL_SECONDS = metrics.Histogram(
+    "mcbot_gcp_call_duration_seconds", "Compute API呼び出しの所要時間", ("method", "outcome"))
+QUERY_RTT_SECONDS = metrics.Histogram(
+    "mcbot_query_rtt_seconds", "Minecraft Query (handshake+stat) の往復時間", ("outcome",))
+PING_RTT_SECONDS = metrics.Histogram(
+    "mcbot_ping_rtt_seconds", "Server List Ping の ping/pong 往復時間", ("outcome",))
+WEBHOOK_TOTAL = metrics.Counter("mcbot_webhook_total", "受信したWebhookの数", ("outcome",))
+NOTIFICATION_TOTAL = metrics.Counter(
+    "mcbot_stop_notification_total", "まとめて送信したVM停止通知メッセージの数", ("outcome",))
+DASHBOARD_EDITS_TOTAL = metrics.Counter(
+    "mcbot_dashboard_edits_total", "ダッシュボードメッセージの送信・編集の数", ("outcome",))
+PREWARM_TOTAL = metrics.Counter("mcbot_prewarm_total", "予測プリウォームの結果", ("outcome",))
+PREWARM_SAVED_SECONDS = metrics.Histogram(
+    "mcbot_prewarm_saved_seconds", "プリウォームが当たったときに省けた待ち時間", ())
+AGENT_REPORTS_TOTAL = metrics.Counter("mcbot_agent_reports_total", "VMの起動エージェントからの報告の数", ("event",))
+IDLE_MONITOR_TOTAL = metrics.Counter("mcbot_idle_monitor_total", "アイドル監視の観測結果", ("action",))
+BOOT_PHASE_SECONDS = metrics.Histogram(
+    "mcbot_vm_boot_phase_seconds", "VMの起動エージェントが計測した起動段階ごとの所要時間", ("phase",),
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+NOTIFICATION_EVENTS = metrics.Histogram(
+    "mcbot_stop_notification_events", "1通の停止通知にまとめたイベント数", (), buckets=(1, 2, 5, 10, 20, 50, 100))
+SERVER_MSPT = metrics.Histogram(
+    "mcbot_server_mspt", "VMの起動エージェントが tick query で測った1tickの平均処理時間 (ミリ秒)", ("machine_type",),
+    buckets=(1, 2, 5, 10, 20, 30, 40, 50, 75, 100, 200))
+LOOP_LAG_SECONDS = metrics.Histogram(
+    "mcbot_event_loop_lag_seconds", "イベントループの遅延 (サンプラーが予定より遅れて起きた秒数)", (),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+LOOP_STALLS_TOTAL = metrics.Counter(
+    "mcbot_event_loop_stalls_total", "イベントループが LOOP_STALL_THRESHOLD 秒以上止まった回数", ("handler",))
+
+def observe_gcp_call(method, elapsed, error):
+    GCP_CALL_SECONDS.observe(elapsed, method, "error" if error else "ok")
+
+# --- イベントループの監視 ---
+# ループが LOOP_STALL_THRESHOLD 秒以上止まったら、止めている処理のスタックを構造化ログに出す。
+# コマンド・ボタンの処理が SLOW_HANDLER_SECONDS 以上かかった場合も、ループが止まっていた秒数と
+# インタラクションの作成から処理開始までの待ち時間を付けて構造化ログに出す (/mc_perf でも確認できる)
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.25))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', 0.5))
+# Discord はインタラクションへの最初の応答 (defer を含む) を3秒以内に求める
+SLOW_HANDLER_SECONDS = float(os.getenv('SLOW_HANDLER_SECONDS', 3))
+loop_lag_window = RttWindow(window_seconds=600)
+handler_windows = collections.defaultdict(RttWindow)  # 処理の名前 -> 直近1時間の所要時間
+
+def log_event(severity, message, **fields):
+    """構造化ログを1行出力する (Cloud Logging では jsonPayload として取り込まれる)"""
+    print(json.dumps({"severity": severity, "message": message, **fields}, ensure_ascii=False, default=str), flush=True)
+
+def observe_loop_lag(lag):
+    LOOP_LAG_SECONDS.observe(lag)
+    loop_lag_window.add(lag)
+
+def observe_loop_stall(stall):
+    for handler in stall.handlers or ("-",):
+        LOOP_STALLS_TOTAL.inc(handler)
+    log_event("WARNING", f"イベントループが {stall.duration:.2f}秒止まりました: {stall.innermost()}",
+              event="loop_stall", duration_ms=round(stall.duration * 1000, 1),
+              handlers=list(stall.handlers), stack="".join(stall.stack))
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD, on_lag=observe_loop_lag, on_stall=observe_loop_stall)
+
+def instrumented(name):
+    """コマンド/ボタンのコールバックの所要時間と結果を記録するデコレータ"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            interaction = next((arg for arg in args if isinstance(arg, discord.Interaction)), None)
+            # インタラクションの作成から処理を始めるまでの秒数 (ループが詰まっていると伸びる)
+            queued = (discord.utils.utcnow() - interaction.created_at).total_seconds() if interaction else None
+            outcome = "error"
+            tracked = {"blocked": 0.0}
+            try:
+                with loop_monitor.track(name) as tracked:
+                    result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                elapsed = time.perf_counter() - started_at
+                COMMAND_SECONDS.observe(elapsed, name, outcome)
+                handler_windows[name].add(elapsed)
+                if elapsed >= SLOW_HANDLER_SECONDS:
+                    log_event("WARNING", f"{name} の処理に {elapsed:.2f}秒かかりました",
+                              event="slow_handler", handler=name, outcome=outcome,
+                              duration_ms=round(elapsed * 1000, 1),
+                              blocked_ms=round(tracked["blocked"] * 1000, 1),
+                              queued_ms=None if queued is None else round(queued * 1000, 1))
+        return wrapper
+    return decorator
+
+# GCP Compute Engine APIクライアントを初期化
+# API呼び出しは専用スレッドプールで実行し、イベントループをブロックしない
 credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/compute'])
-compute_service = discovery.build('compute', 'v1', credentials=credentials)
+compute = ComputeClient(credentials, max_workers=int(os.getenv('GCP_MAX_WORKERS', 4)), observer=observe_gcp_call)
+
+# スナップショット作成の完了待ち上限 (秒)。インタラクションのトークン有効期限 (15分) より短くする
+SNAPSHOT_WAIT_DEADLINE = 600
+
+# Minecraft Query クライアント (Botのイベントループ上で1つのUDPソケットを使い回す)
+MINECRAFT_PORT = int(os.getenv('MINECRAFT_PORT', 25565))
+query_client = QueryClient()
+# Server List Ping はゲームポート (TCP) に接続する。Query が無効・遮断されていても人数を取得できる
+MINECRAFT_GAME_PORT = int(os.getenv('MINECRAFT_GAME_PORT', 25565))
+# 人数の取得方法と試す順序 (query: UDP Query / ping: Server List Ping)。前の方法が失敗したら次を試す
+PLAYER_PROBES = [name.strip() for name in os.getenv('PLAYER_PROBES', 'query,ping').split(',') if name.strip()]
+# /mc_status に表示する直近の往復時間
+rtt_windows = {"query": RttWindow(), "ping": RttWindow()}
+
+# RCON (設定されていれば、スナップショット前に save-off / save-all flush してライブでも整合性を保つ)
+RCON_PASSWORD = getattr(config, 'RCON_PASSWORD', None) or os.getenv('RCON_PASSWORD', '')
+RCON_PORT = int(getattr(config, 'RCON_PORT', None) or os.getenv('RCON_PORT', 25575))
+_rcon_client = None
+
+# 起動後にプレイ可能になるまで待つ上限 (秒) と、起動計測の保存先 (未設定なら標準出力のみ)
+STARTUP_READY_TIMEOUT = int(os.getenv('STARTUP_READY_TIMEOUT', 600))
+BOOT_HISTORY_PATH = os.getenv('BOOT_HISTORY_PATH')
 
 # --- Discord UI (Buttons) ---
 class ServerControlView(View):
@@ -55,8 +191,10 @@ class ServerControlView(View):
         super().__init__(timeout=timeout)
 
     @discord.ui.button(label="Minecraftサーバーを起動", style=discord.ButtonStyle.success, custom_id="start_minecraft_server_button")
+    @instrumented("button:start_server")
     async def start_server_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer() # 応答に時間がかかる可能性があるため
+        note_activity()
         current_status = await get_instance_status()
         if current_status == "RUNNING":
             await interaction.followup.send("サーバーは既に起動しています。", ephemeral=True)
@@ -64,16 +202,11 @@ class ServerControlView(View):
             await interaction.followup.send("サーバーを起動中です...完了まで数分かかることがあります。", ephemeral=True)
             success = await start_instance()
             if success:
-                # 起動完了 & IP通知ロジック (後で実装)
-                await asyncio.sleep(15) # 仮の待機時間
-                ip_address = await get_instance_external_ip()
-                if ip_address:
-                    message = f"サーバーが起動しました！ IPアドレス:\n```{ip_address}```"
-                else:
-                    message = "サーバーの起動処理は開始されましたが、IPアドレスの取得に失敗しました。少し待ってから `/mc_status` で確認してください。"
-                # ボタンを無効化するか、メッセージを更新する
+                # ボタンを無効化し、起動の進捗に合わせて元のメッセージを編集する
                 self.disable_all_items()
-                await interaction.edit_original_response(content=message, view=self) # 元のメッセージを編集
+                async def edit(content):
+                    await interaction.edit_original_response(content=content, view=self)
+                await announce_startup(edit)
             else:
                 await interaction.followup.send("サーバーの起動に失敗しました。エラーログを確認してください。", ephemeral=True)
         else:
@@ -85,51 +218,134 @@ class ServerControlView(View):
             if isinstance(item, (discord.ui.Button, discord.ui.Select)):
                 item.disabled = True
 
+# --- インスタンス状態キャッシュ ---
+# ステータス・外部IP・ブートディスクは1回の instances().get (fieldsで絞り込み) でまとめて取得し、
+# 短いTTLでキャッシュする。同じキーへの同時リクエストは1本の取得に合流させる。
+INSTANCE_CACHE_TTL = float(os.getenv('INSTANCE_CACHE_TTL', 5))
+INSTANCE_FIELDS = "status,machineType,lastStartTimestamp,networkInterfaces/accessConfigs/natIP,disks(boot,source)"
+
+class InstanceStateCache:
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {} # key -> (expires_at, value)
+        self._inflight = {} # key -> asyncio.Future
+        self._generation = 0 # invalidate() のたびに増やし、古い取得結果を保存しないようにする
+
+    async def get(self, key, fetch):
+        loop = asyncio.get_running_loop()
+        entry = self._entries.get(key)
+        if entry and entry[0] > loop.time():
+            return entry[1]
+        future = self._inflight.get(key)
+        if future is None:
+            future = loop.create_future()
+            self._inflight[key] = future
+            generation = self._generation
+            try:
+                value = await fetch()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # 待っている呼び出し元がいなくても "never retrieved" 警告を出さない
+                future.exception()
+                raise
+            else:
+                if generation == self._generation:
+                    self._entries[key] = (loop.time() + self._ttl, value)
+                future.set_result(value)
+                return value
+            finally:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+        return await asyncio.shield(future)
+
+    def invalidate(self, key=None):
+        self._generation += 1
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+
+instance_cache = InstanceStateCache(INSTANCE_CACHE_TTL)
+INSTANCE_KEY = (GCP_PROJECT_ID, GCP_ZONE, GCP_INSTANCE_NAME)
+
+def _summarize_instance(response):
+    ip = None
+    interfaces = response.get('networkInterfaces', [])
+    if interfaces:
+        access_configs = interfaces[0].get('accessConfigs', [])
+        if access_configs:
+            ip = access_configs[0].get('natIP')
+    boot_disk = None
+    boot_disk_info = next((disk for disk in response.get('disks', []) if disk.get('boot')), None)
+    if boot_disk_info and boot_disk_info.get('source'):
+        # 'source' は 'projects/PROJECT_ID/zones/ZONE/disks/DISK_NAME' の形式
+        boot_disk = boot_disk_info['source'].split('/')[-1]
+    return {'status': response.get('status'), 'ip': ip, 'boot_disk': boot_disk,
+            'machine_type': (response.get('machineType') or '').split('/')[-1] or None,
+            'started_at': response.get('lastStartTimestamp')}
+
+async def get_instance_state():
+    """インスタンスの status / ip / boot_disk をキャッシュ経由で取得する"""
+    async def fetch():
+        response = await compute.execute(lambda s: s.instances().get(
+            project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME, fields=INSTANCE_FIELDS))
+        return _summarize_instance(response)
+    return await instance_cache.get(INSTANCE_KEY, fetch)
+
 # --- ヘルパー関数 (GCP操作) ---
 async def get_instance_status():
     """GCEインスタンスの現在のステータスを取得する"""
     try:
-        request = compute_service.instances().get(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME)
-        response = request.execute()
-        return response.get('status') # 例: RUNNING, TERMINATED
+        return (await get_instance_state())['status'] # 例: RUNNING, TERMINATED
     except Exception as e:
         print(f"インスタンスの状態取得中にエラー: {e}")
         return None
 
-async def start_instance():
-    """GCEインスタンスを起動する"""
+async def start_instance(resize=True):
+    """GCEインスタンスを起動する
+
+    resize=True なら、起動前に記録から推定した見込み人数に合わせてマシンタイプを変える (MACHINE_SIZING_ENABLED のとき)
+    """
+    if resize:
+        await apply_machine_size()
     try:
-        request = compute_service.instances().start(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME)
-        response = request.execute()
+        response = await compute.execute(
+            lambda s: s.instances().start(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME))
         print(f"インスタンス起動APIレスポンス: {response}")
-        # 起動完了まで待機するロジックをここに追加することも可能 (ポーリングなど)
+        # 次の停止Webhookを重複扱いせずに通知する
+        stop_dispatcher.forget(GCP_ZONE, GCP_INSTANCE_NAME)
+        dashboard.poke()
+        resume_idle_monitor()
         return True
     except Exception as e:
         print(f"インスタンス起動中にエラー: {e}")
         return False
+    finally:
+        instance_cache.invalidate(INSTANCE_KEY)
 
 async def stop_instance(): # 今回は自動停止がメインだが、手動停止用として
     """GCEインスタンスを停止する"""
     try:
-        request = compute_service.instances().stop(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME)
-        response = request.execute()
+        response = await compute.execute(
+            lambda s: s.instances().stop(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME))
         print(f"インスタンス停止APIレスポンス: {response}")
+        dashboard.poke()
         return True
     except Exception as e:
         print(f"インスタンス停止中にエラー: {e}")
         return False
+    finally:
+        instance_cache.invalidate(INSTANCE_KEY)
 
 async def get_instance_external_ip():
     """GCEインスタンスの外部IPアドレスを取得する"""
     try:
-        request = compute_service.instances().get(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME)
-        response = request.execute()
-        interfaces = response.get('networkInterfaces', [])
-        if interfaces:
-            access_configs = interfaces[0].get('accessConfigs', [])
-            if access_configs:
-                return access_configs[0].get('natIP')
-        return None
+        return (await get_instance_state())['ip']
     except Exception as e:
         print(f"外部IPアドレスの取得中にエラー: {e}")
         return None
@@ -137,23 +353,55 @@ async def get_instance_external_ip():
 async def get_boot_disk_name():
     """GCEインスタンスのブートディスク名を取得する"""
     try:
-        instance_details = compute_service.instances().get(project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME).execute()
-        disks = instance_details.get('disks', [])
-        if disks:
-            boot_disk_info = next((disk for disk in disks if disk.get('boot')), None)
-            if boot_disk_info:
-                # 'source' は 'projects/PROJECT_ID/zones/ZONE/disks/DISK_NAME' の形式
-                source_disk_url = boot_disk_info.get('source')
-                if source_disk_url:
-                    return source_disk_url.split('/')[-1]
-        print("ブートディスクが見つかりませんでした。")
-        return None
+        boot_disk = (await get_instance_state())['boot_disk']
+        if not boot_disk:
+            print("ブートディスクが見つかりませんでした。")
+        return boot_disk
     except Exception as e:
         print(f"ブートディスク名の取得中にエラー: {e}")
         return None
 
-async def create_gce_snapshot(disk_name: str, snapshot_name_prefix: str):
-    """GCEディスクのスナップショットを作成する"""
+async def wait_for_gce_operations(operations, deadline):
+    """Computeオペレーションの完了をイベントループを止めずに待つ"""
+    return await compute.run(wait_for_operations, GCP_PROJECT_ID, operations, deadline)
+
+def get_rcon_client(ip):
+    """認証済み接続を使い回すRCONクライアントを返す (IPが変わったら作り直す)。未設定なら None"""
+    global _rcon_client
+    if not RCON_PASSWORD or not ip:
+        return None
+    if _rcon_client is None or _rcon_client.host != ip:
+        _rcon_client = RconClient(ip, RCON_PORT, RCON_PASSWORD)
+    return _rcon_client
+
+@contextlib.asynccontextmanager
+async def world_flushed(ip):
+    """RCONが使えればワールドを書き出して自動保存を止めた状態にする。使えなければ何もしない"""
+    rcon = get_rcon_client(ip)
+    if rcon is None:
+        yield False
+        return
+    try:
+        flushed = save_flushed(rcon)
+        await flushed.__aenter__()
+    except Exception as e:
+        print(f"RCONによるワールド保存に失敗したため、そのままスナップショットを作成します: {e}")
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try:
+            await flushed.__aexit__(None, None, None)
+        except Exception as e:
+            print(f"RCONで save-on に失敗しました。手動で自動保存を再開してください: {e}")
+
+async def create_gce_snapshot(disk_name: str, snapshot_name_prefix: str, wait: bool = False, flush_ip: str = None):
+    """GCEディスクのスナップショットを作成する
+
+    wait=True の場合は完了まで待つ。flush_ip を渡すと、RCONでワールドを書き出してから取得し、
+    スナップショットのデータ取得が終わった時点で自動保存を再開する。
+    """
     try:
         # スナップショット名に日時を付加して一意にする
         timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -170,74 +418,639 @@ async def create_gce_snapshot(disk_name: str, snapshot_name_prefix: str):
         
         print(f"スナップショット作成リクエスト: disk='{disk_name}', name='{snapshot_name}'")
         
-        request = compute_service.disks().createSnapshot(
-            project=GCP_PROJECT_ID,
-            zone=GCP_ZONE, # ゾーンディスクを想定
-            disk=disk_name,
-            body=snapshot_body
-        )
-        operation = request.execute()
-        print(f"スナップショット作成オペレーション開始: {operation}")
+        async with world_flushed(flush_ip) as flushed:
+            operation = await compute.execute(lambda s: s.disks().createSnapshot(
+                project=GCP_PROJECT_ID,
+                zone=GCP_ZONE, # ゾーンディスクを想定
+                disk=disk_name,
+                body=snapshot_body
+            ))
+            print(f"スナップショット作成オペレーション開始: {operation}")
+            if flushed:
+                # データの取得 (CREATING) が終わるまで書き込みを止めておく
+                status = await compute.run(wait_for_snapshot_capture, GCP_PROJECT_ID, snapshot_name)
+                print(f"スナップショットのデータ取得完了 (status={status})。自動保存を再開します。")
+        instance_cache.invalidate(INSTANCE_KEY)
         
-        # オペレーションの完了を待機 (同期的に待つ場合は下記のようなループが必要)
-        # self_link = operation.get('selfLink')
-        # while True:
-        #     op_request = compute_service.zoneOperations().get(project=GCP_PROJECT_ID, zone=GCP_ZONE, operation=operation['name'])
-        #     op_response = op_request.execute()
-        #     if op_response['status'] == 'DONE':
-        #         if 'error' in op_response:
-        #             raise Exception(f"スナップショット作成オペレーションエラー: {op_response['error']}")
-        #         print(f"スナップショット '{snapshot_name}' が正常に作成されました。")
-        #         break
-        #     await asyncio.sleep(5) # 5秒待機して再確認
-            
+        if wait:
+            result = (await wait_for_gce_operations([operation], SNAPSHOT_WAIT_DEADLINE))[0]
+            print(f"スナップショット作成オペレーション結果: {result}")
+            if not result['success']:
+                return False, snapshot_name, f"スナップショット作成オペレーションエラー: {result['error']}"
+            print(f"スナップショット '{snapshot_name}' が正常に作成されました。")
+
         return True, snapshot_name, None # 成功、スナップショット名、エラーなし
     except Exception as e:
         error_message = f"スナップショット作成中にエラー: {e}"
         print(error_message)
         return False, None, str(e) # 失敗、スナップショット名なし、エラーメッセージ
 
+# --- 起動完了待ち ---
+async def timed_full_stat(ip, timeout):
+    """Full stat を取得し、往復時間をメトリクスに記録する"""
+    started_at = time.perf_counter()
+    try:
+        data = await query_client.full_stat(ip, MINECRAFT_PORT, timeout=timeout)
+    except Exception:
+        QUERY_RTT_SECONDS.observe(time.perf_counter() - started_at, "error")
+        raise
+    elapsed = time.perf_counter() - started_at
+    QUERY_RTT_SECONDS.observe(elapsed, "ok")
+    rtt_windows["query"].add(elapsed)
+    return data
+
+async def timed_ping(ip, timeout):
+    """Server List Ping で ServerStat を取得し、ping/pong の往復時間を記録する"""
+    started_at = time.perf_counter()
+    try:
+        result = await server_list_ping(ip, MINECRAFT_GAME_PORT, timeout=timeout)
+    except Exception:
+        PING_RTT_SECONDS.observe(time.perf_counter() - started_at, "error")
+        raise
+    PING_RTT_SECONDS.observe(result.latency, "ok")
+    rtt_windows["ping"].add(result.latency)
+    return result.stat
+
+async def fetch_server_stat(ip, timeout):
+    """PLAYER_PROBES の順に ServerStat を取得する。すべて失敗したら最後の例外を送出する"""
+    error = None
+    for name in PLAYER_PROBES:
+        try:
+            if name == "query":
+                return parse_full_stat(await timed_full_stat(ip, timeout))
+            if name == "ping":
+                return await timed_ping(ip, timeout)
+        except Exception as e:
+            error = e
+            continue
+        print(f"不明な取得方法です: {name}")
+    raise error or ValueError("PLAYER_PROBES が空です")
+
+async def probe_minecraft(ip):
+    """Minecraftサーバーが Query または Server List Ping に応答すれば True"""
+    try:
+        await fetch_server_stat(ip, timeout=2)
+        return True
+    except Exception:
+        return False
+
+async def get_server_stat(ip):
+    """ServerStat を取得する。応答がなければ None"""
+    try:
+        stat = await fetch_server_stat(ip, timeout=3)
+    except Exception as e:
+        print(f"Minecraftサーバーの状態取得に失敗: {type(e).__name__} - {e}")
+        return None
+    if stat.numplayers > 0:
+        note_activity()
+    return stat
+
+# Discord のメッセージの上限 (2000文字) に収めるため、/mc_status に並べる参加者名の数
+STATUS_MAX_PLAYER_NAMES = 30
+DISCORD_MESSAGE_LIMIT = 2000
+
+def format_player_names(names, limit=STATUS_MAX_PLAYER_NAMES):
+    """先頭 limit 人の名前と、残りの人数"""
+    shown = ", ".join(f"`{name}`" for name in names[:limit])
+    if len(names) > limit:
+        shown += f" ほか{len(names) - limit}人"
+    return shown
+
+def latency_report():
+    reports = [format_rtt_report("Server List Ping RTT", rtt_windows["ping"]),
+               format_rtt_report("Query RTT (handshake+stat)", rtt_windows["query"])]
+    return "\n".join(report for report in reports if report)
+
+async def get_fresh_instance_state():
+    # 起動待ちでは常に最新の状態を見る
+    instance_cache.invalidate(INSTANCE_KEY)
+    return await get_instance_state()
+
+async def announce_startup(edit):
+    """RUNNING → IP割り当て → Minecraft応答 の各段階で edit(content) を呼んでメッセージを更新する"""
+    stage_messages = {
+        STAGE_RUNNING: "VMが起動しました。IPアドレスの割り当てを待っています...",
+        STAGE_IP: "IPアドレス `{ip}` が割り当てられました。Minecraftサーバーの起動を待っています...",
+        STAGE_PLAYABLE: "サーバーが起動しました！ IPアドレス:\n```{ip}```",
+    }
+
+    async def on_stage(stage, elapsed, state):
+        print(f"起動段階: {stage} ({elapsed:.1f}秒)")
+        dashboard.poke()
+        content = stage_messages[stage].format(ip=state.get('ip'))
+        if stage == STAGE_PLAYABLE:
+            content += f"\n(起動からプレイ可能になるまで {elapsed:.0f}秒)"
+        await edit(content)
+
+    result = await wait_until_playable(
+        get_fresh_instance_state, probe_minecraft, on_stage, timeout=STARTUP_READY_TIMEOUT)
+    record_boot(result, GCP_INSTANCE_NAME, BOOT_HISTORY_PATH)
+    if not result['ready']:
+        if result['ip']:
+            message = f"VMは起動しましたが、Minecraftサーバーの応答を確認できませんでした ({result['error']})。IPアドレス: `{result['ip']}`\n少し待ってから `/mc_status` で確認してください。"
+        else:
+            message = f"サーバーの起動処理は開始されましたが、IPアドレスの取得に失敗しました ({result['error']})。少し待ってから `/mc_status` で確認してください。"
+        await edit(message)
+    return result
+
 # --- Helper function for Webhook ---
-async def send_vm_stopped_notification():
-    """VM停止通知をDiscordに送信する非同期ヘルパー関数"""
+async def send_vm_stopped_notification(events=()):
+    """VM停止通知をDiscordに送信する。events はまとめられた停止イベント ({"instance", "zone"}) のリスト"""
     target_channel_id = DISCORD_CHANNEL_ID
+    # 起動直後に届いたWebhookはログイン完了を待ってから送る
+    await bot.wait_until_ready()
     channel = bot.get_channel(target_channel_id)
     if channel:
-        print(f"{target_channel_id} チャンネルに通知を送信します (async helper)。")
+        names = sorted({event.get("instance") or GCP_INSTANCE_NAME for event in events}) or [GCP_INSTANCE_NAME]
+        print(f"{target_channel_id} チャンネルに通知を送信します: {names}")
+        if names == [GCP_INSTANCE_NAME]:
+            message = "Minecraftサーバーが停止しました。\n"
+        else:
+            message = "Minecraftサーバーが停止しました: " + ", ".join(f"`{name}`" for name in names) + "\n"
         view = ServerControlView() # Botのイベントループ内でViewインスタンスを作成
         await channel.send(
-            "Minecraftサーバーが停止しました。\n" +
+            message +
             "再度プレイする場合は下のボタンからサーバーを起動してください。",
             view=view
         )
-        print("Discordへの通知メッセージ送信成功 (async helper)")
+        print("Discordへの通知メッセージ送信成功")
         return True
     else:
-        print(f"エラー: チャンネルID {target_channel_id} が見つかりません (async helper)。")
+        print(f"エラー: チャンネルID {target_channel_id} が見つかりません。")
         return False
 
-# --- Flask Webhook Endpoint ---
-@flask_app.route("/webhook/vm-stopped", methods=['POST'])
-def vm_stopped_webhook(): # asyncを外して同期関数にする
-    # ここで何らかの認証を入れるのが望ましい (例: 固定トークン、リクエスト元のIP制限など)
-    # ... (認証コメントはそのまま)
+def observe_notification(events, success):
+    NOTIFICATION_TOTAL.inc("ok" if success else "failed")
+    NOTIFICATION_EVENTS.observe(len(events))
+    dashboard.poke()
+    if any(event.get("instance") == GCP_INSTANCE_NAME for event in events) and sizing_history.ended(time.time()):
+        save_sizing()
+    if any(event.get("instance") == GCP_INSTANCE_NAME for event in events) and prewarm_tracker.expire(time.time(), stopped=True):
+        print("プリウォームしたサーバーは利用されないまま停止されました")
+        PREWARM_TOTAL.inc("miss")
+        save_activity()
 
-    print("VM停止のWebhookを受信しました。")
-    
-    # Discordへの通知処理 (Viewの作成も含む) をBotのイベントループで実行
-    future = asyncio.run_coroutine_threadsafe(send_vm_stopped_notification(), bot.loop)
-    
+# 停止Webhookは上限付きキューに入れてすぐに応答し、まとめて1通のメッセージで通知する
+stop_dispatcher = StopEventDispatcher(
+    send_vm_stopped_notification,
+    maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 100)),
+    coalesce_seconds=float(os.getenv('WEBHOOK_COALESCE_SECONDS', 2)),
+    dedupe_ttl=float(os.getenv('WEBHOOK_DEDUPE_SECONDS', 300)),
+    on_sent=observe_notification,
+)
+
+# --- ステータスダッシュボード ---
+# 指定チャンネルにピン留めした Embed をバックグラウンドで編集し続ける。
+# GCP / Query への問い合わせは DASHBOARD_REFRESH_SECONDS ごと (起動・停止・コマンドの直後は次の tick) だけ行う
+DASHBOARD_CHANNEL_IDS = [int(value) for value in os.getenv('DASHBOARD_CHANNEL_IDS', str(DISCORD_CHANNEL_ID)).split(',')
+                         if value.strip() and int(value)]
+DASHBOARD_REFRESH_SECONDS = float(os.getenv('DASHBOARD_REFRESH_SECONDS', 30))
+DASHBOARD_TICK_SECONDS = float(os.getenv('DASHBOARD_TICK_SECONDS', 5))
+dashboard = Dashboard(DASHBOARD_CHANNEL_IDS, refresh_seconds=DASHBOARD_REFRESH_SECONDS)
+
+async def find_dashboard_message(channel):
+    """ピン留め済みのダッシュボードを探し、なければ新しく送信してピン留めする"""
+    for message in await channel.pins():
+        if message.author.id == bot.user.id and message.embeds and message.embeds[0].footer.text == DASHBOARD_FOOTER:
+            return message
+    message = await channel.send(embed=discord.Embed.from_dict(dashboard.embed))
     try:
-        success = future.result(timeout=10) # タイムアウトを設定 (例: 10秒)
-        if success:
-            print("Discord通知処理完了 (via run_coroutine_threadsafe)")
-            return "Webhook processed and notification sent.", 200
+        await message.pin(reason="Minecraftサーバーのステータスダッシュボード")
+    except discord.HTTPException as e:
+        # メッセージの管理権限がない場合はピン留めせずに使う
+        print(f"ダッシュボードのピン留めに失敗しました: {e}")
+    return message
+
+async def publish_dashboard(panel):
+    channel = bot.get_channel(panel.channel_id)
+    if channel is None:
+        return
+    fingerprint = dashboard.fingerprint
+    try:
+        if panel.message is None:
+            panel.message = await find_dashboard_message(channel)
+        await panel.message.edit(embed=discord.Embed.from_dict(dashboard.embed))
+        panel.sent_fingerprint = fingerprint
+        DASHBOARD_EDITS_TOTAL.inc("ok")
+    except discord.NotFound:
+        # 削除されていたら次の tick で作り直す
+        panel.message = None
+        DASHBOARD_EDITS_TOTAL.inc("not_found")
+    except discord.HTTPException as e:
+        if e.status == 429:
+            retry_after = getattr(e, "retry_after", None) or 5.0
+            panel.limiter.block(retry_after)
+            DASHBOARD_EDITS_TOTAL.inc("rate_limited")
         else:
-            print("Discord通知処理で問題発生 (via run_coroutine_threadsafe)")
-            return "Webhook processed, but notification failed.", 500 # エラーを示すステータスコード
+            DASHBOARD_EDITS_TOTAL.inc("error")
+        print(f"ダッシュボードの更新に失敗しました (channel={panel.channel_id}): {e}")
+
+@tasks.loop(seconds=DASHBOARD_TICK_SECONDS)
+async def dashboard_loop():
+    if dashboard.refresh_due():
+        try:
+            state = await get_instance_state()
+        except Exception as e:
+            print(f"ダッシュボード用の状態取得に失敗: {e}")
+            state = None
+        stat = None
+        if state and state['status'] == "RUNNING" and state['ip']:
+            stat = await get_server_stat(state['ip'])
+        dashboard.update(render_dashboard(GCP_INSTANCE_NAME, state, stat, datetime.datetime.now(datetime.timezone.utc)))
+    await asyncio.gather(*(publish_dashboard(panel) for panel in dashboard.pending_panels()))
+
+@dashboard_loop.before_loop
+async def before_dashboard_loop():
+    await bot.wait_until_ready()
+
+# --- 予測プリウォーム ---
+# 起動要求とプレイヤーの観測は常に記録し、PREWARM_ENABLED=true のときだけ予測に基づいて先に起動する
+PREWARM_ENABLED = os.getenv('PREWARM_ENABLED', 'false').lower() == 'true'
+ACTIVITY_MODEL_PATH = os.getenv('ACTIVITY_MODEL_PATH')
+# 利用が見込まれる枠の何秒前から起動するか (起動からプレイ可能までの時間より少し長く)
+PREWARM_LEAD_SECONDS = float(os.getenv('PREWARM_LEAD_SECONDS', 600))
+PREWARM_THRESHOLD = float(os.getenv('PREWARM_THRESHOLD', 0.5))
+# プリウォームから何秒以内に利用があれば当たりとするか
+PREWARM_HIT_WINDOW = float(os.getenv('PREWARM_HIT_WINDOW', 2700))
+# 曜日×時刻の枠をどのタイムゾーンで区切るか (時間単位、既定は日本時間)
+ACTIVITY_UTC_OFFSET_HOURS = float(os.getenv('ACTIVITY_UTC_OFFSET_HOURS', 9))
+ACTIVITY_TZ = datetime.timezone(datetime.timedelta(hours=ACTIVITY_UTC_OFFSET_HOURS))
+activity_model = prewarm.ActivityModel(utc_offset=int(ACTIVITY_UTC_OFFSET_HOURS * 3600))
+prewarm_tracker = prewarm.PrewarmTracker(PREWARM_HIT_WINDOW)
+prewarm.load_state(ACTIVITY_MODEL_PATH, activity_model, prewarm_tracker)
+
+def save_activity():
+    prewarm.save_state(ACTIVITY_MODEL_PATH, activity_model, prewarm_tracker)
+
+def note_activity():
+    """起動要求またはプレイヤーの存在を観測した"""
+    now = time.time()
+    changed = activity_model.record(now)
+    saved = prewarm_tracker.activity(now)
+    if saved is not None:
+        print(f"プリウォームが当たりました (省けた待ち時間: {saved:.0f}秒)")
+        PREWARM_TOTAL.inc("hit")
+        PREWARM_SAVED_SECONDS.observe(saved)
+    if changed or saved is not None:
+        save_activity()
+
+async def measure_prewarm_boot():
+    """プリウォームした起動がプレイ可能になるまでの時間を計測する (省けた待ち時間の上限になる)"""
+    result = await wait_until_playable(get_fresh_instance_state, probe_minecraft, timeout=STARTUP_READY_TIMEOUT)
+    record_boot(result, GCP_INSTANCE_NAME, BOOT_HISTORY_PATH)
+    if result['ready']:
+        prewarm_tracker.ready(result['stages'].get(STAGE_PLAYABLE))
+        save_activity()
+
+@tasks.loop(seconds=60)
+async def prewarm_loop():
+    now = time.time()
+    if prewarm_tracker.expire(now):
+        print("プリウォームしたサーバーは時間内に利用されませんでした")
+        PREWARM_TOTAL.inc("miss")
+        save_activity()
+    if not PREWARM_ENABLED or prewarm_tracker.pending is not None:
+        return
+    slot = activity_model.next_active_slot(now, PREWARM_LEAD_SECONDS, PREWARM_THRESHOLD)
+    if slot is None or slot == prewarm_tracker.last_slot:
+        return
+    if await get_instance_status() != "TERMINATED":
+        return
+    probability = activity_model.probability(slot)
+    print(f"利用が見込まれるため事前に起動します (枠開始: {datetime.datetime.fromtimestamp(slot, ACTIVITY_TZ):%m/%d %H:%M}, 確率 {probability:.0%})")
+    if not await start_instance():
+        return
+    prewarm_tracker.started(now, slot)
+    PREWARM_TOTAL.inc("started")
+    save_activity()
+    channel = bot.get_channel(DISCORD_CHANNEL_ID)
+    if channel:
+        await channel.send(f"いつも遊ばれている時間帯のため、Minecraftサーバーを事前に起動しています (確率 {probability:.0%})。")
+    asyncio.create_task(measure_prewarm_boot())
+
+@prewarm_loop.before_loop
+async def before_prewarm_loop():
+    await bot.wait_until_ready()
+
+def prewarm_report():
+    summary = prewarm_tracker.summary()
+    lines = [f"予測プリウォーム: {'有効' if PREWARM_ENABLED else '無効 (記録のみ)'}",
+             f"観測量: {activity_model.weeks:.1f}週 (予測には{prewarm.MIN_WEEKS:.0f}週以上必要)"]
+    slot = activity_model.next_active_slot(time.time(), 24 * 3600, PREWARM_THRESHOLD)
+    if slot is not None:
+        lines.append(f"24時間以内の次の予測: {datetime.datetime.fromtimestamp(slot, ACTIVITY_TZ):%m/%d %H:%M} (確率 {activity_model.probability(slot):.0%})")
+    if summary['precision'] is not None:
+        lines.append(f"当たり {summary['hits']}回 / 外れ {summary['misses']}回 (的中率 {summary['precision']:.0%})")
+        lines.append(f"省けた待ち時間: 合計 {summary['saved_seconds'] / 60:.1f}分"
+                     + (f" (1回あたり {summary['saved_seconds'] / summary['hits']:.0f}秒)" if summary['hits'] else ""))
+    if summary['pending']:
+        lines.append("現在プリウォーム中です。")
+    return "\n".join(lines)
+
+# --- VM の起動エージェントからのプレイヤー数報告 ---
+# エージェントは参加・退出のたびに /webhook/players へ報告する。0人が IDLE_GRACE_SECONDS 続いたら
+# 停止判定の Cloud Function を ?idle_confirmed=1 付きで呼び出す (Function でも Query で0人を確認してから停止する)
+CHECK_PLAYERS_URL = os.getenv('CHECK_PLAYERS_URL')
+# VM のエージェント・check-players との共有シークレット (X-Webhook-Secret ヘッダー)。
+# 設定されていれば Webhook はヘッダーが一致するものだけを受け付け、Function の呼び出しにも付ける
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_SECRET_HEADER = "X-Webhook-Secret"
+IDLE_GRACE_SECONDS = float(os.getenv('IDLE_GRACE_SECONDS', 600))
+agent_reports = AgentReports(idle_grace=IDLE_GRACE_SECONDS)
+
+def observe_agent_report(report):
+    AGENT_REPORTS_TOTAL.inc(report["event"])
+    if report["event"] == "backup":
+        resolve_world_backup(report)
+        return
+    if report["event"] == "boot":
+        for phase, seconds in report["phases"].items():
+            BOOT_PHASE_SECONDS.observe(seconds, phase)
+        print(f"VMの起動エージェントの計測 ({report['instance']}): {report['phases']}")
+    if report["instance"] == GCP_INSTANCE_NAME:
+        observe_sizing(report)
+    changed = agent_reports.record(report, time.monotonic())
+    if report["instance"] == GCP_INSTANCE_NAME and report["count"] > 0:
+        note_activity()
+        # Query の観測の間に出入りしたプレイヤーも、停止前スナップショットの要否の判断に含める
+        idle_monitor.players_seen = True
+    if report["instance"] == GCP_INSTANCE_NAME and report["event"] != "exit":
+        # Bot 以外から起動された場合も監視を始め、0人になったらすぐ短い間隔に戻す
+        resume_idle_monitor()
+        if changed and report["count"] == 0 and idle_monitor_loop.is_running():
+            idle_monitor_loop.change_interval(seconds=idle_monitor.fast_seconds)
+    if changed or report["event"] != "heartbeat":
+        dashboard.poke()
+
+async def request_idle_check(zone, instance):
+    """停止判定の Cloud Function を呼び出す。Function が応答したら True"""
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=90)) as session:
+            headers = {WEBHOOK_SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+            async with session.get(CHECK_PLAYERS_URL, params={"idle_confirmed": "1"}, headers=headers) as response:
+                body = (await response.text()).strip()
+                print(f"停止判定を依頼しました ({zone}/{instance}): {response.status} {body}")
+                return response.status < 500
+    except (ClientError, asyncio.TimeoutError) as e:
+        print(f"停止判定の依頼に失敗しました ({zone}/{instance}): {type(e).__name__} - {e}")
+        return False
+
+@tasks.loop(seconds=30)
+async def agent_idle_loop():
+    for zone, instance in agent_reports.idle_due(time.monotonic()):
+        # Function は設定済みの1台だけを判定する
+        if instance != GCP_INSTANCE_NAME:
+            continue
+        agent_reports.mark_triggered((zone, instance), await request_idle_check(zone, instance))
+
+@agent_idle_loop.before_loop
+async def before_agent_idle_loop():
+    await bot.wait_until_ready()
+
+# --- ワールドの増分バックアップ (VM の起動エージェントが実行) ---
+# メタデータ world-backup-request に新しい依頼IDを書くと、エージェントが save-off / save-all flush の後に
+# 変わったチャンクだけをバックアップ先へ送り、結果を /webhook/players に backup イベントで返す
+WORLD_BACKUP_TIMEOUT = float(os.getenv('WORLD_BACKUP_TIMEOUT', 600))
+world_backup_waiters = {}  # 依頼ID -> Future
+
+async def set_instance_metadata(items):
+    """インスタンスのメタデータのうち items のキーだけを書き換える (他のキーはそのまま残す)"""
+    instance = await compute.execute(lambda s: s.instances().get(
+        project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME, fields="metadata"))
+    metadata = instance.get('metadata', {})
+    merged = {item['key']: item.get('value') for item in metadata.get('items', [])}
+    merged.update(items)
+    body = {
+        'fingerprint': metadata.get('fingerprint'),
+        'items': [{'key': key, 'value': value} for key, value in merged.items()],
+    }
+    return await compute.execute(lambda s: s.instances().setMetadata(
+        project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME, body=body))
+
+async def request_world_backup():
+    """エージェントにワールドのバックアップを依頼し、backup イベントの報告を待って返す"""
+    request_id = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.urandom(2).hex()}"
+    future = asyncio.get_running_loop().create_future()
+    world_backup_waiters[request_id] = future
+    try:
+        await set_instance_metadata({'world-backup-request': request_id})
+        return await asyncio.wait_for(future, WORLD_BACKUP_TIMEOUT)
+    finally:
+        world_backup_waiters.pop(request_id, None)
+
+def resolve_world_backup(report):
+    print(f"ワールドのバックアップ結果を受信しました ({report['request']}): "
+          f"{'成功 ' + report['backup_id'] if report['ok'] else '失敗 ' + report['error']}")
+    future = world_backup_waiters.get(report['request'])
+    if future is not None and not future.done():
+        future.set_result(report)
+
+def format_world_backup(report):
+    if not report['ok']:
+        return f"ワールドのバックアップに失敗しました。\nエラー: `{report['error']}`"
+    stats = report['stats']
+    lines = [f"ワールドのバックアップが完了しました。\nバックアップID: `{report['backup_id']}`"]
+    if stats:
+        lines.append(f"変更チャンク: {stats.get('changed_chunks', 0)}/{stats.get('chunks', 0)} / "
+                     f"送信: {stats.get('uploaded_objects', 0)}オブジェクト "
+                     f"({stats.get('uploaded_bytes', 0) / 1024 / 1024:.1f}MB) / "
+                     f"再利用: {stats.get('reused_objects', 0)}オブジェクト")
+    if not report['flushed']:
+        lines.append("※ ワールドの書き出しを確認できなかったため、直前の変更が含まれていない可能性があります。")
+    return "\n".join(lines)
+
+# --- 見込み人数に応じたマシンタイプの選択 ---
+# 停止中のインスタンスを起動する前に、見込み人数 (/mc_start の players、なければ記録からの推定) を収容できる
+# マシンタイプに setMachineType で変え、ヒープサイズをメタデータ java-heap-mb で起動エージェントに渡す。
+# 起動エージェントの報告からマシンタイプごとの稼働時間・最大人数・mspt を記録し、/mc_sizing で表示する
+MACHINE_SIZING_ENABLED = os.getenv('MACHINE_SIZING_ENABLED', 'false').lower() == 'true'
+MACHINE_SIZES = sizing.parse_sizes(os.getenv('MACHINE_SIZES') or sizing.DEFAULT_SIZES)
+SIZING_STATE_PATH = os.getenv('SIZING_STATE_PATH')
+RESIZE_WAIT_DEADLINE = 120
+sizing_history = sizing.SizingHistory()
+sizing.load_state(SIZING_STATE_PATH, sizing_history)
+
+def save_sizing():
+    sizing.save_state(SIZING_STATE_PATH, sizing_history)
+
+def observe_sizing(report):
+    now = time.time()
+    if report["event"] == "boot":
+        sizing_history.started(now, report.get("machine_type"))
+        save_sizing()
+    elif report["event"] == "exit":
+        if sizing_history.ended(now):
+            save_sizing()
+    elif report["event"] in ("players", "heartbeat"):
+        sizing_history.observe(now, report["count"], report.get("mspt"))
+        if "mspt" in report:
+            SERVER_MSPT.observe(report["mspt"], sizing_history.current["machine_type"])
+            save_sizing()
+
+async def apply_machine_size(expected_players=None):
+    """見込み人数に合わせてマシンタイプとヒープサイズを変える。(選んだ MachineSize, 説明) を返す
+
+    インスタンスが停止中でない・見込み人数がわからない・変更に失敗した場合は今のマシンタイプのまま起動する
+    """
+    if not MACHINE_SIZING_ENABLED:
+        return None, None
+    source = "指定"
+    if expected_players is None:
+        expected_players = sizing_history.estimate(time.time())
+        source = "記録からの推定"
+    if expected_players is None:
+        return None, None
+    size = sizing.choose_size(MACHINE_SIZES, expected_players)
+    note = f"見込み {expected_players}人 ({source}) → `{size.machine_type}` (ヒープ {size.heap_mb}MB)"
+    try:
+        state = await get_fresh_instance_state()
+        if state['status'] != "TERMINATED":
+            return None, None
+        operations = []
+        if state['machine_type'] != size.machine_type:
+            operations.append(await compute.execute(lambda s: s.instances().setMachineType(
+                project=GCP_PROJECT_ID, zone=GCP_ZONE, instance=GCP_INSTANCE_NAME,
+                body={'machineType': f"zones/{GCP_ZONE}/machineTypes/{size.machine_type}"})))
+        operations.append(await set_instance_metadata({'java-heap-mb': str(size.heap_mb)}))
+        results = await wait_for_gce_operations(operations, RESIZE_WAIT_DEADLINE)
+        failed = [result for result in results if not result['success']]
+        if failed:
+            raise RuntimeError(failed[0]['error'])
+    except Exception as e:
+        print(f"マシンタイプの変更に失敗したため、今のマシンタイプで起動します: {e}")
+        return None, f"マシンタイプの変更に失敗しました (`{e}`)。今のマシンタイプで起動します。"
+    finally:
+        instance_cache.invalidate(INSTANCE_KEY)
+    print(f"マシンタイプを選択しました: {note} (変更前: {state['machine_type']})")
+    return size, note
+
+# --- アイドル監視 (IDLE_MONITOR_ENABLED=true のとき) ---
+# check-players と同じ判定・停止処理を Bot 内で行う。GCP クライアント・Query クライアントは Bot のものを使い回し、
+# 観測間隔は IdleMonitor が状態に応じて変える (0人付近は短く、混んでいる間は延ばし、停止中は観測しない)
+IDLE_MONITOR_ENABLED = os.getenv('IDLE_MONITOR_ENABLED', 'false').lower() == 'true'
+# true にすると、前回のスナップショット以降にプレイヤーを見ていなければ停止前スナップショットを省略する。
+# Query の観測の間の短いセッションは見落とすため、VM のエージェントの参加報告もプレイヤーがいた印として使う。
+# 既定では省略せず、毎回作成する
+SKIP_UNCHANGED_SNAPSHOT = os.getenv('SKIP_UNCHANGED_SNAPSHOT', 'false').lower() == 'true'
+idle_monitor = idle.IdleMonitor(
+    fast_seconds=float(os.getenv('IDLE_MONITOR_FAST_SECONDS', idle.DEFAULT_FAST_SECONDS)),
+    slow_seconds=float(os.getenv('IDLE_MONITOR_SLOW_SECONDS', idle.DEFAULT_SLOW_SECONDS)),
+    near_empty=int(os.getenv('IDLE_MONITOR_NEAR_EMPTY', idle.DEFAULT_NEAR_EMPTY)),
+    required_zero_readings=int(os.getenv('IDLE_REQUIRED_ZERO_READINGS', idle.DEFAULT_REQUIRED_ZERO_READINGS)),
+    idle_seconds=float(os.getenv('IDLE_MONITOR_IDLE_SECONDS', idle.DEFAULT_IDLE_SECONDS)),
+)
+
+async def stop_idle_server(ip):
+    """check-players と同じ停止処理: 停止前スナップショット (RCONで書き出し) → 停止 → 停止通知"""
+    snapshot_taken = False
+    if idle_monitor.take_snapshot(SKIP_UNCHANGED_SNAPSHOT):
+        boot_disk = await get_boot_disk_name()
+        if boot_disk:
+            # スナップショットに失敗しても停止はする
+            snapshot_taken, snapshot_name, error = await create_gce_snapshot(
+                boot_disk, f"{GCP_INSTANCE_NAME}-snapshot", flush_ip=ip)
+            if not snapshot_taken:
+                print(f"停止前スナップショットの作成に失敗しました: {error}")
+    else:
+        print("前回のスナップショット以降にプレイヤーが観測されていないため、スナップショット作成を省略します。")
+    if not await stop_instance():
+        return False
+    idle_monitor.stopped(snapshot_taken)
+    stop_dispatcher.submit({"instance": GCP_INSTANCE_NAME, "zone": GCP_ZONE})
+    return True
+
+@tasks.loop(seconds=idle.DEFAULT_FAST_SECONDS)
+async def idle_monitor_loop():
+    try:
+        state = await get_instance_state()
     except Exception as e:
-        print(f"Discord通知処理中に例外発生 (via run_coroutine_threadsafe): {e}")
-        return f"Error during notification: {e}", 500
+        print(f"アイドル監視: インスタンスの状態取得に失敗: {e}")
+        return
+    count = None
+    if state['status'] == "RUNNING" and state['ip']:
+        stat = await get_server_stat(state['ip'])
+        count = stat.numplayers if stat else -1
+    action, interval = idle_monitor.observe(state['status'], count, time.monotonic())
+    IDLE_MONITOR_TOTAL.inc(action)
+    if action == idle.STOP:
+        print(f"プレイヤー数0が {idle_monitor.idle_seconds:.0f}秒以上続いたため、インスタンス停止処理を開始します。")
+        if not await stop_idle_server(state['ip']):
+            return
+        action = idle.PAUSE
+    if action == idle.PAUSE:
+        print(f"インスタンスが `{state['status']}` のため、アイドル監視を休止します。")
+        idle_monitor_loop.stop()
+        return
+    if interval != idle_monitor_loop.seconds:
+        idle_monitor_loop.change_interval(seconds=interval)
+
+@idle_monitor_loop.before_loop
+async def before_idle_monitor_loop():
+    await bot.wait_until_ready()
+
+def resume_idle_monitor():
+    """起動したとき・起動を検知したときに呼ぶ"""
+    if IDLE_MONITOR_ENABLED and not idle_monitor_loop.is_running():
+        idle_monitor.resume(time.monotonic())
+        idle_monitor_loop.change_interval(seconds=idle_monitor.fast_seconds)
+        idle_monitor_loop.start()
+
+# --- HTTPサーバー (Botと同じイベントループで動かす) ---
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render_all(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def webhook_authorized(request):
+    """WEBHOOK_SECRET が設定されていれば、X-Webhook-Secret ヘッダーが一致するか"""
+    if not WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(request.headers.get(WEBHOOK_SECRET_HEADER, "").encode(), WEBHOOK_SECRET.encode())
+
+async def vm_stopped_webhook(request):
+    if not webhook_authorized(request):
+        WEBHOOK_TOTAL.inc("unauthorized")
+        return web.Response(text="Unauthorized.\n", status=401)
+    try:
+        # 本文なし (旧形式) の場合は設定済みのインスタンスの停止とみなす
+        payload = await request.json() if request.can_read_body else {}
+        if not isinstance(payload, dict):
+            raise ValueError("JSONオブジェクトではありません")
+    except ValueError as e:
+        WEBHOOK_TOTAL.inc("invalid")
+        return web.Response(text=f"Invalid payload: {e}\n", status=400)
+    event = {
+        "instance": str(payload.get("instance") or GCP_INSTANCE_NAME),
+        "zone": str(payload.get("zone") or GCP_ZONE),
+    }
+    outcome = stop_dispatcher.submit(event)
+    WEBHOOK_TOTAL.inc(outcome)
+    print(f"VM停止のWebhookを受信しました: {event['zone']}/{event['instance']} ({outcome})")
+    if outcome == QUEUED:
+        return web.Response(text="Webhook accepted.\n", status=202)
+    if outcome == DUPLICATE:
+        return web.Response(text="Duplicate stop event ignored.\n", status=202)
+    # キューが満杯: 送信元に再試行させる
+    return web.Response(text="Webhook queue is full.\n", status=503, headers={"Retry-After": "5"})
+
+async def players_webhook(request):
+    if not webhook_authorized(request):
+        WEBHOOK_TOTAL.inc("unauthorized")
+        return web.Response(text="Unauthorized.\n", status=401)
+    try:
+        report = parse_report(await request.json())
+    except (ValueError, TypeError) as e:
+        WEBHOOK_TOTAL.inc("invalid")
+        return web.Response(text=f"Invalid payload: {e}\n", status=400)
+    observe_agent_report(report)
+    return web.Response(text="Report accepted.\n", status=202)
+
+def create_web_app():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_post("/webhook/vm-stopped", vm_stopped_webhook)
+    app.router.add_post("/webhook/players", players_webhook)
+    return app
 
 # --- Discord Bot イベントハンドラ ---
 @bot.event
@@ -250,26 +1063,48 @@ async def on_ready():
         print(f"{len(synced)}個のスラッシュコマンドを同期しました")
     except Exception as e:
         print(f"スラッシュコマンドの同期に失敗: {e}")
-    # TODO: VM停止を監視するバックグラウンドタスクを開始する
-    # Flaskアプリを別スレッドで起動
-    # werkzeugのログを無効化するなど、本番環境では調整が必要な場合がある
-    # threading.Thread(target=lambda: flask_app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False), daemon=True).start()
-    # print("Flask Webhookサーバーを http://0.0.0.0:8080 で起動しました")
-    pass # Cloud Runで動かす場合は、gunicornなどがFlaskアプリをサーブするので、Bot内での起動は不要になることが多い
+    if DASHBOARD_CHANNEL_IDS and not dashboard_loop.is_running():
+        dashboard_loop.start()
+    if not prewarm_loop.is_running():
+        prewarm_loop.start()
+    if IDLE_MONITOR_ENABLED:
+        # 停止中なら最初の観測で休止する
+        resume_idle_monitor()
+    elif CHECK_PLAYERS_URL and not agent_idle_loop.is_running():
+        agent_idle_loop.start()
 
 # --- Discord スラッシュコマンド ---
 @bot.tree.command(name="mc_status", description="Minecraftサーバーの現在の状態を表示します。")
+@instrumented("mc_status")
 async def mc_status_command(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True) # 応答に時間がかかる場合があるため
+    dashboard.poke()
     status = await get_instance_status()
     if status:
-        await interaction.followup.send(f"Minecraftサーバー ({GCP_INSTANCE_NAME}) の現在の状態: `{status}`")
+        message = f"Minecraftサーバー ({GCP_INSTANCE_NAME}) の現在の状態: `{status}`"
+        ip_address = await get_instance_external_ip() if status == "RUNNING" else None
+        if ip_address:
+            stat = await get_server_stat(ip_address)
+            if stat:
+                message += f"\nバージョン: `{stat.version}` / プレイヤー: {stat.numplayers}/{stat.maxplayers}"
+                if stat.players:
+                    message += "\n" + format_player_names(stat.players)
+            else:
+                message += "\nMinecraftサーバーからの応答がありません (起動中の可能性があります)。"
+            report = latency_report()
+            # 上限を超える場合は RTT の要約を省く
+            if report and len(message) + 1 + len(report) <= DISCORD_MESSAGE_LIMIT:
+                message += "\n" + report
+        await interaction.followup.send(message[:DISCORD_MESSAGE_LIMIT])
     else:
         await interaction.followup.send("サーバーの状態を取得できませんでした。エラーログを確認してください。")
 
 @bot.tree.command(name="mc_start", description="Minecraftサーバーを起動します。")
-async def mc_start_command(interaction: discord.Interaction):
+@app_commands.describe(players="見込みのプレイヤー数 (マシンタイプの選択に使います。省略すると記録から推定します)")
+@instrumented("mc_start")
+async def mc_start_command(interaction: discord.Interaction, players: app_commands.Range[int, 1, 100] = None):
     await interaction.response.defer() # 先にdefer
+    note_activity()
     current_status = await get_instance_status()
     if current_status == "RUNNING":
         ip_address = await get_instance_external_ip()
@@ -277,22 +1112,27 @@ async def mc_start_command(interaction: discord.Interaction):
         return
     if current_status == "TERMINATED":
         await interaction.followup.send("サーバーを起動中です...完了まで数分かかることがあります。", ephemeral=True)
-        success = await start_instance()
+        _, sizing_note = await apply_machine_size(players)
+        success = await start_instance(resize=False)
         if success:
-            await asyncio.sleep(15) # VM起動とIP割り当てまでの猶予 (必要に応じて調整)
-            ip_address = await get_instance_external_ip()
-            if ip_address:
-                message = f"サーバーが起動しました！ IPアドレス:\n```{ip_address}```"
-            else:
-                message = "サーバーの起動処理は開始されましたが、IPアドレスの取得に失敗しました。少し待ってから `/mc_status` や `/mc_start` で再度確認してください。"
-            await interaction.edit_original_response(content=message) # 最初の応答を編集
+            async def edit(content):
+                if sizing_note:
+                    content = f"{content}\n{sizing_note}"
+                await interaction.edit_original_response(content=content) # 最初の応答を編集
+            await announce_startup(edit)
         else:
             await interaction.edit_original_response(content="サーバーの起動に失敗しました。エラーログを確認してください。")
     else:
         await interaction.followup.send(f"サーバーは現在 `{current_status}` 状態です。起動できません。", ephemeral=True)
 
 @bot.tree.command(name="mc_backup", description="Minecraftサーバーのバックアップ(スナップショット)を作成します。")
-async def mc_backup_command(interaction: discord.Interaction):
+@app_commands.describe(method="snapshot: ディスク全体のスナップショット / world: ワールドの増分バックアップ (起動中のみ)")
+@app_commands.choices(method=[
+    app_commands.Choice(name="snapshot", value="snapshot"),
+    app_commands.Choice(name="world", value="world"),
+])
+@instrumented("mc_backup")
+async def mc_backup_command(interaction: discord.Interaction, method: str = "snapshot"):
     await interaction.response.defer(ephemeral=True) # 応答に時間がかかるため、ephemeralで
 
     current_status = await get_instance_status()
@@ -300,6 +1140,23 @@ async def mc_backup_command(interaction: discord.Interaction):
         await interaction.followup.send("サーバーの状態を取得できませんでした。バックアップは作成できません。", ephemeral=True)
         return
 
+    if method == "world":
+        # ワールドの増分バックアップは VM 上のエージェントが行うので、起動中のみ
+        if current_status != "RUNNING":
+            await interaction.followup.send(f"サーバーは現在 `{current_status}` 状態です。ワールドのバックアップは起動中のみ作成できます。", ephemeral=True)
+            return
+        await interaction.followup.send("ワールドの増分バックアップを依頼しました...", ephemeral=True)
+        try:
+            report = await request_world_backup()
+        except asyncio.TimeoutError:
+            await interaction.edit_original_response(content=f"{WORLD_BACKUP_TIMEOUT:.0f}秒以内にエージェントから結果が届きませんでした。VMのログを確認してください。")
+            return
+        except Exception as e:
+            await interaction.edit_original_response(content=f"ワールドのバックアップの依頼に失敗しました。\nエラー: `{e}`")
+            return
+        await interaction.edit_original_response(content=format_world_backup(report))
+        return
+
     # サーバーが起動中でもスナップショットは作成可能だが、整合性のためには停止中が望ましい場合がある
     # ここでは起動中でも許可する
     if current_status not in ["RUNNING", "TERMINATED"]:
@@ -317,19 +1174,79 @@ async def mc_backup_command(interaction: discord.Interaction):
     
     await interaction.edit_original_response(content=f"`{boot_disk_name}` のスナップショット作成を開始します...")
 
-    success, snapshot_name, error = await create_gce_snapshot(boot_disk_name, snapshot_prefix)
+    # 起動中ならRCONでワールドを書き出してから取得する (RCON未設定時はそのまま取得)
+    flush_ip = await get_instance_external_ip() if current_status == "RUNNING" else None
+    success, snapshot_name, error = await create_gce_snapshot(boot_disk_name, snapshot_prefix, wait=True, flush_ip=flush_ip)
 
     if success:
-        message = f"""スナップショットの作成処理を開始しました。
-スナップショット名: `{snapshot_name}`
-作成完了まで数分かかることがあります。GCPコンソールで進捗を確認してください。"""
+        message = f"""スナップショットの作成が完了しました。
+スナップショット名: `{snapshot_name}`"""
         await interaction.edit_original_response(content=message)
     else:
         message = f"""スナップショットの作成に失敗しました。
 エラー: `{error}`"""
         await interaction.edit_original_response(content=message)
 
+@bot.tree.command(name="mc_prewarm", description="予測プリウォームの状況と効果を表示します。")
+@instrumented("mc_prewarm")
+async def mc_prewarm_command(interaction: discord.Interaction):
+    await interaction.response.send_message(prewarm_report(), ephemeral=True)
+
+def perf_report():
+    """/mc_perf の本文: イベントループの遅延・処理ごとの所要時間・直近のループ停止"""
+    lines = [format_rtt_report("イベントループの遅延", loop_lag_window) or "イベントループの遅延: まだ標本がありません。"]
+    rows = []
+    for name, window in sorted(handler_windows.items()):
+        ordered = sorted(window.samples())
+        if ordered:
+            rows.append(f"{name:<20} {len(ordered):>4}回 p50 {percentile(ordered, 0.5):6.2f}s "
+                        f"p90 {percentile(ordered, 0.9):6.2f}s 最大 {ordered[-1]:6.2f}s")
+    if rows:
+        lines.append("コマンド・ボタンの所要時間 (直近60分):\n```\n" + "\n".join(rows) + "\n```")
+    active = loop_monitor.active()
+    if active:
+        lines.append("実行中: " + ", ".join(f"`{name}`" for name in active))
+    stalls = list(loop_monitor.stalls)
+    if not stalls:
+        lines.append(f"{LOOP_STALL_THRESHOLD}秒以上のループ停止は記録されていません。")
+        return "\n".join(lines)
+    lines.append(f"直近のループ停止 ({len(stalls)}回、{LOOP_STALL_THRESHOLD}秒以上):")
+    for stall in reversed(stalls[-5:]):
+        handlers = ", ".join(stall.handlers) or "-"
+        lines.append(f"- {datetime.datetime.fromtimestamp(stall.started_at):%m/%d %H:%M:%S} "
+                     f"{stall.duration:.2f}秒 ({handlers}) `{stall.innermost()}`")
+    # 最新の停止のスタックは内側から入るだけ表示する
+    stack = []
+    budget = 1900 - len("\n".join(lines))
+    for frame in reversed(stalls[-1].stack):
+        budget -= len(frame) + 1
+        if budget < 20:
+            break
+        stack.insert(0, frame.rstrip())
+    if stack:
+        lines.append("```\n" + "\n".join(stack) + "\n```")
+    return "\n".join(lines)
+
+@bot.tree.command(name="mc_perf", description="Botのイベントループの遅延と処理時間を表示します (管理者用)。")
+@app_commands.default_permissions(administrator=True)
+@instrumented("mc_perf")
+async def mc_perf_command(interaction: discord.Interaction):
+    await interaction.response.send_message(perf_report(), ephemeral=True)
+
+@bot.tree.command(name="mc_sizing", description="マシンタイプごとのtick性能(mspt)と稼働費用を表示します。")
+@instrumented("mc_sizing")
+async def mc_sizing_command(interaction: discord.Interaction):
+    message = sizing.format_report(sizing_history.report(MACHINE_SIZES), MACHINE_SIZES)
+    if MACHINE_SIZING_ENABLED:
+        estimate = sizing_history.estimate(time.time())
+        if estimate is not None:
+            message += f"\n今起動した場合の見込み: {estimate}人 → `{sizing.choose_size(MACHINE_SIZES, estimate).machine_type}`"
+    else:
+        message += "\n(MACHINE_SIZING_ENABLED=false のため、起動時にマシンタイプは変更しません)"
+    await interaction.response.send_message(message, ephemeral=True)
+
 @bot.tree.command(name="help", description="利用可能なコマンドの一覧を表示します。")
+@instrumented("help")
 async def help_command(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
@@ -352,15 +1269,21 @@ async def help_command(interaction: discord.Interaction):
 
     await interaction.followup.send(embed=embed, ephemeral=True)
 
-# --- Botの起動 & Flaskアプリの起動 ---
+# --- Botの起動 & HTTPサーバーの起動 ---
 async def main():
-    # Flaskアプリを起動 (本番環境ではgunicornなどを使用することを想定)
-    # ローカルテスト用にthreadingで起動する場合
-    flask_thread = threading.Thread(target=lambda: flask_app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False), daemon=True)
-    flask_thread.start()
-    print("Flask Webhookサーバーを http://0.0.0.0:8080 で起動しました (ローカルテスト用)")
-
-    await bot.start(DISCORD_BOT_TOKEN)
+    # Webhook / メトリクス用のHTTPサーバーをBotと同じイベントループで起動する
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', WEBHOOK_PORT).start()
+    print(f"Webhookサーバーを http://0.0.0.0:{WEBHOOK_PORT} で起動しました")
+    stop_dispatcher.start()
+    loop_monitor.start()
+    try:
+        await bot.start(DISCORD_BOT_TOKEN)
+    finally:
+        loop_monitor.stop()
+        await stop_dispatcher.stop()
+        await runner.cleanup()
 
 if __name__ == "__main__":
     if not DISCORD_BOT_TOKEN or GCP_PROJECT_ID == "" or DISCORD_CHANNEL_ID == 0:
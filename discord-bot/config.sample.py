@@ -16,6 +16,12 @@ GCP_INSTANCE_NAME = "minecraft-server" # GCEインスタンス名
 # 開発者モードを有効にして、チャンネルを右クリック -> IDをコピー で取得できます
 DISCORD_CHANNEL_ID = 0 # 通知やコマンドを受け付けるチャンネルのID (整数)
 
+# RCON (任意)
+# 設定すると /mc_backup 実行時に save-off / save-all flush でワールドを書き出してからスナップショットを取得します。
+# VM側の server.properties の rcon.password と同じ値を指定してください (Terraform の rcon_password 変数)。
+RCON_PASSWORD = ""
+RCON_PORT = 25575
+
 # GCPサービスアカウントキーのパスについて:
 # このBotは、まず環境変数 `DISCORD_BOT_GCP_CREDENTIALS` を参照します。
 # 次に環境変数 `GOOGLE_APPLICATION_CREDENTIALS` を参照します。
@@ -0,0 +1,154 @@
+# チャンネルにピン留めしたステータスダッシュボード (Embed 1件) の表示内容と更新制御
+# Discord に依存しない部分だけをここに置き、メッセージの送信・編集は bot.py の tasks.loop から行う。
+# - 状態の取得は refresh_seconds ごと (または poke() された直後の1回) に限り、閲覧者数に関係なく一定
+# - 表示内容が前回の送信と同じなら編集しない
+# - 編集はチャンネルごとのトークンバケットで間引き、429 を受けたら retry_after まで止める
+#   間引かれた更新は捨てずに保留し、次の tick で最新の内容だけを送る (更新の合流)
+import datetime
+import hashlib
+import json
+import time
+
+DASHBOARD_FOOTER = "minecraft-server dashboard"
+# Discord のメッセージ編集はチャンネルあたり 5回 / 5秒 程度のバケットなので、余裕を持たせる
+EDIT_BUCKET_CAPACITY = 3
+EDIT_BUCKET_PERIOD = 5.0
+
+_STATUS_COLORS = {
+    "RUNNING": 0x2ECC71,
+    "STAGING": 0xF1C40F,
+    "PROVISIONING": 0xF1C40F,
+    "STOPPING": 0xE67E22,
+    "SUSPENDING": 0xE67E22,
+    "TERMINATED": 0x95A5A6,
+    "SUSPENDED": 0x95A5A6,
+}
+_UNKNOWN_COLOR = 0xE74C3C
+
+
+class EditRateLimiter:
+    """チャンネル単位のトークンバケット。clock は time.monotonic 互換"""
+
+    def __init__(self, capacity=EDIT_BUCKET_CAPACITY, period=EDIT_BUCKET_PERIOD, clock=time.monotonic):
+        self._capacity = capacity
+        self._rate = capacity / period
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+        self._blocked_until = 0.0
+
+    def try_acquire(self):
+        now = self._clock()
+        if now < self._blocked_until:
+            return False
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def block(self, seconds):
+        """429 の retry_after などで、指定秒数は編集しない"""
+        self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+        self._tokens = 0.0
+
+
+def format_uptime(started_at, now):
+    """lastStartTimestamp (RFC3339) からの経過時間を分単位で返す (分未満は表示しないので毎分1回だけ変わる)"""
+    if not started_at:
+        return None
+    try:
+        started = datetime.datetime.fromisoformat(started_at)
+    except ValueError:
+        return None
+    minutes = max(0, int((now - started).total_seconds() // 60))
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}日 {hours}時間 {minutes}分"
+    if hours:
+        return f"{hours}時間 {minutes}分"
+    return f"{minutes}分"
+
+
+def render_dashboard(instance_name, state, stat, now):
+    """Embed の dict (discord.Embed.from_dict 形式) を返す
+
+    state: get_instance_state() の結果 (取得失敗時 None)
+    stat: mc_query.ServerStat (未起動・応答なしの場合 None)
+    """
+    status = (state or {}).get("status") or "UNKNOWN"
+    fields = [{"name": "状態", "value": f"`{status}`", "inline": True}]
+    if status == "RUNNING":
+        ip = state.get("ip")
+        fields.append({"name": "IPアドレス", "value": f"`{ip}`" if ip else "割り当て待ち", "inline": True})
+        uptime = format_uptime(state.get("started_at"), now)
+        if uptime:
+            fields.append({"name": "稼働時間", "value": uptime, "inline": True})
+        if stat is not None:
+            fields.append({"name": "プレイヤー", "value": f"{stat.numplayers}/{stat.maxplayers}", "inline": True})
+            fields.append({"name": "バージョン", "value": f"`{stat.version}`", "inline": True})
+            if stat.players:
+                # Embed フィールドの上限 (1024文字) に収める
+                names = ", ".join(f"`{name}`" for name in stat.players)
+                fields.append({"name": "参加中", "value": names[:1024], "inline": False})
+        elif ip:
+            fields.append({"name": "プレイヤー", "value": "Minecraftサーバーの応答待ち", "inline": True})
+    elif state is None:
+        fields.append({"name": "備考", "value": "状態を取得できませんでした", "inline": True})
+    return {
+        "title": f"Minecraftサーバー ({instance_name})",
+        "color": _STATUS_COLORS.get(status, _UNKNOWN_COLOR),
+        "fields": fields,
+        "footer": {"text": DASHBOARD_FOOTER},
+    }
+
+
+def fingerprint(embed):
+    return hashlib.sha1(json.dumps(embed, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class DashboardPanel:
+    """チャンネルごとのダッシュボードメッセージと、そこに最後に送った内容"""
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.message = None
+        self.sent_fingerprint = None
+        self.limiter = EditRateLimiter()
+
+
+class Dashboard:
+    def __init__(self, channel_ids, refresh_seconds=30.0, clock=time.monotonic):
+        self.panels = {channel_id: DashboardPanel(channel_id) for channel_id in channel_ids}
+        self._refresh_seconds = refresh_seconds
+        self._clock = clock
+        self._refreshed_at = None
+        self._poked = True
+        self.embed = None
+        self.fingerprint = None
+
+    def poke(self):
+        """状態が変わった可能性がある (起動・停止・コマンド実行) ので、次の tick で取り直す"""
+        self._poked = True
+
+    def refresh_due(self):
+        if self._poked or self._refreshed_at is None:
+            return True
+        return self._clock() - self._refreshed_at >= self._refresh_seconds
+
+    def update(self, embed):
+        self._poked = False
+        self._refreshed_at = self._clock()
+        self.embed = embed
+        self.fingerprint = fingerprint(embed)
+
+    def pending_panels(self):
+        """内容が前回の送信から変わっていて、今編集してよいパネル"""
+        if self.embed is None:
+            return []
+        return [
+            panel for panel in self.panels.values()
+            if panel.sent_fingerprint != self.fingerprint and panel.limiter.try_acquire()
+        ]
@@ -0,0 +1,72 @@
+# Discord Bot 用の非ブロッキング GCP Compute API アクセス層
+# googleapiclient の execute() は同期I/Oなので、専用の上限付きスレッドプールで実行し
+# イベントループ (ハートビートや他のインタラクション) を止めないようにする。
+# httplib2 はスレッドセーフではないため、Computeクライアントはスレッドごとに1つ持つ。
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient import discovery
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class ComputeClient:
+    """スレッドプール上で Compute API を呼び出す非同期ラッパー
+
+    使い方:
+        compute = ComputeClient(credentials)
+        instance = await compute.execute(
+            lambda s: s.instances().get(project=..., zone=..., instance=...))
+    """
+
+    def __init__(self, credentials, max_workers=DEFAULT_MAX_WORKERS, observer=None, service_factory=None):
+        self._credentials = credentials
+        # service_factory() を渡すとスレッドごとのクライアント生成を差し替えられる (ベンチマークのフェイク用)
+        self._service_factory = service_factory or self._build_service
+        # observer(method_id, elapsed_seconds, error) が execute() のたびに呼ばれる (計測用)
+        self._observer = observer
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcp")
+
+    def _service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = self._service_factory()
+        return service
+
+    def _build_service(self):
+        # 同梱の静的ディスカバリドキュメントを使うのでネットワーク取得は発生しない
+        return discovery.build(
+            "compute", "v1",
+            credentials=self._credentials,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+
+    async def run(self, func, *args):
+        """func(service, *args) をワーカースレッドで実行して結果を返す"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._service(), *args))
+
+    async def execute(self, build_request):
+        """build_request(service) が返す HttpRequest をワーカースレッドで execute() する"""
+        return await self.run(self._execute, build_request)
+
+    def _execute(self, service, build_request):
+        request = build_request(service)
+        if self._observer is None:
+            return request.execute()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            return request.execute()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._observer(getattr(request, "methodId", "unknown"), time.perf_counter() - started_at, error)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,91 @@
+# Bot 内のアイドル監視 (Cloud Scheduler → check-players の代わりに使える)
+# 観測結果 (インスタンスの状態とプレイヤー数) から、停止するかと次に観測するまでの秒数を決める。
+# - RUNNING で 0人: fast_seconds ごとに観測し、0人が required_zero_readings 回かつ idle_seconds 続いたら停止
+# - 少人数 (near_empty 人以下): fast_seconds の2倍
+# - それより多い: 観測のたびに間隔を倍にし、slow_seconds まで延ばす
+# - 起動中 (STAGING など) や Query 失敗: fast_seconds
+# - TERMINATED などの停止状態: 観測をやめる (next_interval は None)。起動時に Bot から再開する
+# 判定基準は cloud-function/player_history.should_stop と同じ (取得失敗を挟んだら連続とみなさない)。
+# Discord・GCP には依存しないので、観測と停止処理は bot.py の tasks.loop から行う。
+
+DEFAULT_FAST_SECONDS = 60.0
+DEFAULT_SLOW_SECONDS = 900.0
+DEFAULT_NEAR_EMPTY = 1
+DEFAULT_REQUIRED_ZERO_READINGS = 2
+DEFAULT_IDLE_SECONDS = 600.0
+# 起動APIの直後はまだ TERMINATED と返ることがあるので、再開からこの秒数は停止状態でも観測を続ける
+STARTING_GRACE_SECONDS = 180.0
+
+STOPPED_STATUSES = ("TERMINATED", "STOPPING", "SUSPENDED", "SUSPENDING")
+
+WAIT = "wait"
+STOP = "stop"
+PAUSE = "pause"
+
+
+class IdleMonitor:
+    def __init__(self, fast_seconds=DEFAULT_FAST_SECONDS, slow_seconds=DEFAULT_SLOW_SECONDS,
+                 near_empty=DEFAULT_NEAR_EMPTY, required_zero_readings=DEFAULT_REQUIRED_ZERO_READINGS,
+                 idle_seconds=DEFAULT_IDLE_SECONDS):
+        self.fast_seconds = fast_seconds
+        self.slow_seconds = slow_seconds
+        self.near_empty = near_empty
+        self.required_zero_readings = required_zero_readings
+        self.idle_seconds = idle_seconds
+        self.interval = fast_seconds
+        self.zero_readings = 0
+        self.zero_since = None
+        self.resumed_at = None
+        # 前回の停止前スナップショット以降にプレイヤーがいたか (不明な間は True)
+        self.players_seen = True
+
+    def reset(self):
+        """停止したときに呼び、観測を最初からやり直す"""
+        self.interval = self.fast_seconds
+        self.zero_readings = 0
+        self.zero_since = None
+        self.resumed_at = None
+
+    def resume(self, now):
+        """起動したとき・起動を検知したときに呼ぶ"""
+        self.reset()
+        self.resumed_at = now
+
+    def observe(self, status, count, now):
+        """(action, next_interval) を返す。count は Query の人数 (失敗は -1、RUNNING 以外は None)"""
+        if status in STOPPED_STATUSES:
+            if self.resumed_at is not None and now - self.resumed_at < STARTING_GRACE_SECONDS:
+                return WAIT, self.fast_seconds
+            self.reset()
+            return PAUSE, None
+        if status != "RUNNING" or count is None or count < 0:
+            # 起動途中・応答なしは連続0人の記録を途切れさせる
+            self.zero_readings = 0
+            self.zero_since = None
+            self.interval = self.fast_seconds
+            return WAIT, self.interval
+        if count > 0:
+            self.players_seen = True
+            self.zero_readings = 0
+            self.zero_since = None
+            if count <= self.near_empty:
+                self.interval = self.fast_seconds * 2
+            else:
+                self.interval = min(self.slow_seconds, max(self.interval, self.fast_seconds * 2) * 2)
+            return WAIT, self.interval
+        self.zero_readings += 1
+        if self.zero_since is None:
+            self.zero_since = now
+        self.interval = self.fast_seconds
+        if self.zero_readings >= self.required_zero_readings and now - self.zero_since >= self.idle_seconds:
+            return STOP, self.interval
+        return WAIT, self.interval
+
+    def take_snapshot(self, skip_unchanged=True):
+        """停止前スナップショットを作るか (前回以降にプレイヤーがいなければ省略できる)"""
+        return not skip_unchanged or self.players_seen
+
+    def stopped(self, snapshot_taken):
+        self.reset()
+        if snapshot_taken:
+            self.players_seen = False
@@ -0,0 +1,79 @@
+# 直近の往復時間 (RTT) のローリングウィンドウ
+# Prometheus のヒストグラム (/metrics) は起動時からの累積なので、/mc_status では直近 window_seconds の
+# 標本だけから分位点と簡易ヒストグラムを作り、プレイヤーから見た遅延の目安として表示する。
+import bisect
+import collections
+import time
+
+DEFAULT_WINDOW_SECONDS = 3600.0
+DEFAULT_MAX_SAMPLES = 512
+# 表示用のバケット境界 (ミリ秒)
+RTT_BUCKETS_MS = (10, 20, 50, 100, 200, 500)
+BAR_WIDTH = 16
+
+
+def percentile(ordered, fraction):
+    """昇順に並んだ標本の分位点 (最近傍法)"""
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class RttWindow:
+    def __init__(self, window_seconds=DEFAULT_WINDOW_SECONDS, max_samples=DEFAULT_MAX_SAMPLES, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._samples = collections.deque(maxlen=max_samples)  # (記録時刻, 秒)
+
+    def add(self, seconds):
+        self._samples.append((self._clock(), seconds))
+
+    def samples(self):
+        """期限内の標本 (秒) を古い順で返す"""
+        expires_at = self._clock() - self.window_seconds
+        while self._samples and self._samples[0][0] < expires_at:
+            self._samples.popleft()
+        return [seconds for _, seconds in self._samples]
+
+    def summary(self):
+        ordered = sorted(self.samples())
+        if not ordered:
+            return None
+        return {
+            "count": len(ordered),
+            "p50": percentile(ordered, 0.5),
+            "p90": percentile(ordered, 0.9),
+            "max": ordered[-1],
+        }
+
+    def histogram(self, buckets_ms=RTT_BUCKETS_MS):
+        """[(ラベル, 件数)]。最後のバケットは上限なし"""
+        counts = [0] * (len(buckets_ms) + 1)
+        for seconds in self.samples():
+            counts[bisect.bisect_left(buckets_ms, seconds * 1000)] += 1
+        labels = [f"<{buckets_ms[0]}ms"]
+        labels += [f"{low}-{high}ms" for low, high in zip(buckets_ms, buckets_ms[1:])]
+        labels.append(f"{buckets_ms[-1]}ms+")
+        return list(zip(labels, counts))
+
+
+def format_rtt_report(title, window):
+    """/mc_status に付ける RTT の要約とヒストグラム (標本がなければ None)
+
+    メッセージの文字数を抑えるため、ヒストグラムは標本のある最初と最後のバケットの間だけを出す。
+    """
+    summary = window.summary()
+    if summary is None:
+        return None
+    minutes = window.window_seconds / 60
+    lines = [f"{title} (直近{minutes:.0f}分, {summary['count']}回): "
+             f"p50 {summary['p50'] * 1000:.0f}ms / p90 {summary['p90'] * 1000:.0f}ms / 最大 {summary['max'] * 1000:.0f}ms"]
+    histogram = window.histogram()
+    used = [index for index, (_, count) in enumerate(histogram) if count]
+    histogram = histogram[used[0]:used[-1] + 1]
+    peak = max(count for _, count in histogram)
+    width = max(len(label) for label, _ in histogram)
+    rows = [f"{label:<{width}} |{'█' * round(BAR_WIDTH * count / peak):<{BAR_WIDTH}} {count}" for label, count in histogram]
+    lines.append("```\n" + "\n".join(rows) + "\n```")
+    return "\n".join(lines)
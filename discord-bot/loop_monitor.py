@@ -0,0 +1,137 @@
+# イベントループの遅延 (ラグ) の計測と、ループを止めた処理のスタックの記録
+# - サンプラー (ループ上のタスク): interval 秒ごとに起き、予定より遅れた秒数をラグとして記録する
+# - ウォッチドッグ (別スレッド): サンプラーが threshold 秒以上予定より遅れているのにループが戻ってこなければ、
+#   ループのスレッドのスタックを取り出す (= その時点でループを止めている処理)。ループが戻った時点で
+#   停止時間を確定し、on_stall(stall) を呼ぶ
+# - コマンド・ボタンの処理は track(name) の中で実行し、停止がどの処理の最中に起きたかと、処理ごとに
+#   ループが止まっていた合計秒数を記録する
+# Discord には依存しない。
+import asyncio
+import collections
+import contextlib
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+DEFAULT_INTERVAL = 0.25
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_HISTORY = 20
+# スタックとして残すフレーム数 (内側から)
+STACK_LIMIT = 30
+
+
+class Stall:
+    """ループが threshold 秒以上止まった1回分
+
+    started_at: 検知した時刻 (time.time())
+    duration: ループが止まっていた秒数 (ループが戻るまでは None)
+    stack: 検知した時点のループのスレッドのスタック (format_stack 形式の文字列のリスト)
+    handlers: 検知した時点で実行中だった処理の名前
+    """
+
+    __slots__ = ("started_at", "duration", "stack", "handlers", "_tokens")
+
+    def __init__(self, started_at, stack, handlers, tokens):
+        self.started_at = started_at
+        self.duration = None
+        self.stack = stack
+        self.handlers = handlers
+        self._tokens = tokens
+
+    def innermost(self):
+        """スタックの最も内側のフレーム (どこで止まっていたか) の1行目"""
+        return self.stack[-1].strip().splitlines()[0] if self.stack else "(スタックを取得できませんでした)"
+
+
+class LoopMonitor:
+    def __init__(self, interval=DEFAULT_INTERVAL, threshold=DEFAULT_THRESHOLD, history=DEFAULT_HISTORY,
+                 on_lag=None, on_stall=None):
+        self.interval = interval
+        self.threshold = threshold
+        self._on_lag = on_lag
+        self._on_stall = on_stall
+        self.stalls = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._tokens = itertools.count()
+        self._active = {}   # token -> 処理の名前
+        self._blocked = {}  # token -> ループが止まっていた合計秒数
+        self._current = None
+        self._expected_at = None
+        self._loop_thread = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """イベントループ上から呼ぶ"""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._expected_at = time.monotonic() + self.interval
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        threading.Thread(target=self._watch, daemon=True, name="loop-watchdog").start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self):
+        while True:
+            self._expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self._expected_at)
+            with self._lock:
+                stall, self._current = self._current, None
+                if stall is not None:
+                    stall.duration = lag
+                    for token in stall._tokens:
+                        if token in self._blocked:
+                            self._blocked[token] += lag
+            if self._on_lag is not None:
+                self._on_lag(lag)
+            if stall is not None:
+                self.stalls.append(stall)
+                if self._on_stall is not None:
+                    self._on_stall(stall)
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 4):
+            if time.monotonic() - self._expected_at < self.threshold:
+                continue
+            with self._lock:
+                if self._current is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                # サンプラーが起きる直前に読んだ場合に備えて、スタックを取った後にもう一度確かめる
+                if frame is None or time.monotonic() - self._expected_at < self.threshold:
+                    continue
+                stack = traceback.format_stack(frame, limit=STACK_LIMIT)
+                tokens = tuple(self._active)
+                self._current = Stall(time.time(), stack, tuple(self._active[t] for t in tokens), tokens)
+
+    @contextlib.contextmanager
+    def track(self, name):
+        """name の処理の実行中であることを記録する。with の値は終了時に blocked (止まっていた秒数) を持つ dict"""
+        token = next(self._tokens)
+        result = {"blocked": 0.0}
+        with self._lock:
+            self._active[token] = name
+            self._blocked[token] = 0.0
+        try:
+            yield result
+        finally:
+            with self._lock:
+                del self._active[token]
+                blocked = self._blocked.pop(token)
+                if self._current is not None and token in self._current._tokens:
+                    # ループが戻った直後でサンプラーがまだ停止時間を確定していない
+                    blocked += max(0.0, time.monotonic() - self._expected_at)
+                result["blocked"] = blocked
+
+    def active(self):
+        with self._lock:
+            return list(self._active.values())
@@ -0,0 +1,173 @@
+# Minecraft Server List Ping (1.7 以降の TCP handshake / status / ping) の asyncio クライアント
+# Query (UDP, enable-query=true が必要) が無効・遮断されていても、プレイヤーが接続するゲームポートで人数を取得できる。
+# - status 応答の JSON から online / max / sample / version / description を取り出して ServerStat にする
+#   (sample はサーバーが選んだ最大12人程度なので、全員の名前が入るとは限らない)
+# - status の後に ping / pong を1往復して、その時間を RTT (プレイヤーから見た遅延の目安) とする
+#
+# このファイルは cloud-function/ と discord-bot/ に同じ内容で置いている (デプロイ単位が別のため)
+import asyncio
+import contextlib
+import json
+import struct
+import time
+
+from mc_query import ServerStat
+
+# 状態確認だけの接続では、プロトコルバージョンを -1 にするのが慣例
+PROTOCOL_VERSION = -1
+NEXT_STATE_STATUS = 1
+PACKET_HANDSHAKE = 0x00
+PACKET_STATUS = 0x00
+PACKET_PING = 0x01
+# status 応答の上限 (favicon を含めても通常は数十KB)
+MAX_PACKET_SIZE = 1 << 21
+
+
+class PingError(Exception):
+    """Server List Ping の応答が不正な場合の例外"""
+
+
+class PingResult:
+    """status 応答の解析結果と計測値
+
+    latency: ping / pong の往復時間 (秒)。ping を省略した場合は None
+    elapsed: 接続開始から status 応答を受け取るまでの時間 (秒)
+    """
+
+    __slots__ = ("stat", "status", "latency", "elapsed")
+
+    def __init__(self, stat, status, latency, elapsed):
+        self.stat = stat
+        self.status = status
+        self.latency = latency
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        latency = "-" if self.latency is None else f"{self.latency * 1000:.1f}ms"
+        return f"PingResult({self.stat!r}, latency={latency})"
+
+
+def encode_varint(value):
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, pos=0):
+    """data[pos:] の VarInt を読み、(値, 次の位置) を返す"""
+    result = 0
+    for shift in range(0, 35, 7):
+        if pos >= len(data):
+            raise PingError("VarInt が途中で終わっています")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            if result & 0x80000000:
+                result -= 1 << 32
+            return result, pos
+    raise PingError("VarInt が長すぎます")
+
+
+def _packet(packet_id, payload=b""):
+    body = encode_varint(packet_id) + payload
+    return encode_varint(len(body)) + body
+
+
+def _string(value):
+    data = value.encode("utf-8")
+    return encode_varint(len(data)) + data
+
+
+async def _read_packet(reader):
+    length = 0
+    for shift in range(0, 35, 7):
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+    else:
+        raise PingError("パケット長の VarInt が長すぎます")
+    if length <= 0 or length > MAX_PACKET_SIZE:
+        raise PingError(f"パケット長が不正です: {length}")
+    data = await reader.readexactly(length)
+    packet_id, pos = decode_varint(data)
+    return packet_id, data[pos:]
+
+
+def _flatten_text(component):
+    """description (文字列またはチャットコンポーネント) を平文にする"""
+    if isinstance(component, str):
+        return component
+    if isinstance(component, list):
+        return "".join(_flatten_text(part) for part in component)
+    if isinstance(component, dict):
+        return str(component.get("text", "")) + "".join(_flatten_text(part) for part in component.get("extra", ()))
+    return ""
+
+
+def parse_status(status):
+    """status 応答の JSON (dict) を ServerStat にする"""
+    if not isinstance(status, dict):
+        raise PingError("status 応答が JSON オブジェクトではありません")
+    players = status.get("players")
+    if not isinstance(players, dict) or not isinstance(players.get("online"), int):
+        raise PingError("status 応答に players.online がありません")
+    names = tuple(
+        entry["name"] for entry in players.get("sample") or ()
+        if isinstance(entry, dict) and isinstance(entry.get("name"), str)
+    )
+    version = status.get("version")
+    return ServerStat(
+        motd=_flatten_text(status.get("description", "")),
+        version=version.get("name") if isinstance(version, dict) else None,
+        numplayers=players["online"],
+        maxplayers=players.get("max", -1) if isinstance(players.get("max"), int) else -1,
+        players=names,
+    )
+
+
+async def _server_list_ping(host, port, ping):
+    started_at = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        handshake = (encode_varint(PROTOCOL_VERSION) + _string(host) + struct.pack(">H", port)
+                     + encode_varint(NEXT_STATE_STATUS))
+        writer.write(_packet(PACKET_HANDSHAKE, handshake) + _packet(PACKET_STATUS))
+        await writer.drain()
+        packet_id, payload = await _read_packet(reader)
+        if packet_id != PACKET_STATUS:
+            raise PingError(f"status 応答のパケットIDが不正です: {packet_id}")
+        length, pos = decode_varint(payload)
+        try:
+            status = json.loads(payload[pos:pos + length].decode("utf-8"))
+        except ValueError as e:
+            raise PingError(f"status 応答の JSON を解析できません: {e}")
+        elapsed = time.perf_counter() - started_at
+        latency = None
+        if ping:
+            token = struct.pack(">q", time.time_ns() & 0x7FFFFFFFFFFFFFFF)
+            sent_at = time.perf_counter()
+            writer.write(_packet(PACKET_PING, token))
+            await writer.drain()
+            packet_id, payload = await _read_packet(reader)
+            if packet_id != PACKET_PING or payload[:8] != token:
+                raise PingError("pong 応答が不正です")
+            latency = time.perf_counter() - sent_at
+        return PingResult(parse_status(status), status, latency, elapsed)
+    finally:
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+
+
+async def server_list_ping(host, port=25565, timeout=5, ping=True):
+    """Server List Ping を行い PingResult を返す。接続から pong まで timeout 秒以内に終わらなければ TimeoutError"""
+    return await asyncio.wait_for(_server_list_ping(host, port, ping), timeout)
@@ -0,0 +1,264 @@
+# Minecraft Query (UDP) プロトコルの asyncio クライアント
+# - 1つのUDPソケットで複数サーバーへ同時に問い合わせる
+# - 応答はセッションIDで対応するリクエストに振り分ける
+# - チャレンジトークンは有効期間 (約30秒) 内であれば同じクライアント (= 同じ送信元ポート) の中で使い回す。
+#   効くのは Bot の query_client のように長く使うクライアントだけで、呼び出しごとにクライアントを作る
+#   query_server_stat / query_player_count (Cloud Function の人数確認) では毎回 handshake から始まる
+#
+# このファイルは cloud-function/ と discord-bot/ に同じ内容で置いている (デプロイ単位が別のため)
+import asyncio
+import itertools
+import struct
+import time
+
+QUERY_MAGIC = b"\xfe\xfd"
+TYPE_HANDSHAKE = 0x09
+TYPE_STAT = 0x00
+# Full statリクエストはトークンの後ろに4バイトのパディングを付ける
+FULL_STAT_PADDING = b"\x00\x00\x00\x00"
+
+# サーバー側のトークンは30秒ごとに更新されるため、余裕を持って短めにキャッシュする
+CHALLENGE_TOKEN_TTL = 25.0
+
+# Minecraftはセッションの各バイトの上位4bitを無視するため 0x0F0F0F0F でマスクする
+_session_ids = itertools.count(1)
+
+
+def _next_session_id():
+    # カウンタをそのままマスクすると16件ごとに同じIDになるので、下位16bitを各バイトの下位4bitに振り分ける
+    while True:
+        n = next(_session_ids) & 0xFFFF
+        if n:
+            return (n & 0xF) | (n >> 4 & 0xF) << 8 | (n >> 8 & 0xF) << 16 | (n >> 12 & 0xF) << 24
+
+
+class QueryError(Exception):
+    """Query応答が不正な場合の例外"""
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        # (packet_type, session_id) -> Future
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 5:
+            return
+        session_id = struct.unpack_from(">i", data, 1)[0]
+        future = self.pending.pop((data[0], session_id), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable など。どのリクエスト宛てか判別できないため、期限切れに任せる
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Queryソケットが閉じられました"))
+        self.pending.clear()
+
+
+class QueryClient:
+    """複数のMinecraftサーバーへ並行してQueryを送るクライアント
+
+    使い方:
+        async with QueryClient() as client:
+            data = await client.full_stat("203.0.113.10", 25565, timeout=5)
+    """
+
+    def __init__(self, token_ttl=CHALLENGE_TOKEN_TTL):
+        # (host, port) -> (token_bytes, expires_at)
+        # サーバーはトークンを送信元アドレスに結び付けるため、ソケットごと (= インスタンスごと) に持つ
+        self._token_cache = {}
+        self._token_ttl = token_ttl
+        self._protocol = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def open(self):
+        if self._protocol is None:
+            loop = asyncio.get_running_loop()
+            _, self._protocol = await loop.create_datagram_endpoint(
+                _QueryProtocol, local_addr=("0.0.0.0", 0)
+            )
+
+    def close(self):
+        if self._protocol is not None and self._protocol.transport is not None:
+            self._protocol.transport.close()
+        self._protocol = None
+        # 次に open() するソケットは送信元ポートが変わるので、これまでのトークンは使えない
+        self._token_cache.clear()
+
+    async def _request(self, host, port, packet_type, payload):
+        session_id = _next_session_id()
+        key = (packet_type, session_id)
+        future = asyncio.get_running_loop().create_future()
+        self._protocol.pending[key] = future
+        packet = QUERY_MAGIC + bytes([packet_type]) + struct.pack(">i", session_id) + payload
+        try:
+            self._protocol.transport.sendto(packet, (host, port))
+            return await future
+        finally:
+            self._protocol.pending.pop(key, None)
+
+    async def _challenge_token(self, host, port):
+        cached = self._token_cache.get((host, port))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        data = await self._request(host, port, TYPE_HANDSHAKE, b"")
+        end = data.find(b"\x00", 5)
+        if end == -1:
+            raise QueryError(f"handshake応答が不正です: {data!r}")
+        token = struct.pack(">i", int(data[5:end]))
+        self._token_cache[(host, port)] = (token, time.monotonic() + self._token_ttl)
+        return token
+
+    async def _full_stat(self, host, port):
+        token = await self._challenge_token(host, port)
+        return await self._request(host, port, TYPE_STAT, token + FULL_STAT_PADDING)
+
+    async def full_stat(self, host, port=25565, timeout=5):
+        """Full statの生データを返す。handshakeとstatを合わせて timeout 秒以内に終わらなければ TimeoutError
+
+        キャッシュ済みのトークンで timeout の半分までに応答がなければ、トークンが失効したとみなして
+        残りの時間で handshake からやり直す。
+        """
+        await self.open()
+        deadline = time.monotonic() + timeout
+        cached = self._token_cache.get((host, port))
+        if cached and cached[1] > time.monotonic():
+            try:
+                return await asyncio.wait_for(self._full_stat(host, port), timeout / 2)
+            except asyncio.TimeoutError:
+                self._token_cache.pop((host, port), None)
+        try:
+            return await asyncio.wait_for(self._full_stat(host, port), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._token_cache.pop((host, port), None)
+            raise
+
+    async def poll_many(self, targets, timeout=5):
+        """複数の (host, port) に並行して問い合わせ、{(host, port): 応答 or 例外} を返す
+
+        各ターゲットは個別に timeout 秒の期限を持つため、全体の所要時間は最も遅い1台分に収まる。
+        """
+        targets = list(targets)
+        results = await asyncio.gather(
+            *(self.full_stat(host, port, timeout) for host, port in targets),
+            return_exceptions=True,
+        )
+        return dict(zip(targets, results))
+
+
+class ServerStat:
+    """Full stat応答の解析結果"""
+
+    __slots__ = (
+        "motd", "gametype", "game_id", "version", "plugins", "map",
+        "numplayers", "maxplayers", "hostport", "hostip", "players",
+    )
+
+    def __init__(self, motd=None, gametype=None, game_id=None, version=None, plugins=None, map=None,
+                 numplayers=-1, maxplayers=-1, hostport=None, hostip=None, players=()):
+        self.motd = motd
+        self.gametype = gametype
+        self.game_id = game_id
+        self.version = version
+        self.plugins = plugins
+        self.map = map
+        self.numplayers = numplayers
+        self.maxplayers = maxplayers
+        self.hostport = hostport
+        self.hostip = hostip
+        self.players = players
+
+    def __repr__(self):
+        return (f"ServerStat(version={self.version!r}, map={self.map!r}, "
+                f"players={self.numplayers}/{self.maxplayers}, names={list(self.players)!r})")
+
+
+# K/V セクションのキー名 -> ServerStat の属性名
+_STAT_KEYS = {
+    "hostname": "motd",
+    "gametype": "gametype",
+    "game_id": "game_id",
+    "version": "version",
+    "plugins": "plugins",
+    "map": "map",
+    "hostport": "hostport",
+    "hostip": "hostip",
+}
+# type(1) + session_id(4) + "splitnum\x00\x80\x00" のパディング(11)
+_KV_SECTION_OFFSET = 5 + 11
+# K/V セクション (空のキーで終端) とプレイヤーセクションの間にある区切り
+_PLAYER_SECTION_MARKER = b"\x00\x00\x01player_\x00\x00"
+
+
+def parse_full_stat(data):
+    """Full stat応答を解析して ServerStat を返す
+
+    区切りの検索は元の bytes に対して行い、各セクションは memoryview のスライスから直接
+    1回だけデコードして str.split で分割する。split() 後に bytes を個別にデコードする方式と違い、
+    中間の bytes オブジェクトを作らない。
+    """
+    if len(data) < _KV_SECTION_OFFSET or data[0] != TYPE_STAT:
+        raise QueryError("Full stat応答が短すぎるか、タイプが不正です")
+    marker = data.find(_PLAYER_SECTION_MARKER, _KV_SECTION_OFFSET)
+    if marker == -1:
+        raise QueryError("プレイヤーセクションが見つかりません")
+    view = memoryview(data)
+    stat = ServerStat()
+
+    # K/V セクション: key\x00value\x00 ... (値は空のこともあるので区切りは交互に対応させる)
+    fields = str(view[_KV_SECTION_OFFSET:marker], "utf-8", "replace").split("\x00")
+    values = iter(fields)
+    for key, value in zip(values, values):
+        if key == "numplayers" or key == "maxplayers":
+            try:
+                setattr(stat, key, int(value))
+            except ValueError:
+                raise QueryError(f"{key} が数値ではありません")
+        else:
+            attr = _STAT_KEYS.get(key)
+            if attr is not None:
+                setattr(stat, attr, value)
+
+    # プレイヤーセクション: name\x00 ... が空の名前 (\x00\x00) で終わる。名前は空にならない
+    pos = marker + len(_PLAYER_SECTION_MARKER)
+    if pos < len(data) and data[pos] != 0:
+        players_end = data.find(b"\x00\x00", pos)
+        if players_end == -1:
+            players_end = len(data)
+        stat.players = tuple(str(view[pos:players_end], "utf-8", "replace").split("\x00"))
+    return stat
+
+
+def parse_player_count(data):
+    """Full stat応答から numplayers を取り出す。解析できなければ -1"""
+    try:
+        return parse_full_stat(data).numplayers
+    except QueryError:
+        return -1
+
+
+async def query_server_stat(ip, port=25565, timeout=5):
+    # 呼び出しごとに新しいソケットを使うため、トークンのキャッシュは使われない
+    async with QueryClient() as client:
+        return parse_full_stat(await client.full_stat(ip, port, timeout))
+
+
+async def query_player_count(ip, port=25565, timeout=5):
+    # query_server_stat と同じく、トークンのキャッシュは使われない
+    async with QueryClient() as client:
+        return parse_player_count(await client.full_stat(ip, port, timeout))
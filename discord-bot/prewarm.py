@@ -0,0 +1,185 @@
+# 利用履歴からの予測プリウォーム
+# 起動要求 (/mc_start・ボタン) と、プレイヤーが1人以上いた観測を「曜日×時刻」の枠 (既定15分) ごとに記録し、
+# 週単位で減衰させたスコアから「この枠に遊ばれる確率」を見積もる。
+# 確率が閾値を超える枠の少し前 (起動にかかる時間ぶん) に停止中なら先に起動しておく。
+#
+# プリウォームが当たったか (起動後の一定時間内に起動要求かプレイヤーが来たか) と、
+# それで省けた待ち時間 (起動からプレイ可能になるまでのうち、利用者が来る前に済んでいた分) も集計する。
+#
+# モデルは 672 枠 (15分 × 7日) の float と最終観測週だけなので、JSON 1ファイル (ローカルまたは GCS、state_store.py) に保存する。
+import time
+
+import state_store
+
+SLOT_MINUTES = 15
+SLOTS_PER_WEEK = 7 * 24 * 60 // SLOT_MINUTES
+WEEK_SECONDS = 7 * 24 * 3600
+# 1週ごとにスコアに掛ける係数 (古い習慣ほど効きを弱める)
+WEEKLY_DECAY = 0.8
+# 予測を始めるのに必要な観測量 (減衰後の週数)
+MIN_WEEKS = 2.0
+# 1970-01-01 は木曜なので、月曜 00:00 (UTC) 起点にずらす
+_EPOCH_OFFSET = 3 * 24 * 3600
+
+
+def week_index(ts):
+    return int((ts + _EPOCH_OFFSET) // WEEK_SECONDS)
+
+
+def slot_index(ts, utc_offset=0):
+    """ts (UNIX秒) が属する曜日×時刻の枠番号。utc_offset でローカル時刻の週に合わせる"""
+    return int((ts + _EPOCH_OFFSET + utc_offset) % WEEK_SECONDS // (SLOT_MINUTES * 60))
+
+
+class ActivityModel:
+    def __init__(self, utc_offset=0):
+        self.utc_offset = utc_offset
+        self.scores = [0.0] * SLOTS_PER_WEEK
+        # 各枠を最後に数えた週 (同じ週の同じ枠は1回だけ数える)
+        self.marked_week = [-1] * SLOTS_PER_WEEK
+        # 減衰後の観測週数 (確率の分母)
+        self.weeks = 0.0
+        self.current_week = None
+
+    def _advance(self, ts):
+        week = week_index(ts)
+        if self.current_week is None:
+            self.current_week = week
+            self.weeks = 1.0
+            return
+        elapsed = week - self.current_week
+        if elapsed > 0:
+            factor = WEEKLY_DECAY ** elapsed
+            self.scores = [score * factor for score in self.scores]
+            self.weeks = self.weeks * factor + sum(WEEKLY_DECAY ** k for k in range(elapsed))
+            self.current_week = week
+
+    def record(self, ts):
+        """ts の枠で利用があったことを記録する。新しく数えたら True"""
+        self._advance(ts)
+        slot = slot_index(ts, self.utc_offset)
+        if self.marked_week[slot] == self.current_week:
+            return False
+        self.marked_week[slot] = self.current_week
+        self.scores[slot] += 1.0
+        return True
+
+    def probability(self, ts):
+        if self.weeks < MIN_WEEKS:
+            return 0.0
+        return min(1.0, self.scores[slot_index(ts, self.utc_offset)] / self.weeks)
+
+    def next_active_slot(self, now, lead_seconds, threshold):
+        """now から lead_seconds 後までに始まる枠のうち、確率が threshold 以上の最初の枠の開始時刻"""
+        slot_seconds = SLOT_MINUTES * 60
+        start = now - (now + self.utc_offset) % slot_seconds + slot_seconds
+        ts = start
+        while ts <= now + lead_seconds:
+            if self.probability(ts) >= threshold:
+                return ts
+            ts += slot_seconds
+        return None
+
+    def to_dict(self):
+        return {
+            "slot_minutes": SLOT_MINUTES,
+            "scores": [round(score, 4) for score in self.scores],
+            "marked_week": self.marked_week,
+            "weeks": self.weeks,
+            "current_week": self.current_week,
+        }
+
+    def load_dict(self, data):
+        if data.get("slot_minutes") != SLOT_MINUTES or len(data.get("scores", [])) != SLOTS_PER_WEEK:
+            return
+        self.scores = [float(score) for score in data["scores"]]
+        self.marked_week = [int(week) for week in data["marked_week"]]
+        self.weeks = float(data["weeks"])
+        self.current_week = data["current_week"]
+
+
+class PrewarmTracker:
+    """プリウォームの当たり外れと省けた待ち時間を集計する"""
+
+    def __init__(self, hit_window):
+        self.hit_window = hit_window
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.pending = None  # {"started_at", "slot", "ready_after"}
+        # 最後にプリウォームした枠 (外れた枠で何度も起動しないようにする)
+        self.last_slot = None
+
+    def started(self, ts, slot_ts):
+        self.pending = {"started_at": ts, "slot": slot_ts, "ready_after": None}
+        self.last_slot = slot_ts
+
+    def ready(self, time_to_playable):
+        if self.pending is not None:
+            self.pending["ready_after"] = time_to_playable
+
+    def activity(self, ts):
+        """起動要求またはプレイヤーを観測した。プリウォーム中なら当たりとして省けた秒数を返す"""
+        pending = self.pending
+        if pending is None or ts > pending["started_at"] + self.hit_window:
+            return None
+        self.pending = None
+        waited = ts - pending["started_at"]
+        boot = pending["ready_after"]
+        # プレイ可能になる前に来た場合は、それまでに進んでいた分だけ待ち時間が減っている
+        saved = waited if boot is None else min(boot, waited)
+        self.hits += 1
+        self.saved_seconds += saved
+        return saved
+
+    def expire(self, ts, stopped=False):
+        """停止された、または当たり判定の時間を過ぎたプリウォームを外れとして確定する"""
+        pending = self.pending
+        if pending is not None and (stopped or ts > pending["started_at"] + self.hit_window):
+            self.pending = None
+            self.misses += 1
+            return True
+        return False
+
+    def summary(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "precision": self.hits / total if total else None,
+            "saved_seconds": self.saved_seconds,
+            "pending": self.pending is not None,
+        }
+
+    def to_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "saved_seconds": self.saved_seconds,
+                "pending": self.pending, "last_slot": self.last_slot}
+
+    def load_dict(self, data):
+        self.hits = int(data.get("hits", 0))
+        self.misses = int(data.get("misses", 0))
+        self.saved_seconds = float(data.get("saved_seconds", 0.0))
+        self.pending = data.get("pending")
+        self.last_slot = data.get("last_slot")
+
+
+def load_state(path, model, tracker):
+    """path はローカルファイルか gs://バケット/オブジェクト名"""
+    if not path:
+        return
+    try:
+        data = state_store.read_json(path)
+    except (OSError, ValueError) as e:
+        print(f"利用履歴モデルの読み込みに失敗: {e}")
+        return
+    if data is None:
+        return
+    model.load_dict(data.get("model", {}))
+    tracker.load_dict(data.get("prewarm", {}))
+
+
+def save_state(path, model, tracker):
+    if not path:
+        return
+    state_store.write_json_later(
+        path, {"saved_at": time.time(), "model": model.to_dict(), "prewarm": tracker.to_dict()}, "利用履歴モデル")
@@ -0,0 +1,89 @@
+# サーバー起動後の準備完了 (プレイ可能) 判定パイプライン
+# 段階: RUNNING になるまで待つ → 外部IPが割り当てられるまで待つ → Minecraftポートが応答するまで待つ
+# 各段階の到達時刻を記録し、起動ごとの "プレイ可能になるまでの時間" を残す
+import asyncio
+import json
+import time
+
+STAGE_RUNNING = "running"
+STAGE_IP = "ip"
+STAGE_PLAYABLE = "playable"
+
+
+async def wait_until_playable(get_state, probe, on_stage=None, timeout=600, poll_interval=3, sleep=None):
+    """インスタンスがプレイ可能になるまで待つ
+
+    get_state: 最新の {"status", "ip", ...} を返すコルーチン関数
+    probe: probe(ip) が True を返せばサーバーが応答している
+    on_stage: on_stage(stage, elapsed, state) 段階到達ごとに呼ばれるコルーチン関数 (メッセージ更新用)
+
+    戻り値: {"ready": bool, "ip": str|None, "stages": {stage: 経過秒}, "elapsed": 経過秒, "error": str|None}
+    """
+    sleep = sleep or asyncio.sleep
+    started_at = time.monotonic()
+    stages = {}
+    ip = None
+    error = None
+
+    async def reach(stage, state):
+        if stage in stages:
+            return
+        stages[stage] = time.monotonic() - started_at
+        if on_stage is not None:
+            try:
+                await on_stage(stage, stages[stage], state)
+            except Exception as e:
+                # 通知の失敗で判定自体は止めない
+                print(f"起動状況の通知に失敗: {e}")
+
+    while time.monotonic() - started_at < timeout:
+        try:
+            state = await get_state()
+        except Exception as e:
+            print(f"起動待ち中のインスタンス状態取得でエラー: {e}")
+            state = None
+        if state:
+            status = state.get("status")
+            if status in ("STOPPING", "TERMINATED", "SUSPENDED") and STAGE_RUNNING in stages:
+                error = f"起動中にインスタンスが {status} になりました"
+                break
+            if status == "RUNNING":
+                await reach(STAGE_RUNNING, state)
+                if state.get("ip"):
+                    ip = state["ip"]
+                    await reach(STAGE_IP, state)
+                    if await probe(ip):
+                        await reach(STAGE_PLAYABLE, state)
+                        break
+        await sleep(poll_interval)
+    else:
+        error = f"{timeout}秒以内にサーバーが応答しませんでした"
+
+    return {
+        "ready": STAGE_PLAYABLE in stages,
+        "ip": ip,
+        "stages": stages,
+        "elapsed": time.monotonic() - started_at,
+        "error": error,
+    }
+
+
+def record_boot(result, instance_name, path=None):
+    """起動ごとの計測結果を1行のJSONとして出力し、path があれば追記する"""
+    record = {
+        "instance": instance_name,
+        "started_at": time.time() - result["elapsed"],
+        "ready": result["ready"],
+        "time_to_playable": result["stages"].get(STAGE_PLAYABLE),
+        "stages": {stage: round(elapsed, 2) for stage, elapsed in result["stages"].items()},
+        "error": result["error"],
+    }
+    line = json.dumps(record, ensure_ascii=False)
+    print(f"起動計測: {line}")
+    if path:
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"起動計測の保存に失敗: {e}")
+    return record
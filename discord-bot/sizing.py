@@ -0,0 +1,189 @@
+# 見込みのプレイヤー数に応じたマシンタイプの選択と、マシンタイプごとの性能・費用の集計
+# - サイズ表 (MachineSize のリスト) は「マシンタイプ:最大人数:ヒープMB:1時間あたりの料金」をカンマでつないだ文字列で指定する
+#   例: "e2-medium:3:2560:0.0335,e2-standard-2:8:7168:0.067,e2-standard-4:20:14336:0.134"
+#   見込み人数を収容できる最小のサイズを選び、どれにも収まらなければ最大のサイズにする
+# - 見込み人数を指定されなければ、記録したセッションの最大人数から推定する:
+#   同じ曜日・時刻帯 (前後 SIMILAR_HOURS 時間) のセッションが MIN_SIMILAR_SESSIONS 回以上あればその最大、
+#   なければ全セッションの最大人数の90パーセンタイル、記録がなければ推定しない (マシンタイプを変えない)
+# - セッションは VM の起動エージェントの報告 (boot → heartbeat/players → exit) から作り、
+#   マシンタイプごとに稼働時間・最大人数・mspt (1tickの平均処理時間) を集計してサイズ表の調整に使う
+# Discord・GCP には依存しない。状態は JSON 1ファイル (ローカルまたは GCS、state_store.py) に保存する。
+import time
+
+import state_store
+from latency import percentile
+from prewarm import WEEK_SECONDS
+
+DEFAULT_SIZES = "e2-medium:3:2560:0.0335,e2-standard-2:8:7168:0.067,e2-standard-4:20:14336:0.134,e2-standard-8:40:29696:0.268"
+MAX_SESSIONS = 200
+SIMILAR_HOURS = 2
+MIN_SIMILAR_SESSIONS = 2
+# マシンタイプごとに保持する mspt の標本数
+MAX_MSPT_SAMPLES = 500
+# mspt がこれを超えると tick が遅れ始める (20tick/秒)
+TICK_BUDGET_MS = 50.0
+
+
+class MachineSize:
+    __slots__ = ("machine_type", "max_players", "heap_mb", "hourly_cost")
+
+    def __init__(self, machine_type, max_players, heap_mb, hourly_cost):
+        self.machine_type = machine_type
+        self.max_players = max_players
+        self.heap_mb = heap_mb
+        self.hourly_cost = hourly_cost
+
+    def __repr__(self):
+        return f"MachineSize({self.machine_type}, players<={self.max_players}, heap={self.heap_mb}MB)"
+
+
+def parse_sizes(text):
+    """サイズ表の文字列を最大人数の昇順の MachineSize のリストにする。不正なら ValueError"""
+    sizes = []
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        if len(parts) != 4:
+            raise ValueError(f"サイズの指定が不正です (マシンタイプ:最大人数:ヒープMB:料金): {item!r}")
+        sizes.append(MachineSize(parts[0], int(parts[1]), int(parts[2]), float(parts[3])))
+    if not sizes:
+        raise ValueError("サイズ表が空です")
+    return sorted(sizes, key=lambda size: size.max_players)
+
+
+def choose_size(sizes, expected_players):
+    """expected_players 人を収容できる最小のサイズ"""
+    for size in sizes:
+        if expected_players <= size.max_players:
+            return size
+    return sizes[-1]
+
+
+def find_size(sizes, machine_type):
+    return next((size for size in sizes if size.machine_type == machine_type), None)
+
+
+class SizingHistory:
+    def __init__(self):
+        self.sessions = []  # {"started_at", "ended_at", "machine_type", "peak"} (古い順)
+        self.current = None
+        self.mspt = {}      # マシンタイプ -> mspt の標本 (新しいものを後ろに)
+
+    # --- セッションの記録 ---
+    def started(self, ts, machine_type):
+        if self.current is not None:
+            self.ended(ts)
+        self.current = {"started_at": ts, "ended_at": None, "machine_type": machine_type or "unknown", "peak": 0}
+
+    def observe(self, ts, count, mspt=None):
+        """プレイヤー数 (と mspt) の報告。セッション中でなければ起動の報告を取りこぼしたとみなして始める"""
+        if self.current is None:
+            self.started(ts, None)
+        self.current["peak"] = max(self.current["peak"], count)
+        if mspt is not None:
+            samples = self.mspt.setdefault(self.current["machine_type"], [])
+            samples.append(mspt)
+            del samples[:-MAX_MSPT_SAMPLES]
+
+    def ended(self, ts):
+        """セッションが終わった。記録したら True"""
+        if self.current is None:
+            return False
+        self.current["ended_at"] = ts
+        self.sessions.append(self.current)
+        del self.sessions[:-MAX_SESSIONS]
+        self.current = None
+        return True
+
+    # --- 推定と集計 ---
+    def estimate(self, now):
+        """now に始めるセッションの見込み人数 (記録がなければ None)"""
+        if not self.sessions:
+            return None
+        similar = []
+        for session in self.sessions:
+            # 週の中での時刻の差 (曜日・時刻が近いか)
+            distance = (now - session["started_at"]) % WEEK_SECONDS
+            if min(distance, WEEK_SECONDS - distance) <= SIMILAR_HOURS * 3600:
+                similar.append(session["peak"])
+        if len(similar) >= MIN_SIMILAR_SESSIONS:
+            return max(similar)
+        return percentile(sorted(session["peak"] for session in self.sessions), 0.9)
+
+    def report(self, sizes, now=None):
+        """マシンタイプごとの集計 [{machine_type, sessions, hours, cost, peak, mspt_p50, mspt_p95, mspt_max}]"""
+        now = time.time() if now is None else now
+        sessions = self.sessions + ([dict(self.current, ended_at=now)] if self.current else [])
+        rows = {}
+        for session in sessions:
+            row = rows.setdefault(session["machine_type"], {"sessions": 0, "hours": 0.0, "peak": 0})
+            row["sessions"] += 1
+            row["hours"] += max(0.0, session["ended_at"] - session["started_at"]) / 3600
+            row["peak"] = max(row["peak"], session["peak"])
+        result = []
+        for machine_type in sorted(set(rows) | set(self.mspt)):
+            row = rows.get(machine_type, {"sessions": 0, "hours": 0.0, "peak": 0})
+            size = find_size(sizes, machine_type)
+            ordered = sorted(self.mspt.get(machine_type, ()))
+            result.append({
+                "machine_type": machine_type,
+                "sessions": row["sessions"],
+                "hours": row["hours"],
+                "cost": None if size is None else row["hours"] * size.hourly_cost,
+                "peak": row["peak"],
+                "mspt_p50": percentile(ordered, 0.5),
+                "mspt_p95": percentile(ordered, 0.95),
+                "mspt_max": ordered[-1] if ordered else None,
+            })
+        return result
+
+    def to_dict(self):
+        return {"sessions": self.sessions, "current": self.current, "mspt": self.mspt}
+
+    def load_dict(self, data):
+        self.sessions = list(data.get("sessions", []))[-MAX_SESSIONS:]
+        self.current = data.get("current")
+        self.mspt = {key: list(values)[-MAX_MSPT_SAMPLES:] for key, values in data.get("mspt", {}).items()}
+
+
+def load_state(path, history):
+    """path はローカルファイルか gs://バケット/オブジェクト名"""
+    if not path:
+        return
+    try:
+        data = state_store.read_json(path)
+    except (OSError, ValueError) as e:
+        print(f"マシンタイプの記録の読み込みに失敗: {e}")
+        return
+    if data is not None:
+        history.load_dict(data)
+
+
+def save_state(path, history):
+    if not path:
+        return
+    state_store.write_json_later(path, {"saved_at": time.time(), **history.to_dict()}, "マシンタイプの記録")
+
+
+def format_report(rows, sizes):
+    """/mc_sizing の本文"""
+    lines = ["サイズ表: " + ", ".join(
+        f"`{size.machine_type}` ({size.max_players}人まで, ヒープ{size.heap_mb}MB, ${size.hourly_cost}/時)" for size in sizes)]
+    if not rows:
+        lines.append("まだセッションの記録がありません。")
+        return "\n".join(lines)
+    table = []
+    for row in rows:
+        mspt = ("-" if row["mspt_p50"] is None else
+                f"{row['mspt_p50']:.1f}/{row['mspt_p95']:.1f}/{row['mspt_max']:.1f}ms")
+        cost = "-" if row["cost"] is None else f"${row['cost']:.2f}"
+        table.append(f"{row['machine_type']:<15} {row['sessions']:>3}回 {row['hours']:6.1f}時間 最大{row['peak']:>3}人 "
+                     f"mspt {mspt:<18} {cost}")
+    lines.append("マシンタイプごとの実績 (mspt は p50/p95/最大):\n```\n" + "\n".join(table) + "\n```")
+    slow = [row["machine_type"] for row in rows if row["mspt_p95"] is not None and row["mspt_p95"] > TICK_BUDGET_MS * 0.8]
+    if slow:
+        lines.append(f"⚠️ mspt の p95 が {TICK_BUDGET_MS * 0.8:.0f}ms を超えています (tick が遅れかけています): "
+                     + ", ".join(f"`{name}`" for name in slow))
+    return "\n".join(lines)
@@ -0,0 +1,64 @@
+# Bot の状態ファイル (JSON) の読み書き
+# パスはローカルファイルか gs://バケット/オブジェクト名。Cloud Run のファイルシステムはインスタンスの
+# 入れ替えで消えるため、利用履歴モデルなど長く育てる状態は GCS に置く。
+# 保存はイベントループを止めないよう、呼び出し時点の内容を文字列にしてから専用スレッド1本で順に書き込む。
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+_gcs_client = None
+
+
+def _gcs_blob(path):
+    global _gcs_client
+    from google.cloud import storage
+    if _gcs_client is None:
+        _gcs_client = storage.Client()
+    bucket_name, _, blob_name = path[len("gs://"):].partition("/")
+    return _gcs_client.bucket(bucket_name).blob(blob_name)
+
+
+def read_json(path):
+    """path の JSON を読む。存在しなければ None、読めなければ OSError / ValueError"""
+    if path.startswith("gs://"):
+        from google.api_core.exceptions import GoogleAPIError, NotFound
+        try:
+            text = _gcs_blob(path).download_as_text()
+        except NotFound:
+            return None
+        except GoogleAPIError as e:
+            raise OSError(f"{path} の読み込みに失敗: {e}") from e
+        return json.loads(text)
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_text(path, text):
+    if path.startswith("gs://"):
+        from google.api_core.exceptions import GoogleAPIError
+        try:
+            _gcs_blob(path).upload_from_string(text, content_type="application/json")
+        except GoogleAPIError as e:
+            raise OSError(f"{path} への保存に失敗: {e}") from e
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json_later(path, data, label):
+    """data をこの時点の内容で JSON にし、書き込みはバックグラウンドで行う (失敗は label を付けて出力する)"""
+    text = json.dumps(data)
+
+    def write():
+        try:
+            _write_text(path, text)
+        except OSError as e:
+            print(f"{label}の保存に失敗: {e}")
+
+    _writer.submit(write)
@@ -0,0 +1,121 @@
+# VM停止Webhookの非同期取り込み
+# HTTPハンドラは submit() でイベントを上限付きキューに入れてすぐに応答し、
+# 1つのディスパッチャタスクが短い待ち時間内に届いたイベントをまとめて1通のメッセージとして送る。
+# - 同じインスタンスの停止イベントはまとめ待ちの間だけでなく、送信後 dedupe_ttl 秒間も重複として捨てる
+#   (Cloud Function / スケジューラの再試行による連投を防ぐ)
+# - 起動したインスタンスは forget() で重複判定から外し、次の停止を確実に通知する
+import asyncio
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_COALESCE_SECONDS = 2.0
+DEFAULT_DEDUPE_TTL = 300.0
+# 送信に失敗したまとまりを再送する回数と間隔 (秒)。Webhookには受付時点で応答済みなので、ここで再試行する
+SEND_RETRIES = 2
+RETRY_DELAY = 5.0
+
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+DROPPED = "dropped"
+
+
+class StopEventDispatcher:
+    """使い方:
+        dispatcher = StopEventDispatcher(send)   # send(events) -> bool (コルーチン)
+        dispatcher.start()
+        outcome = dispatcher.submit({"instance": "mc-1", "zone": "asia-northeast1-b"})
+    """
+
+    def __init__(self, send, maxsize=DEFAULT_QUEUE_SIZE, coalesce_seconds=DEFAULT_COALESCE_SECONDS,
+                 dedupe_ttl=DEFAULT_DEDUPE_TTL, on_sent=None):
+        self._send = send
+        # on_sent(events, success) は送信のたびに呼ばれる (計測用)
+        self._on_sent = on_sent
+        self._queue = asyncio.Queue(maxsize)
+        self._coalesce_seconds = coalesce_seconds
+        self._dedupe_ttl = dedupe_ttl
+        self._pending = set()  # キュー内またはまとめ待ちのインスタンス
+        self._notified = {}  # インスタンス -> 通知済みとみなす期限 (loop.time())
+        self._task = None
+
+    @staticmethod
+    def _key(event):
+        return event.get("zone"), event.get("instance")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="webhook-dispatcher")
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def submit(self, event):
+        """イベントをキューに入れる。ブロックせず QUEUED / DUPLICATE / DROPPED を返す"""
+        key = self._key(event)
+        expires_at = self._notified.get(key)
+        if key in self._pending or (expires_at is not None and expires_at > asyncio.get_running_loop().time()):
+            return DUPLICATE
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            return DROPPED
+        self._pending.add(key)
+        return QUEUED
+
+    def forget(self, zone, instance):
+        """インスタンスを起動したときに呼び、次の停止イベントを重複扱いしないようにする"""
+        self._notified.pop((zone, instance), None)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def _collect(self):
+        events = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        end_at = loop.time() + self._coalesce_seconds
+        while True:
+            remaining = end_at - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                events.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return events
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            events = await self._collect()
+            success = False
+            for attempt in range(SEND_RETRIES + 1):
+                if attempt:
+                    await asyncio.sleep(RETRY_DELAY * attempt)
+                try:
+                    success = await self._send(events)
+                except Exception as e:
+                    print(f"VM停止通知の送信中に例外が発生しました ({attempt + 1}回目): {e}")
+                    success = False
+                if success:
+                    break
+            now = loop.time()
+            for event in events:
+                key = self._key(event)
+                self._pending.discard(key)
+                if success:
+                    self._notified[key] = now + self._dedupe_ttl
+            # 期限切れのエントリを掃除する
+            for key in [key for key, expires_at in self._notified.items() if expires_at <= now]:
+                del self._notified[key]
+            if self._on_sent is not None:
+                # コールバックの例外でディスパッチャのタスクごと止まらないようにする
+                try:
+                    self._on_sent(events, success)
+                except Exception as e:
+                    print(f"VM停止通知の送信後処理で例外が発生しました: {e}")
@@ -34,6 +34,29 @@ resource "google_compute_instance" "minecraft" {
 
   metadata_startup_script = file("${path.module}/startup.sh")
 
+  metadata = {
+    rcon-password = var.rcon_password
+    // startup.sh が取り出して systemd サービスとして起動する起動エージェント
+    boot-agent = file("${path.module}/vm-agent/boot_agent.py")
+    // 起動エージェントがプレイヤー数の変化を送る先
+    bot-webhook-url    = "${google_cloud_run_v2_service.discord_bot_service.uri}/webhook/players"
+    bot-webhook-secret = random_password.webhook_secret.result
+    // ワールドの増分バックアップ (起動エージェントが import する)
+    world-backup     = file("${path.module}/vm-agent/world_backup.py")
+    world-backup-uri = "gs://${google_storage_bucket.world_backup.name}/${var.instance_name}"
+  }
+
+  lifecycle {
+    // バックアップの依頼 (/mc_backup method:world) と復元の指定、マシンタイプとヒープサイズ (bot_machine_sizing) は
+    // Bot や手動で書き換えるので差分にしない
+    ignore_changes = [
+      machine_type,
+      metadata["world-backup-request"],
+      metadata["world-restore"],
+      metadata["java-heap-mb"],
+    ]
+  }
+
   service_account {
     email  = google_service_account.minecraft_sa.email
     scopes = [
@@ -44,6 +67,19 @@ resource "google_compute_instance" "minecraft" {
   tags = ["minecraft-server"]
 }
 
+// ワールドの増分バックアップの保存先 (チャンク単位の重複排除済みオブジェクトとマニフェスト)
+resource "google_storage_bucket" "world_backup" {
+  name     = "${var.project_id}-minecraft-world-backup"
+  location = var.region
+  uniform_bucket_level_access = true
+}
+
+resource "google_storage_bucket_iam_member" "world_backup_vm" {
+  bucket = google_storage_bucket.world_backup.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.minecraft_sa.email}"
+}
+
 // ファイアウォール（25565ポート開放）
 resource "google_compute_firewall" "minecraft" {
   name    = "allow-minecraft"
@@ -62,6 +98,29 @@ resource "google_compute_firewall" "minecraft" {
   source_ranges = ["0.0.0.0/0"]
 }
 
+// ファイアウォール（RCON用 25575ポート、rcon_password と rcon_source_ranges の両方を設定した時のみ）
+// RCON はパスワードだけで保護されるため、既定ではインターネットに公開しない
+resource "google_compute_firewall" "minecraft_rcon" {
+  count   = var.rcon_password != "" && length(var.rcon_source_ranges) > 0 ? 1 : 0
+  name    = "allow-minecraft-rcon"
+  network = "default"
+
+  allow {
+    protocol = "tcp"
+    ports    = ["25575"]
+  }
+
+  target_tags   = ["minecraft-server"]
+  source_ranges = var.rcon_source_ranges
+}
+
+// Bot の Webhook と check-players の ?idle_confirmed=1 を認証する共有シークレット
+// (VM のエージェント・check-players・Bot に同じ値を渡す)
+resource "random_password" "webhook_secret" {
+  length  = 32
+  special = false
+}
+
 // Cloud Function用サービスアカウント
 resource "google_service_account" "function_sa" {
   account_id   = "minecraft-function-sa"
@@ -117,18 +176,38 @@ resource "google_cloudfunctions_function" "check_players" {
     GCE_INSTANCE_NAME        = var.instance_name
     GCP_PROJECT              = var.project_id
     DISCORD_BOT_WEBHOOK_URL  = "${google_cloud_run_v2_service.discord_bot_service.uri}/webhook/vm-stopped"
+    RCON_PASSWORD            = var.rcon_password
+    PLAYER_HISTORY_URI       = "gs://${google_storage_bucket.player_history.name}"
+    WEBHOOK_SECRET           = random_password.webhook_secret.result
   }
   depends_on = [
     google_cloud_run_v2_service.discord_bot_service
   ]
 }
 
-// Cloud Schedulerジョブ（5分ごと）
+// 停止判定のプレイヤー数履歴 (コールドスタートをまたいで残すため、関数のローカルディスクではなく GCS に置く)
+resource "google_storage_bucket" "player_history" {
+  name     = "${var.project_id}-minecraft-player-history"
+  location = var.region
+  uniform_bucket_level_access = true
+}
+
+resource "google_storage_bucket_iam_member" "player_history_function" {
+  bucket = google_storage_bucket.player_history.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.function_sa.email}"
+}
+
+// Cloud Schedulerジョブ（15分ごと）
+// 通常の停止判定は VM の起動エージェントからの報告を受けた Discord Bot が呼び出す。
+// こちらはエージェントが報告できない場合 (異常終了など) の保険
 resource "google_cloud_scheduler_job" "minecraft_check" {
   name             = "minecraft-check"
-  description      = "5分ごとにCloud Functionを実行"
-  schedule         = "*/5 * * * *"
+  description      = "15分ごとにCloud Functionを実行 (Botからの呼び出しの保険)"
+  schedule         = "*/15 * * * *"
   time_zone        = "Asia/Tokyo"
+  # Bot 内のアイドル監視を使う場合は不要
+  paused           = var.bot_idle_monitor
   http_target {
     http_method = "GET"
     uri         = google_cloudfunctions_function.check_players.https_trigger_url
@@ -231,10 +310,10 @@ resource "google_project_iam_member" "discord_bot_sa_compute_admin" {
 // このリソースは、discord-botディレクトリの内容が変更された場合に再実行されるようにトリガーを設定
 // (実際のファイル内容のハッシュをトリガーにするのがより堅牢)
 locals {
-  # discord-bot ディレクトリ内の主要なソースファイル (bot.py, requirements.txt, Dockerfile, config.sample.py) の
+  # discord-bot ディレクトリ内の主要なソースファイル (*.py, requirements.txt, Dockerfile) の
   # 内容の変更を検知してイメージビルドをトリガーするためのハッシュを計算します。
   # これらのファイルが `${path.module}/discord-bot/` ディレクトリに存在することを想定しています。
-  discord_bot_monitored_files = fileset("${path.module}/discord-bot", "{bot.py,requirements.txt,Dockerfile,config.sample.py}")
+  discord_bot_monitored_files = fileset("${path.module}/discord-bot", "{*.py,requirements.txt,Dockerfile}")
   discord_bot_combined_hash = sha256(join("", [
     for f in sort(local.discord_bot_monitored_files) : filesha256("${path.module}/discord-bot/${f}")
   ]))
@@ -242,6 +321,19 @@ locals {
   # 他にも requirements.txt, Dockerfile などを含めるべきだが、例として bot.py のみ
 }
 
+// Bot の状態 (プリウォームの利用履歴モデル・マシンタイプの記録) の保存先
+resource "google_storage_bucket" "discord_bot_state" {
+  name     = "${var.project_id}-minecraft-bot-state"
+  location = var.region
+  uniform_bucket_level_access = true
+}
+
+resource "google_storage_bucket_iam_member" "discord_bot_state" {
+  bucket = google_storage_bucket.discord_bot_state.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.discord_bot_sa.email}"
+}
+
 resource "null_resource" "build_and_push_discord_bot_image" {
   triggers = {
     # bot.pyの内容が変更されたら再ビルド (より多くのファイルを監視することが望ましい)
@@ -300,6 +392,40 @@ resource "google_cloud_run_v2_service" "discord_bot_service" {
         name  = "DISCORD_CHANNEL_ID"
         value = var.discord_channel_id
       }
+      env {
+        name  = "RCON_PASSWORD"
+        value = var.rcon_password
+      }
+      env {
+        # Function は Bot の URL に依存しているため、循環しないよう URL を組み立てて渡す
+        name  = "CHECK_PLAYERS_URL"
+        value = "https://${var.region}-${var.project_id}.cloudfunctions.net/check-players"
+      }
+      env {
+        name  = "WEBHOOK_SECRET"
+        value = random_password.webhook_secret.result
+      }
+      env {
+        name  = "IDLE_MONITOR_ENABLED"
+        value = tostring(var.bot_idle_monitor)
+      }
+      env {
+        name  = "MACHINE_SIZING_ENABLED"
+        value = tostring(var.bot_machine_sizing)
+      }
+      env {
+        name  = "MACHINE_SIZES"
+        value = var.machine_sizes
+      }
+      env {
+        # Cloud Run のファイルシステムは消えるため、利用履歴モデルとマシンタイプの記録は GCS に置く
+        name  = "ACTIVITY_MODEL_PATH"
+        value = "gs://${google_storage_bucket.discord_bot_state.name}/activity-model.json"
+      }
+      env {
+        name  = "SIZING_STATE_PATH"
+        value = "gs://${google_storage_bucket.discord_bot_state.name}/sizing.json"
+      }
       # DISCORD_BOT_GCP_CREDENTIALS はCloud RunのSAを使うため、ここでは設定不要
     }
     service_account = google_service_account.discord_bot_sa.email
@@ -312,12 +438,13 @@ resource "google_cloud_run_v2_service" "discord_bot_service" {
 
   depends_on = [
     null_resource.build_and_push_discord_bot_image, // イメージがプッシュされた後にサービスを作成・更新
-    google_project_iam_member.discord_bot_sa_compute_admin // SAの権限設定後
+    google_project_iam_member.discord_bot_sa_compute_admin, // SAの権限設定後
+    google_storage_bucket_iam_member.discord_bot_state // 状態の保存先への権限設定後
   ]
 }
 
 // Cloud Runサービスを誰でも呼び出せるようにする (Webhook用)
-// 注意: これはBotのWebhookエンドポイントを公開します。必要に応じて認証を追加してください。
+// Webhook は WEBHOOK_SECRET (X-Webhook-Secret ヘッダー) が一致するリクエストだけを受け付ける
 resource "google_cloud_run_v2_service_iam_member" "discord_bot_service_invoker" {
   project  = google_cloud_run_v2_service.discord_bot_service.project
   location = google_cloud_run_v2_service.discord_bot_service.location
@@ -358,9 +485,12 @@ resource "google_cloudfunctions_function" "delete_old_snapshots" {
   region = var.region
   service_account_email = google_service_account.function_sa.email # 既存のSAを共用
   environment_variables = {
-    GCP_PROJECT              = var.project_id
-    SNAPSHOT_PREFIX          = "${var.instance_name}-snapshot-" # check-players Functionが作成するスナップショットのプレフィックスに合わせる
-    SNAPSHOT_RETENTION_COUNT = var.snapshot_retention_count
+    GCP_PROJECT               = var.project_id
+    SNAPSHOT_PREFIX           = "${var.instance_name}-snapshot-" # check-players Functionが作成するスナップショットのプレフィックスに合わせる
+    SNAPSHOT_SOURCES          = var.instance_name # <名前>-snapshot-* と <名前>-backup-* の両方を世代管理する
+    SNAPSHOT_RETENTION_COUNT  = var.snapshot_retention_count
+    SNAPSHOT_RETENTION_POLICY = var.snapshot_retention_policy # 空なら関数側の既定値
+    BACKUP_RETENTION_POLICY   = var.backup_retention_policy
   }
 }
 
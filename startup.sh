@@ -1,28 +1,41 @@
 #!/bin/bash
 set -eux
 
-# Adoptium（Eclipse Temurin）リポジトリ追加とJava 21インストール
-mkdir -p /etc/apt/keyrings
-wget -O- https://packages.adoptium.net/artifactory/api/gpg/key/public | tee /etc/apt/keyrings/adoptium.asc
+# セットアップと起動は Python の起動エージェント (vm-agent/boot_agent.py) が行う
+# - Java・server.jar はチェックサムで確認し、揃っていれば apt / ダウンロードを省略する
+# - 各段階の所要時間を計測し、プレイヤー数の変化を Discord Bot の Webhook に送る
+# エージェント本体はインスタンスメタデータ boot-agent で配布し、systemd サービスとして常駐させる
 
-echo "deb [signed-by=/etc/apt/keyrings/adoptium.asc] https://packages.adoptium.net/artifactory/deb bookworm main" > /etc/apt/sources.list.d/adoptium.list
+# Debian 12 のイメージには python3 が入っているが、念のため確認する
+command -v python3 || { apt-get update; DEBIAN_FRONTEND=noninteractive apt-get install -y python3; }
 
-apt-get update
-debian_frontend=noninteractive apt-get install -y temurin-21-jre wget screen
-
-# Minecraftサーバーディレクトリ作成
 mkdir -p /opt/minecraft
-cd /opt/minecraft
-
-# サーバーJARダウンロード（バニラ1.20.6）
-wget -O server.jar https://piston-data.mojang.com/v1/objects/e6ec2f64e6080b9b5d9b471b291c33cc7f509733/server.jar
-
-# EULA同意
-echo 'eula=true' > eula.txt
-
-# server.properties作成/編集（query有効化）
-grep -q '^enable-query=' server.properties 2>/dev/null && sed -i 's/^enable-query=.*/enable-query=true/' server.properties || echo 'enable-query=true' >> server.properties
-grep -q '^query.port=' server.properties 2>/dev/null || echo 'query.port=25565' >> server.properties
-
-# サーバー起動（screenでデタッチ）
-screen -dmS minecraft java -Xmx7168M -Xms7168M -XX:+UseG1GC -jar server.jar nogui # e2-standard-2 (8GB RAM) 向けに調整、Minecraftへ7GB割り当て、G1GC有効化 
\ No newline at end of file
+curl -sf -H "Metadata-Flavor: Google" \
+  http://metadata.google.internal/computeMetadata/v1/instance/attributes/boot-agent \
+  -o /opt/minecraft/boot_agent.py
+# ワールドの増分バックアップ (なければエージェントはバックアップなしで動く)
+curl -sf -H "Metadata-Flavor: Google" \
+  http://metadata.google.internal/computeMetadata/v1/instance/attributes/world-backup \
+  -o /opt/minecraft/world_backup.py || rm -f /opt/minecraft/world_backup.py
+
+# KillMode=mixed: 停止時は SIGTERM をエージェントにだけ送り、エージェントが stop コマンドでワールドを保存させる
+cat > /etc/systemd/system/minecraft.service <<'EOF'
+[Unit]
+Description=Minecraft server (boot agent)
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+ExecStart=/usr/bin/python3 /opt/minecraft/boot_agent.py
+WorkingDirectory=/opt/minecraft
+KillMode=mixed
+TimeoutStopSec=80
+Restart=on-failure
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+systemctl daemon-reload
+systemctl restart minecraft.service
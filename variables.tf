@@ -64,7 +64,50 @@ variable "cloud_build_region" {
 }
 
 variable "snapshot_retention_count" {
-  description = "保持するMinecraftサーバーのスナップショットの最大数"
+  description = "保持するMinecraftサーバーのスナップショットの最新の個数 (下の世代管理ルールの latest の既定値)"
   type        = number
   default     = 7
-} 
\ No newline at end of file
+}
+
+variable "snapshot_retention_policy" {
+  description = "停止前の自動スナップショット (<インスタンス名>-snapshot-*) の世代管理ルール (空なら latest=snapshot_retention_count,daily=7,weekly=4,monthly=3)"
+  type        = string
+  default     = ""
+}
+
+variable "backup_retention_policy" {
+  description = "/mc_backup の手動バックアップ (<インスタンス名>-backup-*) の世代管理ルール (空なら latest=snapshot_retention_count,weekly=8,monthly=12)"
+  type        = string
+  default     = ""
+}
+
+variable "rcon_password" {
+  description = "Minecraft RCONのパスワード (空の場合RCONは無効。設定するとスナップショット前にワールドを書き出す)"
+  type        = string
+  default     = ""
+  sensitive   = true
+}
+
+variable "rcon_source_ranges" {
+  description = "RCONポート(25575)への接続を許可する送信元CIDR (空の場合はファイアウォールを開けない)"
+  type        = list(string)
+  default     = []
+}
+
+variable "bot_idle_monitor" {
+  description = "Discord Bot 内のアイドル監視で停止判定を行う (true の場合、check-players の定期実行は一時停止する)"
+  type        = bool
+  default     = false
+}
+
+variable "bot_machine_sizing" {
+  description = "/mc_start などで起動する前に、見込みのプレイヤー数に合わせて Discord Bot がマシンタイプとヒープサイズを変える"
+  type        = bool
+  default     = false
+}
+
+variable "machine_sizes" {
+  description = "マシンタイプの選択に使うサイズ表 (マシンタイプ:最大人数:ヒープMB:1時間あたりの料金 をカンマ区切り。空なら Bot の既定値)"
+  type        = string
+  default     = ""
+}
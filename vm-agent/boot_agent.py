@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+# Minecraft VM の起動エージェント (startup.sh から systemd サービスとして起動される)
+# - Java (Temurin 21) と server.jar をチェックサムで確認し、揃っていれば apt / ダウンロードを省略する
+# - Minecraft サーバーを子プロセスとして起動し、各段階 (java / server_jar / config / jvm_start) の所要時間を計測する
+# - サーバーのログから参加・退出を拾い、プレイヤー数が変わるたびに Bot の Webhook へ送る
+#   (変化がなくても HEARTBEAT_SECONDS ごとに現在の人数を送る)
+# - メタデータ world-backup-request が書き換えられたら、ワールドの増分バックアップ (world_backup.py) を取って結果を Bot に送る
+# - メタデータ world-restore にバックアップID (または latest) があれば、サーバー起動前に1回だけワールドを復元する
+# - 起動後は TICK_SAMPLE_SECONDS ごとに tick query で1tickの平均処理時間 (mspt) を測り、heartbeat に付けて送る
+#   (マシンタイプごとの性能を Bot で比較するため。起動時の報告にマシンタイプとヒープサイズを付ける)
+#
+# VM の Debian 12 に標準で入っている python3 だけで動くよう、標準ライブラリのみを使う。
+# 設定はインスタンスメタデータから読む:
+#   bot-webhook-url   プレイヤー数の送信先 (未設定なら送信しない)
+#   bot-webhook-secret  送信時に X-Webhook-Secret ヘッダーに付ける Bot との共有シークレット
+#   rcon-password     設定されていれば RCON を有効化する
+#   java-heap-mb      Minecraft に割り当てるヒープ (既定 7168)
+#   server-jar-url / server-jar-sha1   server.jar の取得元と SHA-1 (既定はバニラ 1.20.6)
+#   world-backup-uri  増分バックアップの保存先 (gs://bucket/prefix またはローカルディレクトリ)
+import collections
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+try:
+    import world_backup
+except ImportError:  # 古い startup.sh で world_backup.py が配置されていない場合
+    world_backup = None
+
+MINECRAFT_DIR = "/opt/minecraft"
+WORLD_DIR = os.path.join(MINECRAFT_DIR, "world")
+STATE_PATH = os.path.join(MINECRAFT_DIR, ".boot-agent-state.json")
+# 保存済みオブジェクトの一覧 (バックアップのたびに保存先を一覧しなくて済むようにする)
+BACKUP_KNOWN_CACHE = os.path.join(MINECRAFT_DIR, ".world-backup-objects")
+DEFAULT_BACKUP_URI = "/var/backups/minecraft-world"
+METADATA_URL = "http://metadata.google.internal/computeMetadata/v1/instance/"
+
+JAVA_PACKAGE = "temurin-21-jre"
+ADOPTIUM_KEY_URL = "https://packages.adoptium.net/artifactory/api/gpg/key/public"
+ADOPTIUM_KEYRING = "/etc/apt/keyrings/adoptium.asc"
+ADOPTIUM_LIST = "/etc/apt/sources.list.d/adoptium.list"
+ADOPTIUM_REPO = f"deb [signed-by={ADOPTIUM_KEYRING}] https://packages.adoptium.net/artifactory/deb bookworm main"
+
+# バニラ 1.20.6 (URL のパスは SHA-1 そのもの)
+DEFAULT_SERVER_JAR_SHA1 = "e6ec2f64e6080b9b5d9b471b291c33cc7f509733"
+DEFAULT_SERVER_JAR_URL = f"https://piston-data.mojang.com/v1/objects/{DEFAULT_SERVER_JAR_SHA1}/server.jar"
+DEFAULT_HEAP_MB = 7168
+
+HEARTBEAT_SECONDS = 300
+PUSH_TIMEOUT = 5
+PUSH_RETRIES = 3
+# 終了前に未送信の報告 (exit など) を送り切るまで待つ上限
+FLUSH_TIMEOUT = 15
+# メタデータの変更待ち (long poll) の1回あたりの上限
+METADATA_WAIT_SECONDS = 300
+# tick query (1.20.3 以降) で mspt を測る間隔
+TICK_SAMPLE_SECONDS = 120
+
+# プレイヤー名は英数字と _ の16文字以内 (チャットの "<name> ..." には一致しない)
+_JOINED = re.compile(r"\]: (\w{1,16}) joined the game$")
+_LEFT = re.compile(r"\]: (\w{1,16}) left the game$")
+_DONE = re.compile(r"\]: Done \(([\d.]+)s\)!")
+_SAVE_OFF = re.compile(r"\]: (Automatic saving is now disabled|Saving is already turned off)")
+_SAVED = re.compile(r"\]: Saved the game")
+# 「Target tick rate: ...」と改行でつながった1メッセージなので、行頭に来ることもある
+_TICK_AVERAGE = re.compile(r"^(?:.*\]: )?Average time per tick: ([\d.]+)ms")
+
+
+def log(message):
+    print(f"[boot-agent] {message}", flush=True)
+
+
+def metadata(path, default=None):
+    request = urllib.request.Request(METADATA_URL + path, headers={"Metadata-Flavor": "Google"})
+    try:
+        with urllib.request.urlopen(request, timeout=2) as response:
+            return response.read().decode()
+    except (urllib.error.URLError, OSError):
+        return default
+
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def load_state():
+    try:
+        with open(STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_PATH)
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases = {}
+
+    def run(self, name, func, *args):
+        started_at = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.phases[name] = round(time.monotonic() - started_at, 2)
+            log(f"phase {name}: {self.phases[name]}s")
+
+    def mark(self, name, since):
+        self.phases[name] = round(time.monotonic() - since, 2)
+        log(f"phase {name}: {self.phases[name]}s")
+
+    def total(self):
+        return round(time.monotonic() - self.started_at, 2)
+
+
+# --- Java ---
+
+def java_installed(state):
+    """Temurin 21 が入っていて、java の実体が前回記録したハッシュと一致すれば True"""
+    java = shutil.which("java")
+    if not java:
+        return False
+    status = subprocess.run(
+        ["dpkg-query", "-W", "-f=${Status}", JAVA_PACKAGE], capture_output=True, text=True)
+    if status.returncode != 0 or "install ok installed" not in status.stdout:
+        return False
+    return file_digest(os.path.realpath(java), "sha256") == state.get("java_sha256")
+
+
+def ensure_java(state):
+    if java_installed(state):
+        log("Java はインストール済みのため apt を省略します")
+        return False
+    if not os.path.exists(ADOPTIUM_KEYRING):
+        os.makedirs(os.path.dirname(ADOPTIUM_KEYRING), exist_ok=True)
+        with urllib.request.urlopen(ADOPTIUM_KEY_URL, timeout=30) as response, open(ADOPTIUM_KEYRING, "wb") as f:
+            f.write(response.read())
+    if not os.path.exists(ADOPTIUM_LIST):
+        with open(ADOPTIUM_LIST, "w") as f:
+            f.write(ADOPTIUM_REPO + "\n")
+    env = dict(os.environ, DEBIAN_FRONTEND="noninteractive")
+    subprocess.run(["apt-get", "update"], check=True, env=env)
+    subprocess.run(["apt-get", "install", "-y", JAVA_PACKAGE], check=True, env=env)
+    state["java_sha256"] = file_digest(os.path.realpath(shutil.which("java")), "sha256")
+    save_state(state)
+    return True
+
+
+# --- server.jar ---
+
+def ensure_server_jar(url, sha1):
+    path = os.path.join(MINECRAFT_DIR, "server.jar")
+    if file_digest(path, "sha1") == sha1:
+        log("server.jar のチェックサムが一致したためダウンロードを省略します")
+        return False
+    tmp_path = path + ".download"
+    with urllib.request.urlopen(url, timeout=120) as response, open(tmp_path, "wb") as f:
+        shutil.copyfileobj(response, f, 1 << 20)
+    actual = file_digest(tmp_path, "sha1")
+    if actual != sha1:
+        os.remove(tmp_path)
+        raise RuntimeError(f"server.jar のチェックサムが一致しません: expected={sha1} actual={actual}")
+    os.replace(tmp_path, path)
+    return True
+
+
+# --- 設定ファイル ---
+
+def set_properties(path, values):
+    lines = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        pass
+    remaining = dict(values)
+    for index, line in enumerate(lines):
+        key = line.split("=", 1)[0]
+        if key in remaining:
+            lines[index] = f"{key}={remaining.pop(key)}"
+    lines.extend(f"{key}={value}" for key, value in remaining.items())
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_config(rcon_password):
+    with open(os.path.join(MINECRAFT_DIR, "eula.txt"), "w") as f:
+        f.write("eula=true\n")
+    values = {"enable-query": "true", "query.port": "25565"}
+    if rcon_password:
+        values.update({"enable-rcon": "true", "rcon.password": rcon_password, "rcon.port": "25575"})
+    set_properties(os.path.join(MINECRAFT_DIR, "server.properties"), values)
+
+
+# --- Bot への送信 ---
+
+class Reporter:
+    """報告を別スレッドで送る (送信が遅くてもログの読み取りを止めない)
+
+    プレイヤー数の報告 (players / heartbeat) は未送信の古いものを最新の1件で置き換える。
+    それ以外 (boot / backup / exit) は順に送り、失敗したら PUSH_RETRIES 回まで送り直す。
+    """
+
+    COALESCED = ("players", "heartbeat")
+
+    def __init__(self, url, instance, zone, secret=None):
+        self.url = url
+        self.secret = secret
+        self.instance = instance
+        self.zone = zone
+        self._pending = collections.deque()
+        self._sending = False
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True, name="reporter").start()
+
+    def push(self, event, **fields):
+        if not self.url:
+            return
+        payload = {"instance": self.instance, "zone": self.zone, "event": event, "sent_at": time.time(), **fields}
+        with self._condition:
+            if event in self.COALESCED:
+                self._pending = collections.deque(
+                    queued for queued in self._pending if queued["event"] not in self.COALESCED)
+            self._pending.append(payload)
+            self._condition.notify_all()
+
+    def _send(self, payload):
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Webhook-Secret"] = self.secret
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode(), headers=headers)
+        with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT):
+            pass
+
+    def flush(self, timeout):
+        """未送信の報告がなくなるまで最大 timeout 秒待つ (送信スレッドは daemon なので、終了前に呼ぶ)。送り切れたら True"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log(f"未送信の報告を残して終了します ({len(self._pending) + self._sending}件)")
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                payload = self._pending.popleft()
+                self._sending = True
+            try:
+                self._deliver(payload)
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _deliver(self, payload):
+        attempts = 1 if payload["event"] in self.COALESCED else PUSH_RETRIES
+        for attempt in range(attempts):
+            try:
+                self._send(payload)
+                break
+            except (urllib.error.URLError, OSError) as e:
+                log(f"Bot への送信に失敗しました ({payload['event']}, {attempt + 1}回目): {e}")
+                if attempt + 1 < attempts:
+                    time.sleep(2 ** attempt)
+
+
+# --- サーバーコンソール ---
+
+class Console:
+    """サーバーの標準入力にコマンドを送り、期待する出力行を待つ"""
+
+    def __init__(self, process):
+        self.process = process
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def feed(self, line):
+        with self._lock:
+            for waiter in self._waiters:
+                match = waiter[0].search(line)
+                if match and not waiter[1].is_set():
+                    waiter[2] = match
+                    waiter[1].set()
+
+    def run(self, command, expect=None, timeout=60):
+        """command を送り、expect に一致する行が timeout 秒以内に出たらその Match を返す (出なければ None)
+
+        expect を省略した場合は送信できたら True
+        """
+        waiter = [expect, threading.Event(), None]
+        if expect is not None:
+            with self._lock:
+                self._waiters.append(waiter)
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+            if expect is None:
+                return True
+            waiter[1].wait(timeout)
+            return waiter[2]
+        except OSError as e:
+            log(f"コンソールへの送信に失敗しました ({command}): {e}")
+            return None
+        finally:
+            if expect is not None:
+                with self._lock:
+                    self._waiters.remove(waiter)
+
+
+# --- ワールドのバックアップ / 復元 ---
+
+def restore_world(store_uri, backup_id, state):
+    """world-restore が指定されていて、まだ適用していなければワールドを復元する"""
+    if not backup_id or state.get("restored") == backup_id:
+        return False
+    if world_backup is None:
+        log("world_backup.py がないため復元できません")
+        return False
+    if os.path.exists(WORLD_DIR):
+        # 元のワールドは消さずに残す (ディスクを圧迫しないよう、残すのは直前の1つだけ)
+        for previous in glob.glob(f"{WORLD_DIR}.before-restore-*"):
+            shutil.rmtree(previous, ignore_errors=True)
+            log(f"以前の復元前のワールド {previous} を削除しました")
+        moved = f"{WORLD_DIR}.before-restore-{datetime.datetime.now():%Y%m%d-%H%M%S}"
+        os.rename(WORLD_DIR, moved)
+        log(f"既存のワールドを {moved} に移動しました")
+    manifest = world_backup.restore(world_backup.open_store(store_uri), backup_id, WORLD_DIR)
+    log(f"ワールドをバックアップ {manifest['id']} から復元しました ({len(manifest['files'])} ファイル)")
+    state["restored"] = backup_id
+    save_state(state)
+    return True
+
+
+def run_world_backup(console, store_uri, request_id, reporter):
+    """自動保存を止めてワールドを書き出し、増分バックアップを取って結果を Bot に送る"""
+    log(f"ワールドのバックアップを開始します (request={request_id})")
+    saving_off = console.run("save-off", _SAVE_OFF, timeout=10) is not None
+    try:
+        flushed = saving_off and console.run("save-all flush", _SAVED, timeout=120) is not None
+        if not flushed:
+            log("ワールドの書き出しを確認できませんでした。そのままバックアップします")
+        manifest = world_backup.backup(world_backup.open_store(store_uri), WORLD_DIR, known_cache=BACKUP_KNOWN_CACHE)
+    except Exception as e:
+        log(f"ワールドのバックアップに失敗しました: {type(e).__name__} - {e}")
+        reporter.push("backup", request=request_id, ok=False, error=f"{type(e).__name__}: {e}")
+        return
+    finally:
+        console.run("save-on")
+    log(f"ワールドのバックアップが完了しました: {manifest['id']} {json.dumps(manifest['stats'])}")
+    reporter.push("backup", request=request_id, ok=True, backup_id=manifest["id"], flushed=flushed,
+                  stats=manifest["stats"])
+
+
+def watch_backup_requests(console, store_uri, reporter, state):
+    """メタデータ world-backup-request の変更を long poll で待ち、新しい値が来るたびにバックアップする"""
+    etag = "0"
+    while console.process.poll() is None:
+        url = (f"{METADATA_URL}attributes/?recursive=true&wait_for_change=true"
+               f"&timeout_sec={METADATA_WAIT_SECONDS}&last_etag={etag}")
+        request = urllib.request.Request(url, headers={"Metadata-Flavor": "Google"})
+        try:
+            with urllib.request.urlopen(request, timeout=METADATA_WAIT_SECONDS + 10) as response:
+                etag = response.headers.get("ETag", etag)
+                attributes = json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            log(f"メタデータの監視に失敗しました: {e}")
+            time.sleep(10)
+            continue
+        request_id = attributes.get("world-backup-request")
+        if not request_id or request_id == state.get("backup_request"):
+            continue
+        state["backup_request"] = request_id
+        save_state(state)
+        run_world_backup(console, store_uri, request_id, reporter)
+
+
+# --- 起動と監視 ---
+
+def launch(heap_mb):
+    command = [
+        "java", f"-Xmx{heap_mb}M", f"-Xms{heap_mb}M", "-XX:+UseG1GC", "-jar", "server.jar", "nogui",
+    ]
+    log(f"Minecraft サーバーを起動します: {' '.join(command)}")
+    return subprocess.Popen(
+        command, cwd=MINECRAFT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        text=True, bufsize=1)
+
+
+class TickSampler:
+    """tick query で mspt (1tickの平均処理時間、ミリ秒) を定期的に測り、報告のたびに平均と最大を渡す"""
+
+    def __init__(self, console):
+        self.console = console
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def run(self, stopping):
+        while not stopping.wait(TICK_SAMPLE_SECONDS):
+            match = self.console.run("tick query", _TICK_AVERAGE, timeout=10)
+            if match is None:
+                if not self._samples:
+                    # tick コマンドのない古いバージョンでは測らない
+                    log("tick query に応答がないため、mspt の計測をやめます")
+                    return
+                continue
+            with self._lock:
+                self._samples.append(float(match.group(1)))
+
+    def drain(self):
+        """前回から測った mspt の平均と最大 (報告に付けるフィールド)"""
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if not samples:
+            return {}
+        return {"mspt": round(sum(samples) / len(samples), 2), "mspt_max": max(samples)}
+
+
+def supervise(process, console, reporter, timer, launched_at, machine):
+    players = set()
+    lock = threading.Lock()
+    stopping = threading.Event()
+    sampler = TickSampler(console)
+
+    def heartbeat():
+        while not stopping.wait(HEARTBEAT_SECONDS):
+            with lock:
+                current = sorted(players)
+            reporter.push("heartbeat", players=current, count=len(current), **sampler.drain())
+
+    def terminate(signum, frame):
+        # systemd の停止 / VM のシャットダウン時は stop コマンドでワールドを保存してから終了させる
+        log("停止シグナルを受信しました。サーバーに stop を送ります")
+        try:
+            process.stdin.write("stop\n")
+            process.stdin.flush()
+        except OSError:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    threading.Thread(target=heartbeat, daemon=True, name="heartbeat").start()
+
+    ready = False
+    for line in process.stdout:
+        sys.stdout.write(line)
+        console.feed(line)
+        if not ready and _DONE.search(line):
+            ready = True
+            timer.mark("jvm_start", launched_at)
+            log(f"起動完了: 合計 {timer.total()}s {json.dumps(timer.phases)}")
+            reporter.push("boot", phases=timer.phases, total=timer.total(), players=[], count=0, **machine)
+            threading.Thread(target=sampler.run, args=(stopping,), daemon=True, name="tick-sampler").start()
+            continue
+        joined = _JOINED.search(line.rstrip())
+        left = _LEFT.search(line.rstrip()) if joined is None else None
+        if joined is None and left is None:
+            continue
+        with lock:
+            if joined:
+                players.add(joined.group(1))
+            else:
+                players.discard(left.group(1))
+            current = sorted(players)
+        reporter.push("players", players=current, count=len(current))
+    stopping.set()
+    code = process.wait()
+    reporter.push("exit", code=code, players=[], count=0)
+    reporter.flush(FLUSH_TIMEOUT)
+    return code
+
+
+def main():
+    os.makedirs(MINECRAFT_DIR, exist_ok=True)
+    timer = PhaseTimer()
+    state = load_state()
+    instance = metadata("name", "minecraft-server")
+    zone = (metadata("zone", "") or "").split("/")[-1]
+    reporter = Reporter(metadata("attributes/bot-webhook-url"), instance, zone,
+                        metadata("attributes/bot-webhook-secret"))
+
+    timer.run("java", ensure_java, state)
+    timer.run("server_jar", ensure_server_jar,
+              metadata("attributes/server-jar-url", DEFAULT_SERVER_JAR_URL),
+              metadata("attributes/server-jar-sha1", DEFAULT_SERVER_JAR_SHA1))
+    timer.run("config", write_config, metadata("attributes/rcon-password"))
+    backup_uri = metadata("attributes/world-backup-uri", DEFAULT_BACKUP_URI)
+    timer.run("restore", restore_world, backup_uri, metadata("attributes/world-restore"), state)
+
+    # ヒープサイズは Bot がマシンタイプに合わせて書き換えることがある
+    heap_mb = int(metadata("attributes/java-heap-mb", DEFAULT_HEAP_MB))
+    machine = {"machine_type": (metadata("machine-type", "") or "").split("/")[-1], "heap_mb": heap_mb}
+    launched_at = time.monotonic()
+    process = launch(heap_mb)
+    console = Console(process)
+    if world_backup is not None:
+        threading.Thread(target=watch_backup_requests, args=(console, backup_uri, reporter, state),
+                         daemon=True, name="backup-watcher").start()
+    return supervise(process, console, reporter, timer, launched_at, machine)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
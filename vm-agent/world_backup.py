@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# ワールド (/opt/minecraft/world) の増分バックアップ
+# ブートディスク全体のスナップショット (OS・JRE を含む) の代わりに、ワールドのファイルだけを
+# 内容アドレス (SHA-256) のオブジェクトとしてオブジェクトストレージに保存する。
+# - リージョンファイル (.mca: region/ entities/ poi/) はチャンク単位に分解し、変わったチャンクだけを送る
+#   (チャンクは Minecraft が圧縮済みなのでそのまま、無圧縮チャンクとそれ以外のファイルは zlib で圧縮して送る)
+# - 前回のマニフェストとサイズ・更新時刻が同じファイルは読まずに前回のエントリを使う
+# - バックアップごとにマニフェスト (manifests/<id>.json.gz) を1つ書く。どのマニフェストからでも復元できる
+# - 復元したリージョンファイルはチャンクを詰めて並べ直すため、元のファイルとバイト単位では一致しない
+#   (チャンクの内容とタイムスタンプは同じ)
+#
+# 保存先 (URI):
+#   gs://bucket/prefix  → Cloud Storage (VM のサービスアカウントで JSON API を直接呼ぶ)
+#   それ以外のパス      → ローカルディレクトリ (開発用・ディスクに余裕がある場合の代替)
+#
+# 起動エージェント (boot_agent.py) から使うほか、VM 上で直接実行できる:
+#   python3 world_backup.py backup  --store gs://my-bucket/world --world /opt/minecraft/world
+#   python3 world_backup.py restore --store gs://my-bucket/world --id latest --target /opt/minecraft/world.restored
+#   python3 world_backup.py list    --store gs://my-bucket/world
+#
+# VM の python3 だけで動くよう、標準ライブラリのみを使う。
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+SECTOR = 4096
+CHUNKS_PER_REGION = 1024
+# チャンクの圧縮形式 (1: gzip, 2: zlib, 3: 無圧縮, 4: LZ4)。0x80 はチャンク本体が外部 .mcc ファイルにある印
+CHUNK_UNCOMPRESSED = 3
+# オブジェクトの先頭1バイト: 保存時の符号化
+RAW = b"\x00"
+ZLIB = b"\x01"
+# バックアップしないファイル (サーバーが起動中に握っているロック)
+SKIP_FILES = {"session.lock"}
+UPLOAD_WORKERS = 8
+METADATA_TOKEN_URL = "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
+
+
+class BackupError(Exception):
+    """マニフェストやオブジェクトが見つからない・壊れている場合の例外"""
+
+
+# --- 保存先 ---
+
+class LocalObjectStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BackupError(f"オブジェクトがありません: {key}")
+
+    def list(self, prefix):
+        base = self._path(prefix.rstrip("/"))
+        keys = []
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                relative = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                keys.append(relative.replace(os.sep, "/"))
+        return keys
+
+
+class GcsObjectStore:
+    """Cloud Storage の JSON API を urllib で呼ぶ保存先 (アクセストークンはメタデータサーバーから取得)"""
+
+    API = "https://storage.googleapis.com/storage/v1/b/"
+    UPLOAD_API = "https://storage.googleapis.com/upload/storage/v1/b/"
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+        self._token = None
+        self._token_expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _authorization(self):
+        with self._lock:
+            if self._token is None or time.monotonic() > self._token_expires_at:
+                request = urllib.request.Request(METADATA_TOKEN_URL, headers={"Metadata-Flavor": "Google"})
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    token = json.load(response)
+                self._token = token["access_token"]
+                self._token_expires_at = time.monotonic() + token["expires_in"] - 60
+            return f"Bearer {self._token}"
+
+    def _call(self, url, data=None, method="GET"):
+        headers = {"Authorization": self._authorization()}
+        if data is not None:
+            headers["Content-Type"] = "application/octet-stream"
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.read()
+
+    def _name(self, key):
+        return urllib.parse.quote(self.prefix + key, safe="")
+
+    def put(self, key, data):
+        self._call(f"{self.UPLOAD_API}{self.bucket}/o?uploadType=media&name={self._name(key)}", data, "POST")
+
+    def get(self, key):
+        try:
+            return self._call(f"{self.API}{self.bucket}/o/{self._name(key)}?alt=media")
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise BackupError(f"オブジェクトがありません: {key}")
+            raise
+
+    def list(self, prefix):
+        keys = []
+        page_token = None
+        while True:
+            query = {"prefix": self.prefix + prefix, "fields": "items(name),nextPageToken"}
+            if page_token:
+                query["pageToken"] = page_token
+            response = json.loads(self._call(f"{self.API}{self.bucket}/o?{urllib.parse.urlencode(query)}"))
+            keys.extend(item["name"][len(self.prefix):] for item in response.get("items", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return keys
+
+
+def open_store(uri):
+    if uri.startswith("gs://"):
+        bucket, _, prefix = uri[len("gs://"):].partition("/")
+        return GcsObjectStore(bucket, prefix)
+    return LocalObjectStore(uri)
+
+
+# --- オブジェクト ---
+
+def object_key(digest):
+    return f"objects/{digest[:2]}/{digest}"
+
+
+def encode_object(data, compress):
+    if compress:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    return RAW + data
+
+
+def decode_object(blob, digest):
+    codec, body = blob[:1], blob[1:]
+    data = zlib.decompress(body) if codec == ZLIB else body
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise BackupError(f"オブジェクトのハッシュが一致しません: {digest}")
+    return data
+
+
+class _Uploader:
+    """未保存のオブジェクトだけを並行して保存する"""
+
+    def __init__(self, store, known):
+        self.store = store
+        self.known = known
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.reused = 0
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="world-backup")
+
+    def add(self, data, compress):
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.known:
+            self.reused += 1
+            return digest
+        self.known.add(digest)
+        blob = encode_object(data, compress)
+        self.uploaded += 1
+        self.uploaded_bytes += len(blob)
+        self._futures.append(self._executor.submit(self.store.put, object_key(digest), blob))
+        return digest
+
+    def finish(self):
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+
+# --- リージョンファイル ---
+
+def split_region(data):
+    """(タイムスタンプ1024個, [チャンク本体 or None] 1024個) を返す。チャンク本体は圧縮形式の1バイト + データ"""
+    locations = struct.unpack_from(">1024I", data, 0)
+    timestamps = list(struct.unpack_from(">1024I", data, SECTOR))
+    chunks = []
+    for location in locations:
+        offset = (location >> 8) * SECTOR
+        if location == 0 or offset + 5 > len(data):
+            chunks.append(None)
+            continue
+        length = struct.unpack_from(">I", data, offset)[0]
+        if length == 0:
+            chunks.append(None)
+            continue
+        chunks.append(data[offset + 4:offset + 4 + length])
+    return timestamps, chunks
+
+
+def build_region(timestamps, chunks):
+    """split_region の逆。チャンクを先頭から詰めて並べ直したリージョンファイルを返す"""
+    header = bytearray(SECTOR * 2)
+    body = bytearray()
+    sector = 2
+    for index, chunk in enumerate(chunks):
+        if chunk is None:
+            continue
+        record = struct.pack(">I", len(chunk)) + chunk
+        count = -(-len(record) // SECTOR)
+        record += b"\x00" * (count * SECTOR - len(record))
+        struct.pack_into(">I", header, index * 4, sector << 8 | min(count, 255))
+        body += record
+        sector += count
+    struct.pack_into(">1024I", header, SECTOR, *timestamps)
+    return bytes(header + body)
+
+
+def is_region(relative, size):
+    return relative.endswith(".mca") and size >= SECTOR * 2
+
+
+# --- マニフェスト ---
+
+def manifest_key(backup_id):
+    return f"manifests/{backup_id}.json.gz"
+
+
+def list_backups(store):
+    ids = [key[len("manifests/"):-len(".json.gz")] for key in store.list("manifests/") if key.endswith(".json.gz")]
+    return sorted(ids)
+
+
+def load_manifest(store, backup_id):
+    if backup_id == "latest":
+        ids = list_backups(store)
+        if not ids:
+            raise BackupError("バックアップがありません")
+        backup_id = ids[-1]
+    return json.loads(gzip.decompress(store.get(manifest_key(backup_id))))
+
+
+def _walk_world(world_dir):
+    for dirpath, dirnames, filenames in os.walk(world_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename in SKIP_FILES:
+                continue
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, world_dir).replace(os.sep, "/"), path
+
+
+def _load_known(store, cache_path):
+    """保存済みオブジェクトのハッシュ集合 (キャッシュがなければ保存先を一覧する)"""
+    if cache_path:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                return set(f.read().split())
+        except FileNotFoundError:
+            pass
+    return {key.rsplit("/", 1)[-1] for key in store.list("objects/")}
+
+
+def _save_known(known, cache_path):
+    if not cache_path:
+        return
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(sorted(known)))
+    os.replace(tmp_path, cache_path)
+
+
+def backup(store, world_dir, backup_id=None, known_cache=None):
+    """world_dir の増分バックアップを作り、マニフェストを返す
+
+    known_cache: 保存済みオブジェクトのハッシュを記録するローカルファイル (毎回の一覧を省く)
+    """
+    started_at = time.monotonic()
+    backup_id = backup_id or datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+    ids = list_backups(store)
+    previous = load_manifest(store, ids[-1])["files"] if ids else {}
+    known = _load_known(store, known_cache)
+    uploader = _Uploader(store, known)
+    files = {}
+    stats = {"files": 0, "unchanged_files": 0, "regions": 0, "chunks": 0, "changed_chunks": 0}
+    try:
+        for relative, path in _walk_world(world_dir):
+            st = os.stat(path)
+            stats["files"] += 1
+            old = previous.get(relative)
+            if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                files[relative] = old
+                stats["unchanged_files"] += 1
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            entry = {"size": len(data), "mtime_ns": st.st_mtime_ns}
+            if is_region(relative, len(data)):
+                timestamps, chunks = split_region(data)
+                before = uploader.uploaded
+                keys = [
+                    None if chunk is None else uploader.add(chunk, compress=chunk[0] == CHUNK_UNCOMPRESSED)
+                    for chunk in chunks
+                ]
+                stats["regions"] += 1
+                stats["chunks"] += sum(key is not None for key in keys)
+                stats["changed_chunks"] += uploader.uploaded - before
+                index = json.dumps({"timestamps": timestamps, "chunks": keys}, separators=(",", ":")).encode()
+                entry.update(kind="region", object=uploader.add(index, compress=True))
+            else:
+                entry.update(kind="file", object=uploader.add(data, compress=True))
+            files[relative] = entry
+    finally:
+        uploader.finish()
+    stats.update(
+        uploaded_objects=uploader.uploaded,
+        uploaded_bytes=uploader.uploaded_bytes,
+        reused_objects=uploader.reused,
+        elapsed=round(time.monotonic() - started_at, 2),
+    )
+    manifest = {
+        "version": 1,
+        "id": backup_id,
+        "created_at": time.time(),
+        "world": os.path.basename(os.path.normpath(world_dir)),
+        "files": files,
+        "stats": stats,
+    }
+    # オブジェクトをすべて保存してからマニフェストを書く (途中で失敗しても壊れたバックアップは見えない)
+    store.put(manifest_key(backup_id), gzip.compress(json.dumps(manifest, separators=(",", ":")).encode()))
+    _save_known(known, known_cache)
+    return manifest
+
+
+def restore(store, backup_id, target_dir):
+    """マニフェストの内容を target_dir に書き出し、マニフェストを返す (target_dir の既存ファイルは上書きする)"""
+    manifest = load_manifest(store, backup_id)
+
+    def fetch(digest):
+        return decode_object(store.get(object_key(digest)), digest)
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="world-restore") as executor:
+        for relative, entry in manifest["files"].items():
+            data = fetch(entry["object"])
+            if entry["kind"] == "region":
+                index = json.loads(data)
+                chunks = list(executor.map(lambda key: None if key is None else fetch(key), index["chunks"]))
+                data = build_region(index["timestamps"], chunks)
+            path = os.path.join(target_dir, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.restore.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Minecraft ワールドの増分バックアップ")
+    parser.add_argument("command", choices=("backup", "restore", "list"))
+    parser.add_argument("--store", required=True, help="gs://bucket/prefix またはローカルディレクトリ")
+    parser.add_argument("--world", default="/opt/minecraft/world")
+    parser.add_argument("--id", default="latest", help="復元するバックアップ (既定: latest)")
+    parser.add_argument("--target", help="復元先 (既定: --world)")
+    parser.add_argument("--known-cache", help="保存済みオブジェクトの一覧を記録するファイル")
+    args = parser.parse_args(argv)
+    store = open_store(args.store)
+    if args.command == "list":
+        for backup_id in list_backups(store):
+            print(backup_id)
+    elif args.command == "backup":
+        manifest = backup(store, args.world, known_cache=args.known_cache)
+        print(json.dumps({"id": manifest["id"], **manifest["stats"]}, ensure_ascii=False))
+    else:
+        manifest = restore(store, args.id, args.target or args.world)
+        print(f"{manifest['id']} を復元しました ({len(manifest['files'])} ファイル)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())